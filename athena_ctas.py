@@ -0,0 +1,161 @@
+# Athena CTAS statements that build the warehouse star schema
+# next to the raw tables, so the data never leaves S3.
+# Columns, types and surrogate keys follow transforms.py without a key
+# registry, the rows are numbered in the same total order
+CTAS_PREFIX = "ctas_"
+
+# Same remap as fips_codec.STATE_CODE_REMAP
+STATE_CODE = "CASE WHEN {code} / 1000 = 0 THEN 72 ELSE {code} / 1000 END"
+
+
+def code_text(col):
+    """Source code crawled as text, bigint or double -> the digits covid_aws_de.clean_codes gives"""
+    digits = f"regexp_replace(regexp_replace(CAST({col} AS varchar), '\\.0+$', ''), '^0+', '')"
+    return f"CASE WHEN {digits} = '' THEN '0' ELSE {digits} END"
+
+
+def fips_code(col):
+    return f"CAST({code_text(col)} AS integer)"
+
+
+def padded(expr, width):
+    return f"lpad(CAST({expr} AS varchar), {width}, '0')"
+
+
+def ctas(table, database, location, select):
+    return f"""
+        CREATE TABLE {database}.{CTAS_PREFIX}{table}
+        WITH (format = 'PARQUET', write_compression = 'SNAPPY', external_location = '{location}')
+        AS {select}
+    """
+
+
+def drop_sql(table, database):
+    return f"DROP TABLE IF EXISTS {database}.{CTAS_PREFIX}{table}"
+
+
+def dim_region_select():
+    """dim_region rows, numbered in the same total order transforms.build_dim_region sorts by"""
+    fips = fips_code("fips")
+    return f"""
+        WITH jhu AS (
+            SELECT DISTINCT {fips} AS fips_code, province_state, country_region, latitude, longitude
+            FROM enigma_jhu
+            WHERE fips IS NOT NULL AND (province_state IS NULL OR province_state <> 'Grand Princess')
+        ), nyt AS (
+            SELECT DISTINCT {fips} AS fips_code, county
+            FROM nytimes_data_us_county
+            WHERE fips IS NOT NULL
+        ), region AS (
+            SELECT DISTINCT jhu.fips_code, {STATE_CODE.format(code="jhu.fips_code")} AS state_code,
+                jhu.fips_code % 1000 AS county_code, province_state, county, country_region, latitude, longitude
+            FROM jhu JOIN nyt ON jhu.fips_code = nyt.fips_code
+            WHERE latitude IS NOT NULL AND longitude IS NOT NULL
+        )
+        SELECT CAST(ROW_NUMBER() OVER (ORDER BY state_code, county_code, province_state, county,
+                                       country_region, latitude, longitude) AS integer) AS region_sk,
+            {padded("fips_code", 5)} AS fips, {padded("state_code", 2)} AS state_fips,
+            {padded("county_code", 3)} AS county_fips, province_state, county, country_region,
+            CAST(latitude AS real) AS latitude, CAST(longitude AS real) AS longitude
+        FROM region
+    """
+
+
+def dim_region_sql(database, location):
+    return ctas("dim_region", database, location, dim_region_select())
+
+
+def dim_hospital_select():
+    """dim_hospital rows, numbered in the same total order transforms.build_dim_hospital sorts by"""
+    fips = fips_code("fips")
+    zip_code = code_text("hq_zip_code")
+    return f"""
+        WITH hospital AS (
+            SELECT {fips} AS fips_code, {STATE_CODE.format(code=fips)} AS state_code,
+                {fips} % 1000 AS county_code, state_name, county_name, hospital_name, hq_address, hq_city,
+                hq_state, lpad({zip_code}, CAST(greatest(length({zip_code}), 5) AS integer), '0') AS hq_zip_code,
+                hospital_type, latitude, longtitude
+            FROM rearc_usa_hospital_beds
+            WHERE fips IS NOT NULL AND state_name IS NOT NULL
+        )
+        SELECT CAST(ROW_NUMBER() OVER (ORDER BY state_code, county_code, hospital_name, hq_address, state_name,
+                                       county_name, hq_city, hq_state, hq_zip_code, hospital_type,
+                                       latitude, longtitude) AS integer) AS hosp_sk,
+            {padded("fips_code", 5)} AS fips, {padded("state_code", 2)} AS state_fips,
+            {padded("county_code", 3)} AS county_fips,
+            state_name, county_name, hospital_name, hq_address, hq_city, hq_state, hq_zip_code, hospital_type,
+            CAST(latitude AS real) AS latitude, CAST(longtitude AS real) AS longtitude
+        FROM hospital
+    """
+
+
+def dim_hospital_sql(database, location):
+    return ctas("dim_hospital", database, location, dim_hospital_select())
+
+
+def dim_date_select(horizon_days=0, loaded=None):
+    """Calendar from the first source date to horizon_days past the later of
+    today and the last source date, leaving out the loaded (first, last) date_id range"""
+    missing = f"WHERE date_id NOT BETWEEN {int(loaded[0])} AND {int(loaded[1])}" if loaded else ""
+    return f"""
+        WITH bounds AS (
+            SELECT CAST(date_parse(CAST(MIN(date) AS varchar), '%Y%m%d') AS date) AS first_day,
+                date_add('day', {int(horizon_days)}, greatest(
+                    CAST(date_parse(CAST(MAX(date) AS varchar), '%Y%m%d') AS date), current_date)) AS last_day
+            FROM rearc_testing_states_daily
+        ), days AS (
+            SELECT day_date,
+                CAST(year(day_date) * 10000 + month(day_date) * 100 + day(day_date) AS integer) AS date_id
+            FROM bounds CROSS JOIN UNNEST(sequence(first_day, last_day, INTERVAL '1' DAY)) AS t (day_date)
+        )
+        SELECT date_id,
+            day_date AS date, date_format(day_date, '%W') AS day_name,
+            CAST(day_of_week(day_date) AS integer) AS day_of_week, CAST(day(day_date) AS integer) AS day,
+            CAST(day_of_year(day_date) AS integer) AS day_of_year, CAST(month(day_date) AS integer) AS month,
+            date_format(day_date, '%M') AS month_name, CAST(week(day_date) AS integer) AS week,
+            CAST(quarter(day_date) AS integer) AS quarter, CAST(year(day_date) AS integer) AS year,
+            CASE WHEN month(day_date) < 7 THEN 1 ELSE 2 END AS year_half,
+            day_of_week(day_date) >= 6 AS is_weekend
+        FROM days
+        {missing}
+    """
+
+
+def dim_date_sql(database, location, horizon_days=0, loaded=None):
+    return ctas("dim_date", database, location, dim_date_select(horizon_days, loaded))
+
+
+def fact_covid_select(database, cutoff=None):
+    """fact_covid rows from the CTAS dimension tables, only days after cutoff when given"""
+    real = ["positive", "negative", "death", "recovered", "hospitalized", "hospitalizedcurrently",
+            "hospitalizeddischarged", "hospitalizedcumulative"]
+    integer = ["positiveincrease", "deathincrease", "hospitalizedincrease"]
+    measures = {col: f"CAST(COALESCE(f.{col}, 0) AS {'real' if col in real else 'integer'}) AS {col}"
+                for col in real + integer}
+    after = f" AND date > {int(cutoff)}" if cutoff is not None else ""
+    return f"""
+        WITH f AS (
+            SELECT *, {fips_code("fips")} AS state_code
+            FROM rearc_testing_states_daily
+            WHERE fips IS NOT NULL AND state IS NOT NULL{after}
+        ), r AS (
+            SELECT CAST(state_fips AS integer) AS state_code, MIN(region_sk) AS region_sk
+            FROM {database}.{CTAS_PREFIX}dim_region GROUP BY 1
+        ), h AS (
+            SELECT CAST(state_fips AS integer) AS state_code, MIN(hosp_sk) AS hosp_sk
+            FROM {database}.{CTAS_PREFIX}dim_hospital GROUP BY 1
+        )
+        SELECT CAST(f.date AS integer) AS date, {padded("f.state_code", 2)} AS state_fips, f.state,
+            {measures["positive"]}, {measures["positiveincrease"]}, {measures["negative"]},
+            {measures["death"]}, {measures["deathincrease"]}, {measures["recovered"]},
+            {measures["hospitalized"]}, {measures["hospitalizedcurrently"]},
+            {measures["hospitalizeddischarged"]}, {measures["hospitalizedcumulative"]},
+            {measures["hospitalizedincrease"]}, r.region_sk, h.hosp_sk
+        FROM f
+            JOIN r ON f.state_code = r.state_code
+            JOIN h ON f.state_code = h.state_code
+    """
+
+
+def fact_covid_sql(database, location, cutoff=None):
+    return ctas("fact_covid", database, location, fact_covid_select(database, cutoff))
@@ -0,0 +1,70 @@
+# Compare the CSV and parquet serializers used for the warehouse
+# tables on a synthetic fact_covid table
+#
+# python benchmarks/bench_output_formats.py --days 420 --states 56 --repeat 3
+import argparse
+import sys
+import time
+from io import BytesIO
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pyarrow.parquet as pq
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+import dwh_output  # noqa: E402
+
+FLOAT_COLUMNS = ['positive', 'negative', 'death', 'recovered', 'hospitalized', 'hospitalizedcurrently',
+                 'hospitalizeddischarged', 'hospitalizedcumulative']
+INT_COLUMNS = ['positiveincrease', 'deathincrease', 'hospitalizedincrease']
+
+
+def make_fact_covid(days, states, seed=0):
+    rng = np.random.default_rng(seed)
+    dates = pd.date_range("2020-01-13", periods=days)
+    n = days * states
+    df = pd.DataFrame({
+        "date": np.repeat((dates.year * 10000 + dates.month * 100 + dates.day).to_numpy(), states),
+        "state_fips": np.tile([str(i).zfill(2) for i in range(1, states + 1)], days),
+    })
+    df["state"] = pd.Categorical(np.tile([f"S{i}" for i in range(states)], days))
+    for col in FLOAT_COLUMNS:
+        df[col] = rng.gamma(2.0, 5000.0, n).round()
+    for col in INT_COLUMNS:
+        df[col] = rng.integers(0, 5000, n)
+    df["region_sk"] = np.tile(np.arange(1, states + 1), days)
+    df["hosp_sk"] = np.tile(np.arange(1, states + 1), days)
+    return df[list(dwh_output.PARQUET_DTYPES["fact_covid"])]
+
+
+def copy_bytes(body, output_format):
+    """Bytes COPY has to decode, uncompressed column data for parquet"""
+    if output_format == "csv":
+        return len(body)
+    meta = pq.ParquetFile(BytesIO(body)).metadata
+    return sum(meta.row_group(i).total_byte_size for i in range(meta.num_row_groups))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="CSV vs parquet serialization of fact_covid")
+    parser.add_argument("--days", type=int, default=420)
+    parser.add_argument("--states", type=int, default=56)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    df = make_fact_covid(args.days, args.states)
+    print(f"fact_covid: {len(df)} rows, {df.memory_usage(deep=True).sum()} bytes in memory")
+    print(f"{'format' : <10}{'serialize s' : >14}{'object bytes' : >16}{'copy bytes' : >16}")
+    for output_format in dwh_output.OUTPUT_FORMATS:
+        timings = []
+        for _ in range(args.repeat):
+            t0 = time.perf_counter()
+            body = dwh_output.serialize(df, "fact_covid", output_format)
+            timings.append(time.perf_counter() - t0)
+        print(f"{output_format : <10}{round(min(timings), 4) : >14}{len(body) : >16}"
+              f"{copy_bytes(body, output_format) : >16}")
+
+
+if __name__ == "__main__":
+    main()
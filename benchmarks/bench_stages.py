@@ -0,0 +1,132 @@
+# Time and memory profile the transform stages and the upload of the
+# warehouse tables on synthetic sources at several scale factors.
+# Uploads go to an in-process moto S3, nothing leaves the machine
+#
+# pip install "moto[s3]"
+# python benchmarks/bench_stages.py --scales 1 10 100 --repeat 3 --json bench_stages.jsonl
+import argparse
+import contextlib
+import gc
+import io
+import json
+import os
+import sys
+import time
+import tracemalloc
+from pathlib import Path
+
+import boto3
+import pandas as pd
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+import dwh_output  # noqa: E402
+import frame_memory  # noqa: E402
+import transforms  # noqa: E402
+from synthetic_sources import make_sources  # noqa: E402
+
+try:
+    from moto import mock_aws
+except ImportError as e:
+    raise ImportError("bench_stages uploads to a moto S3, pip install 'moto[s3]'") from e
+
+BUCKET = "bench-covid19-de"
+OUTPUT_DIR = "output/"
+
+
+def profile(fn, repeat):
+    """Best wall time over `repeat` quiet runs, then one traced run for the peak allocation
+
+    :return: (result, seconds, peak traced MB)
+    """
+    timings = []
+    for _ in range(repeat):
+        gc.collect()
+        with contextlib.redirect_stdout(io.StringIO()):
+            t0 = time.perf_counter()
+            result = fn()
+            timings.append(time.perf_counter() - t0)
+    gc.collect()
+    tracemalloc.start()
+    with contextlib.redirect_stdout(io.StringIO()):
+        fn()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return result, min(timings), round(peak / 1024 ** 2, 2)
+
+
+def upload_tables(client, tables, output_format, parts):
+    """Serialize and upload every table like upload_transform
+
+    :return: bytes uploaded
+    """
+    compression = None if output_format == "parquet" else "gzip"
+    ext = dwh_output.file_extension(output_format, compression)
+    total = 0
+    for name, df in tables.items():
+        bodies = dwh_output.serialize_parts(df, name, parts, output_format, compression=compression)
+        dwh_output.put_parts(client, bodies, name, BUCKET, OUTPUT_DIR, ext)
+        total += sum(len(body) for body in bodies)
+    return total
+
+
+def bench_scale(scale, repeat, parts, client):
+    """Run every stage at one scale factor
+
+    :return: list of result dicts
+    """
+    sources = make_sources(scale)
+    source_rows = sum(len(df) for df in sources.values())
+    print(f"scale {scale}x: {source_rows} source rows, "
+          f"{round(sum(frame_memory.deep_memory_mb(df) for df in sources.values()), 2)}MB")
+    print(f"    {'stage' : <16}{'rows/bytes' : >12}{'best s' : >12}{'peak MB' : >12}{'rss MB' : >12}")
+    daily = sources["rearc_testing_states_daily"]
+    dates = pd.to_datetime(daily["date"], format="%Y%m%d")
+    stages = {
+        "dim_region": lambda: transforms.build_dim_region(sources["enigma_jhu"], sources["nytimes_data_us_county"]),
+        "dim_hospital": lambda: transforms.build_dim_hospital(sources["rearc_usa_hospital_beds"]),
+        "dim_date": lambda: transforms.create_date_dim(dates.min(), dates.max()),
+    }
+    tables = {}
+    results = []
+
+    def record(stage, seconds, peak_mb, rows):
+        results.append({"scale": scale, "stage": stage, "rows": rows, "seconds": round(seconds, 4),
+                        "peak_mb": peak_mb, "rss_mb": frame_memory.peak_rss_mb()})
+        print(f"    {stage : <16}{rows : >12}{round(seconds, 4) : >12}{peak_mb : >12}{results[-1]['rss_mb'] : >12}")
+
+    for stage, fn in stages.items():
+        tables[stage], seconds, peak = profile(fn, repeat)
+        record(stage, seconds, peak, len(tables[stage]))
+    tables["fact_covid"], seconds, peak = profile(
+        lambda: transforms.build_fact_covid(daily, tables["dim_region"], tables["dim_hospital"]), repeat)
+    record("fact_covid", seconds, peak, len(tables["fact_covid"]))
+    for output_format in dwh_output.OUTPUT_FORMATS:
+        uploaded, seconds, peak = profile(lambda: upload_tables(client, tables, output_format, parts), repeat)
+        record(f"upload_{output_format}", seconds, peak, uploaded)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Per stage time and memory on synthetic sources")
+    parser.add_argument("--scales", type=int, nargs="+", default=[1, 10, 100])
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--parts", type=int, default=2, help="COPY parts per table, one per slice")
+    parser.add_argument("--json", help="append the results to this JSON lines file")
+    args = parser.parse_args()
+
+    for var in ("AWS_ACCESS_KEY_ID", "AWS_SECRET_ACCESS_KEY"):
+        os.environ.setdefault(var, "testing")
+    with mock_aws():
+        client = boto3.client("s3", region_name="us-east-1")
+        client.create_bucket(Bucket=BUCKET)
+        results = []
+        for scale in args.scales:
+            results += bench_scale(scale, args.repeat, args.parts, client)
+    if args.json:
+        with open(args.json, "a") as f:
+            for result in results:
+                f.write(json.dumps(result) + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,127 @@
+# Synthetic extracts of the source tables, shaped like what the
+# extraction queries return, at a multiple of the current volume
+import numpy as np
+import pandas as pd
+
+# State FIPS codes of the 50 states, DC and the territories
+STATE_CODES = [1, 2, 4, 5, 6, 8, 9, 10, 11, 12, 13, 15, 16, 17, 18, 19, 20, 21, 22, 23, 24, 25, 26, 27, 28,
+               29, 30, 31, 32, 33, 34, 35, 36, 37, 38, 39, 40, 41, 42, 44, 45, 46, 47, 48, 49, 50, 51, 53,
+               54, 55, 56, 60, 66, 69, 72, 78]
+
+# Rows at scale 1, about what the extraction queries return today
+BASE_VOLUME = {
+    "counties": 3200,
+    "hospitals": 6600,
+    "days": 420,
+}
+
+MEASURES = ["positive", "negative", "hospitalized", "hospitalizedcurrently", "hospitalizeddischarged",
+            "hospitalizedcumulative", "death", "recovered"]
+INCREASES = ["deathincrease", "hospitalizedincrease", "positiveincrease"]
+# Column types of the typed extraction, see code_columns and category_columns in covid_aws_de
+CODE_COLUMNS = {"fips", "hq_zip_code"}
+CATEGORY_COLUMNS = {"province_state", "country_region", "state", "state_name",
+                    "county", "county_name", "hospital_type", "hq_state"}
+HOSPITAL_TYPES = ["Short Term Acute Care Hospital", "Critical Access Hospital", "Psychiatric Hospital",
+                  "Long Term Acute Care Hospital", "Rehabilitation Hospital", "Childrens Hospital"]
+
+
+def state_abv(code):
+    return f"S{code:02d}"
+
+
+def county_fips(counties):
+    """County FIPS codes spread evenly over the states, odd county codes like the real ones"""
+    per_state = -(-counties // len(STATE_CODES))
+    codes = [state * 1000 + 2 * i + 1 for state in STATE_CODES for i in range(per_state)]
+    return np.array(codes[:counties])
+
+
+def make_enigma_jhu(fips, scale, rng):
+    """`scale` distinct location rows per county"""
+    fips = np.repeat(fips, scale)
+    return pd.DataFrame({
+        "fips": fips.astype("float64"),
+        "province_state": [f"State {code // 1000}" for code in fips],
+        "country_region": "US",
+        "latitude": rng.uniform(18, 65, len(fips)).round(6),
+        "longitude": rng.uniform(-160, -65, len(fips)).round(6),
+    })
+
+
+def make_nytimes_data_us_county(fips):
+    return pd.DataFrame({"fips": fips.astype("float64"), "county": [f"County {code % 1000}" for code in fips]})
+
+
+def make_rearc_usa_hospital_beds(fips, hospitals, rng):
+    county = rng.choice(fips, hospitals)
+    return pd.DataFrame({
+        "fips": county,
+        "state_name": [f"State {code // 1000}" for code in county],
+        "county_name": [f"County {code % 1000}" for code in county],
+        "latitude": rng.uniform(18, 65, hospitals).round(6),
+        "longtitude": rng.uniform(-160, -65, hospitals).round(6),
+        "hospital_name": [f"Hospital {i}" for i in range(hospitals)],
+        "hq_address": [f"{i % 9000 + 100} Main St" for i in range(hospitals)],
+        "hq_city": [f"City {code % 1000}" for code in county],
+        "hq_state": [state_abv(code // 1000) for code in county],
+        "hq_zip_code": rng.integers(501, 99950, hospitals).astype(str),
+        "hospital_type": rng.choice(HOSPITAL_TYPES, hospitals),
+    })
+
+
+def make_rearc_testing_states_daily(days, rng):
+    """One row per state and day, cumulative measures with some gaps"""
+    dates = pd.date_range("2020-01-13", periods=days)
+    n = days * len(STATE_CODES)
+    df = pd.DataFrame({
+        "fips": np.tile(STATE_CODES, days),
+        "date": np.repeat((dates.year * 10000 + dates.month * 100 + dates.day).to_numpy(), len(STATE_CODES)),
+        "state": np.tile([state_abv(code) for code in STATE_CODES], days),
+    })
+    for col in MEASURES:
+        values = rng.gamma(2.0, 5000.0, n).round()
+        values[rng.random(n) < 0.1] = np.nan
+        df[col] = values
+    for col in INCREASES:
+        df[col] = rng.integers(0, 5000, n)
+    return df
+
+
+def make_d_static_state_abv():
+    """Headerless like the crawled table, the header is the first row"""
+    return pd.DataFrame({"col0": ["State"] + [f"State {code}" for code in STATE_CODES],
+                         "col1": ["Abbreviation"] + [state_abv(code) for code in STATE_CODES]})
+
+
+def as_extracted(df):
+    """Codes as digit strings and repeated text as categoricals, like the extraction loads them"""
+    for col in CODE_COLUMNS.intersection(df.columns):
+        df[col] = pd.to_numeric(df[col]).astype("Int64").astype("string")
+    for col in CATEGORY_COLUMNS.intersection(df.columns):
+        df[col] = df[col].astype("category")
+    return df
+
+
+def make_sources(scale=1, seed=0, typed=True):
+    """Source extracts at `scale` times BASE_VOLUME
+
+    Counties get `scale` location rows each and the states get `scale`
+    times the days, so every transform sees `scale` times the rows.
+
+    :param typed: give the frames the dtypes of the typed extraction,
+        otherwise codes are numbers and text is object
+    :return: dict of table name -> DataFrame
+    """
+    rng = np.random.default_rng(seed)
+    fips = county_fips(BASE_VOLUME["counties"])
+    sources = {
+        "enigma_jhu": make_enigma_jhu(fips, scale, rng),
+        "nytimes_data_us_county": make_nytimes_data_us_county(fips),
+        "rearc_usa_hospital_beds": make_rearc_usa_hospital_beds(fips, BASE_VOLUME["hospitals"] * scale, rng),
+        "rearc_testing_states_daily": make_rearc_testing_states_daily(BASE_VOLUME["days"] * scale, rng),
+        "d_static_state_abv": make_d_static_state_abv(),
+    }
+    if typed:
+        sources = {table: as_extracted(df) for table, df in sources.items()}
+    return sources
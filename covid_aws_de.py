@@ -1,12 +1,31 @@
 # import required packages
 import boto3
+import contextvars
+import gc
+import hashlib
 import pandas as pd
 import requests
 import time
 import json
+import os
 import redshift_connector
-from decouple import config
-from io import StringIO
+import threading
+import athena_ctas
+import dwh_ddl
+import dwh_output
+import dwh_sql
+import frame_memory
+import glue_wheels
+import key_registry
+import local_query
+import pipeline
+import spans
+import transforms
+import view_export
+from boto3.s3.transfer import TransferConfig
+from botocore.exceptions import ClientError
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from decouple import Choices, config
 from inspect import cleandoc
 
 # Set Variables
@@ -23,11 +42,16 @@ S3_BUCKET_NAME = config("S3_BUCKET_NAME")
 S3_STAGING_DIR = config("S3_STAGING_DIR")
 S3_OUTPUT_DIR = config("S3_OUTPUT_DIR")
 S3_SCRIPTS_DIR = config("S3_SCRIPTS_DIR")
+# Prefix the dashboard views are unloaded under
+S3_EXPORT_DIR = config("S3_EXPORT_DIR", default="queries/")
 EXT_PKG_DIR = config("EXT_PKG_DIR")
 # GLUE
 GLUE_IAM_ROLE = config("GLUE_IAM_ROLE")
 GLUE_DB = config("GLUE_DB")
 GLUE_ETL_JOB = config("GLUE_ETL_JOB")
+# Keep the Glue DB and crawlers after the run so reruns crawl incrementally,
+# dropping them makes every run crawl everything again
+GLUE_KEEP_CATALOG = config("GLUE_KEEP_CATALOG", default=True, cast=bool)
 # REDSHIFT
 DWH_CLUSTER_TYPE = config("DWH_CLUSTER_TYPE")
 DWH_NUM_NODES = config("DWH_NUM_NODES")
@@ -38,6 +62,59 @@ DWH_DB_USER = config("DWH_DB_USER")
 DWH_DB_PASSWORD = config("DWH_DB_PASSWORD")
 DWH_PORT = config("DWH_PORT")
 DWH_IAM_ROLE_NAME = config("DWH_IAM_ROLE_NAME")
+# What happens to the cluster after a run: delete it, pause it, or delete it
+# with a final snapshot that the next run restores from
+DWH_LIFECYCLE = config("DWH_LIFECYCLE", default="delete", cast=Choices(["delete", "pause", "snapshot"]))
+# data_api runs the load from here, glue ships it to a python shell job
+LOAD_METHOD = config("LOAD_METHOD", default="data_api", cast=Choices(["data_api", "glue"]))
+DWH_SNAPSHOT_PREFIX = config("DWH_SNAPSHOT_PREFIX", default=f"{DWH_CLUSTER_IDENTIFIER}-final")
+# INGEST
+INGEST_MAX_WORKERS = config("INGEST_MAX_WORKERS", default=9, cast=int)
+INGEST_CHUNK_SIZE_MB = config("INGEST_CHUNK_SIZE_MB", default=16, cast=int)
+INGEST_PART_CONCURRENCY = config("INGEST_PART_CONCURRENCY", default=2, cast=int)
+INGEST_MANIFEST_KEY = config("INGEST_MANIFEST_KEY", default="ingest_manifest.json")
+# OUTPUT
+OUTPUT_FORMAT = config("OUTPUT_FORMAT", default="parquet", cast=Choices(dwh_output.OUTPUT_FORMATS))
+COPY_COMPRESSION = config("COPY_COMPRESSION", default="gzip", cast=Choices(dwh_output.CSV_COMPRESSIONS))
+# 0 splits each table into one file per cluster slice
+COPY_SPLIT_PARTS = config("COPY_SPLIT_PARTS", default=0, cast=int)
+# Format the views are unloaded in, and whether every slice writes its own parts
+EXPORT_FORMAT = config("EXPORT_FORMAT", default="parquet", cast=Choices(view_export.EXPORT_FORMATS))
+EXPORT_PARALLEL = config("EXPORT_PARALLEL", default=True, cast=bool)
+EXPORT_DOWNLOAD_WORKERS = config("EXPORT_DOWNLOAD_WORKERS", default=8, cast=int)
+# full reloads fact_covid, incremental merges rows after the loaded watermark
+FACT_LOAD_MODE = config("FACT_LOAD_MODE", default="full", cast=Choices(["full", "incremental"]))
+# Days before the watermark that are reloaded to pick up restated values
+FACT_RESTATEMENT_DAYS = config("FACT_RESTATEMENT_DAYS", default=7, cast=int)
+# Downcast the source frames and free them as soon as the transforms are done
+COMPACT_MEMORY = config("COMPACT_MEMORY", default=True, cast=bool)
+# S3 prefix of the natural key -> surrogate key registries, empty numbers the dimension rows every run
+KEY_REGISTRY_DIR = config("KEY_REGISTRY_DIR", default="registry/")
+# dim_date is generated this many days past the later of today and the last source date
+DIM_DATE_HORIZON_DAYS = config("DIM_DATE_HORIZON_DAYS", default=365, cast=int)
+# pandas extracts the sources and transforms locally, athena builds the tables with CTAS queries
+TRANSFORM_ENGINE = config("TRANSFORM_ENGINE", default="pandas", cast=Choices(["pandas", "athena"]))
+# Where the pandas engine reads its sources, duckdb queries local copies of the data lake files
+QUERY_BACKEND = config("QUERY_BACKEND", default="athena", cast=Choices(["athena", "duckdb"]))
+LOCAL_CACHE_DIR = config("LOCAL_CACHE_DIR", default="data/")
+# Run the transform stage without AWS. The warehouse watermarks and the key
+# registries are not read, the tables are written under LOCAL_CACHE_DIR
+TRANSFORM_OFFLINE = config("TRANSFORM_OFFLINE", default=False, cast=bool)
+if TRANSFORM_OFFLINE and (TRANSFORM_ENGINE != "pandas" or QUERY_BACKEND != "duckdb"):
+    raise ValueError("TRANSFORM_OFFLINE needs TRANSFORM_ENGINE=pandas and QUERY_BACKEND=duckdb")
+# CTAS numbers the dimension rows on every run, so its surrogate keys
+# cannot follow the registries the pandas engine keeps them stable with
+if TRANSFORM_ENGINE == "athena" and KEY_REGISTRY_DIR:
+    raise ValueError("TRANSFORM_ENGINE=athena does not use the key registries, its region_sk and hosp_sk "
+                     "would not match the loaded fact_covid rows. Set KEY_REGISTRY_DIR= to run it without them")
+# PIPELINE
+# Finished stages are recorded here, a rerun after a failure resumes from it
+PIPELINE_CHECKPOINT = config("PIPELINE_CHECKPOINT", default=".pipeline_checkpoint.json")
+PIPELINE_RESUME = config("PIPELINE_RESUME", default=True, cast=bool)
+PIPELINE_MAX_WORKERS = config("PIPELINE_MAX_WORKERS", default=4, cast=int)
+# Every run's spans are written here as <run id>.jsonl, with the
+# totals per span in a Prometheus textfile, empty keeps them in memory
+METRICS_DIR = config("METRICS_DIR", default="metrics/")
 
 bsession = boto3.Session(
     aws_access_key_id=AWS_ACCESS_KEY_ID,
@@ -52,6 +129,7 @@ ec2_resource = bsession.resource("ec2")
 glue_client = bsession.client("glue")
 iam_client = bsession.client("iam")
 redshift_client = bsession.client("redshift")
+redshift_data_client = bsession.client("redshift-data")
 s3_client = bsession.client("s3")
 s3_resource = bsession.resource("s3")
 
@@ -75,70 +153,209 @@ def create_role_trust_policy(service):
     return trust_policy
 
 
-# Glue
-try:
-    print("Creating Glue IAM Role...")
-    iam_response = iam_client.create_role(RoleName=GLUE_IAM_ROLE,
-                                          AssumeRolePolicyDocument=json.dumps(create_role_trust_policy(service="glue")))
-    # Attach Policy
-    print(f"Attaching Policies to {GLUE_IAM_ROLE}...")
-    iam_client.attach_role_policy(RoleName=GLUE_IAM_ROLE,
-                                  PolicyArn="arn:aws:iam::aws:policy/AmazonS3FullAccess")
-    iam_client.attach_role_policy(RoleName=GLUE_IAM_ROLE,
-                                  PolicyArn="arn:aws:iam::aws:policy/service-role/AWSGlueServiceRole")
-    iam_client.attach_role_policy(RoleName=GLUE_IAM_ROLE,
-                                  PolicyArn="arn:aws:iam::aws:policy/AWSGlueConsoleFullAccess")
-    # Get and print the IAM role ARN
-    print(f"Getting {GLUE_IAM_ROLE} IAM role ARN...")
-    glue_roleArn = iam_client.get_role(RoleName=GLUE_IAM_ROLE)['Role']['Arn']
-    print(f"{GLUE_IAM_ROLE} IAM Role ARN = {glue_roleArn}")
-except Exception as e:
-    print(e)
-
-# Redshift
-try:
-    print("Creating Redshift IAM Role...")
-    iam_response = iam_client.create_role(RoleName=DWH_IAM_ROLE_NAME,
-                                          AssumeRolePolicyDocument=json.dumps(
-                                              create_role_trust_policy(service="redshift")
-                                          )
-                                          )
-    # Attach Policy
-    print(f"Attaching Policies to {DWH_IAM_ROLE_NAME}...")
-    iam_client.attach_role_policy(RoleName=DWH_IAM_ROLE_NAME,
-                                  PolicyArn="arn:aws:iam::aws:policy/AmazonS3FullAccess")
+def create_iam_role(role_name, service, policy_arns):
+    """Create a service role with its policies, an existing role is reused
+
+    :return: role ARN
+    """
+    try:
+        print(f"Creating {role_name} IAM Role...")
+        iam_client.create_role(RoleName=role_name,
+                               AssumeRolePolicyDocument=json.dumps(create_role_trust_policy(service=service)))
+        # Attach Policy
+        print(f"Attaching Policies to {role_name}...")
+        for policy_arn in policy_arns:
+            iam_client.attach_role_policy(RoleName=role_name, PolicyArn=policy_arn)
+    except iam_client.exceptions.EntityAlreadyExistsException:
+        print(f"Role {role_name} already exists\t SKIPPING.")
     # Get and print the IAM role ARN
-    print(f"Getting {DWH_IAM_ROLE_NAME} IAM role ARN...")
-    redshift_roleArn = iam_client.get_role(RoleName=DWH_IAM_ROLE_NAME)['Role']['Arn']
-    print(f"{DWH_IAM_ROLE_NAME} IAM Role ARN = {redshift_roleArn}")
-except Exception as e:
-    print(e)
+    print(f"Getting {role_name} IAM role ARN...")
+    role_arn = iam_client.get_role(RoleName=role_name)['Role']['Arn']
+    print(f"{role_name} IAM Role ARN = {role_arn}")
+    return role_arn
+
+
+def create_iam_roles(state):
+    return {
+        "glue_role_arn": create_iam_role(GLUE_IAM_ROLE, "glue", [
+            "arn:aws:iam::aws:policy/AmazonS3FullAccess",
+            "arn:aws:iam::aws:policy/service-role/AWSGlueServiceRole",
+            "arn:aws:iam::aws:policy/AWSGlueConsoleFullAccess",
+        ]),
+        "redshift_role_arn": create_iam_role(DWH_IAM_ROLE_NAME, "redshift", [
+            "arn:aws:iam::aws:policy/AmazonS3FullAccess",
+        ]),
+    }
+
+
+# Transfer settings for streamed uploads. A streamed body cannot be
+# seeked, so s3transfer keeps every part it has read in memory until
+# it is sent, by default up to 10 parts on top of the ones in flight.
+# Capping that at the part concurrency holds each file to about
+# part_concurrency * chunk_size bytes
+ingest_transfer_config = TransferConfig(
+    multipart_threshold=INGEST_CHUNK_SIZE_MB * 1024 ** 2,
+    multipart_chunksize=INGEST_CHUNK_SIZE_MB * 1024 ** 2,
+    max_concurrency=INGEST_PART_CONCURRENCY,
+)
+# s3transfer setting that boto3's constructor does not take
+ingest_transfer_config.max_in_memory_upload_chunks = INGEST_PART_CONCURRENCY
+
+
+def split_s3_url(url):
+    bucket, key = url.replace("s3://", "").split("/", 1)
+    return bucket, key
+
+
+def key_exists(bucket, key):
+    try:
+        s3_client.head_object(Bucket=bucket, Key=key)
+        return True
+    except ClientError as e:
+        if e.response["Error"]["Code"] in ("404", "NoSuchKey", "NotFound"):
+            return False
+        raise
+
+
+class BucketKeyIndex:
+    """Key existence checks for a bucket without listing it on every call
+
+    Prefixes are listed once into a set that is kept up to date with
+    our own writes. Keys outside the loaded prefixes are checked with
+    a HEAD request, so the cost does not grow with the bucket.
+    """
+
+    def __init__(self, client, bucket):
+        self.client = client
+        self.bucket = bucket
+        self.keys = set()
+        self.prefixes = set()
+        self.lock = threading.Lock()
+
+    def load(self, prefix):
+        with spans.span("index_prefix", prefix=prefix) as s:
+            paginator = self.client.get_paginator("list_objects_v2")
+            keys = {obj["Key"] for page in paginator.paginate(Bucket=self.bucket, Prefix=prefix)
+                    for obj in page.get("Contents", [])}
+            with self.lock:
+                self.keys |= keys
+                self.prefixes.add(prefix)
+            s.add(rows_out=len(keys))
+            s.done = f"Indexed {len(keys)} keys under {self.bucket}/{prefix}."
+
+    def exists(self, key):
+        with self.lock:
+            if key in self.keys:
+                return True
+            if any(key.startswith(prefix) for prefix in self.prefixes):
+                return False
+        if key_exists(self.bucket, key):
+            self.add(key)
+            return True
+        return False
+
+    def add(self, key):
+        with self.lock:
+            self.keys.add(key)
+
+
+bucket_indexes = {}
+
+
+def get_bucket_index(bucket):
+    if bucket not in bucket_indexes:
+        bucket_indexes[bucket] = BucketKeyIndex(s3_client, bucket)
+    return bucket_indexes[bucket]
+
+
+class HashingReader:
+    """File-like wrapper that hashes and counts bytes as they are read"""
+
+    def __init__(self, raw):
+        self.raw = raw
+        self.sha256 = hashlib.sha256()
+        self.size = 0
+
+    def read(self, amt=-1):
+        chunk = self.raw.read(amt)
+        self.sha256.update(chunk)
+        self.size += len(chunk)
+        return chunk
+
+
+def source_unchanged(previous, headers):
+    """Compare response headers with the manifest entry of the last ingest"""
+    if previous.get("etag") and headers.get("ETag"):
+        return previous["etag"] == headers["ETag"]
+    return (previous.get("last_modified") == headers.get("Last-Modified")
+            and previous.get("size") == int(headers.get("Content-Length", -1)))
 
 
 # Function to get dowload file from URL
 # and upload to s3 bucket
-def url_download_upload(bucket, output_dir, file, url):
-    # Uses the creds in ~/.aws/credentials
-    s3 = bsession.resource('s3')
+def url_download_upload(bucket, output_dir, file, url, previous=None):
+    """Stream a file from a URL into an S3 multipart upload
+
+    The HTTP body is never held in memory as a whole, it is read in
+    INGEST_CHUNK_SIZE_MB parts and each part is sent as it fills.
+    With a previous manifest entry the request is conditional and the
+    upload is skipped when the source has not changed.
+
+    :param bucket: Bucket to upload to
+    :param output_dir: S3 prefix the file is written under
+    :param file: S3 object name
+    :param url: Source URL
+    :param previous: Ingest manifest entry from the last run
+    :return: dict with the source validators, bytes transferred,
+        seconds, MB/s and whether it changed
+    :raises: the download or upload error, the manifest entry is not updated
+    """
+    index = get_bucket_index(bucket)
     # Do this as a quick and easy check to make sure your S3 access is OK
-    if output_dir in [obj.key for obj in s3.Bucket(bucket).objects.all()]:
+    if index.exists(output_dir):
         print('Found the upload directory.')
-        # Given an Internet-accessible URL, download the image and upload it to S3,
-        # without needing to persist the image to disk locally
+        # Given an Internet-accessible URL, stream the body into S3
+        # without needing to persist the file to disk or memory
 
         # Do the actual upload to s3
         try:
-            t0 = time.time()
-            with requests.get(url, stream=True) as r:
-                print(f"uploading {file} to {output_dir} in {bucket}...")
-                s3.Object(bucket, f"{output_dir}{file}").put(Body=r.content)
-            t1 = time.time()
-            texec = f"[{round(t1 - t0, 2)}s]"
-            print(f"{bucket}/{output_dir}{file} upload SUCCESSFUL.  {texec : >30}]s")
+            nbytes = []
+            with spans.span("ingest_file", file=file) as s:
+                key = f"{output_dir}{file}"
+                headers = {}
+                # Only trust the validators while our copy is still in the bucket
+                if previous and index.exists(key):
+                    if previous.get("etag"):
+                        headers["If-None-Match"] = previous["etag"]
+                    if previous.get("last_modified"):
+                        headers["If-Modified-Since"] = previous["last_modified"]
+                with requests.get(url, stream=True, headers=headers) as r:
+                    if r.status_code == 304 or (headers and source_unchanged(previous, r.headers)):
+                        print(f"{file} unchanged upstream\t SKIPPING.")
+                        return {**previous, "file": file, "changed": False,
+                                "bytes": 0, "seconds": round(s.elapsed(), 2), "mb_per_s": 0}
+                    r.raise_for_status()
+                    print(f"uploading {file} to {output_dir} in {bucket}...")
+                    body = HashingReader(r.raw)
+                    s3_client.upload_fileobj(body, bucket, key,
+                                             Config=ingest_transfer_config,
+                                             Callback=nbytes.append)
+                index.add(key)
+                seconds = s.elapsed()
+                s.add(bytes=sum(nbytes))
+                stats = {"file": file, "url": url, "key": key, "changed": True,
+                         "etag": r.headers.get("ETag"), "last_modified": r.headers.get("Last-Modified"),
+                         "size": body.size, "sha256": body.sha256.hexdigest(),
+                         "bytes": sum(nbytes), "seconds": round(seconds, 2),
+                         "mb_per_s": round(sum(nbytes) / 1024 ** 2 / max(seconds, 1e-6), 2)}
+                s.done = f"{bucket}/{output_dir}{file} upload SUCCESSFUL. {stats['mb_per_s']}MB/s."
+            return stats
         except Exception as e:
-            print(e)
+            # A failed source must not look unchanged to the stages after ingest
+            print(f"{file} upload FAILED: {e}")
+            raise
     else:
-        print('Not seeing your s3 bucket, might want to double check permissions in IAM')
+        raise RuntimeError(f"{bucket}/{output_dir} not found, might want to double check permissions in IAM")
 
 
 def upload_local_file(file, bucket, output_dir):
@@ -149,49 +366,36 @@ def upload_local_file(file, bucket, output_dir):
     :param object_name: S3 object name. If not specified then file_name is used
     :return: True if file was uploaded, else False
     """
-    s3 = bsession.resource('s3')
+    index = get_bucket_index(bucket)
     # Do this as a quick and easy check to make sure your S3 access is OK
-    if output_dir in [obj.key for obj in s3.Bucket(bucket).objects.all()]:
+    if index.exists(output_dir):
         print('Found the upload directory.')
 
         # Upload the file
         try:
-            t0 = time.time()
             print(f"uploading _url {file} to {output_dir} in {bucket}...")
-            s3.Object(bucket, f"{output_dir}{file}").upload_file(file)
-            t1 = time.time()
-            texec = f"[{round(t1 - t0, 2)}s]"
-            print(f"{bucket}/{output_dir}{file} upload SUCCESSFUL.  {texec : >30}")
+            with spans.span("upload_file", f"{bucket}/{output_dir}{file} upload SUCCESSFUL.", file=file) as s:
+                s3_client.upload_file(file, bucket, f"{output_dir}{file}")
+                index.add(f"{output_dir}{file}")
+                s.add(bytes=os.path.getsize(file))
         except Exception as e:
             print(e)
     else:
         print('Not seeing your s3 bucket, might want to double check permissions in IAM')
 
 
-def download_to_local(bucket, s3path, lpath):
-    t0 = time.time()
-    s3_client.download_file(
-        bucket,
-        f"{s3path}",
-        lpath,
-    )
-    t1 = time.time()
-    texec = f"[{round(t1-t0, 2)}s]"
-    print(f"{bucket}/{s3path} downloaded. {texec : >30}")
+def load_ingest_manifest(bucket, key):
+    """Read the ingest manifest left by the last run, empty on the first run"""
+    try:
+        return json.loads(s3_client.get_object(Bucket=bucket, Key=key)["Body"].read())
+    except s3_client.exceptions.NoSuchKey:
+        return {"sources": {}, "athena_results": {}}
 
 
-# Create Project Bucket and Folder Structure
-# Create Bucket
-s3_client.create_bucket(
-    Bucket=S3_BUCKET_NAME,
-    CreateBucketConfiguration={"LocationConstraint": AWS_REGION_NAME},
-    PublicAccessBlockConfiguration={
-        'BlockPublicAcls': True,
-        'IgnorePublicAcls': True,
-        'BlockPublicPolicy': True,
-        'RestrictPublicBuckets': True
-    },
-)
+def save_ingest_manifest(bucket, key, manifest):
+    s3_client.put_object(Bucket=bucket, Key=key, Body=json.dumps(manifest, indent=2),
+                         ContentType="application/json")
+
 
 # Create Folders
 folder_list = [
@@ -200,18 +404,42 @@ folder_list = [
     'staging/', 'static-datasets/', 'enigma-nytimes-data-in-usa/us_county/',
     'enigma-nytimes-data-in-usa/us_states/', 'rearc-covid-19-testing-data/us_daily/',
     'rearc-covid-19-testing-data/states_daily/', 'static-datasets/countrycode/',
-    'static-datasets/CountyPopulation/', 'static-datasets/state-abv/'
+    'static-datasets/CountyPopulation/', 'static-datasets/state-abv/', S3_SCRIPTS_DIR
 ]
-for folder in folder_list:
-    if folder not in [obj.key for obj in s3_resource.Bucket(S3_BUCKET_NAME).objects.all()]:
-        print(f"Creating directory {folder} in bucket {S3_BUCKET_NAME}...")
-        t0 = time.time()
-        s3_client.put_object(Bucket=S3_BUCKET_NAME, Key=folder)
-        t1 = time.time()
-        texec = f"[{round(t1-t0, 2)}s]"
-        print(f"{folder} CREATED.  {time : >30}")
-    else:
-        print(f"Directory {folder} already exists\t SKIPPING.")
+
+
+# Create Project Bucket and Folder Structure
+def create_bucket_folders(state):
+    # Create Bucket
+    try:
+        s3_client.create_bucket(
+            Bucket=S3_BUCKET_NAME,
+            CreateBucketConfiguration={"LocationConstraint": AWS_REGION_NAME},
+            PublicAccessBlockConfiguration={
+                'BlockPublicAcls': True,
+                'IgnorePublicAcls': True,
+                'BlockPublicPolicy': True,
+                'RestrictPublicBuckets': True
+            },
+        )
+    except s3_client.exceptions.BucketAlreadyOwnedByYou:
+        print(f"Bucket {S3_BUCKET_NAME} already exists\t SKIPPING.")
+
+    # Only the data lake folders are listed up front, query output
+    # prefixes like staging/ keep growing and are probed per key
+    bucket_index = get_bucket_index(S3_BUCKET_NAME)
+    for prefix in ['enigma-jhu/', 'enigma-nytimes-data-in-usa/', 'rearc-covid-19-testing-data/',
+                   'rearc-usa-hospital-beds/', 'static-datasets/', EXT_PKG_DIR, S3_SCRIPTS_DIR]:
+        bucket_index.load(prefix)
+    for folder in folder_list:
+        if not bucket_index.exists(folder):
+            print(f"Creating directory {folder} in bucket {S3_BUCKET_NAME}...")
+            with spans.span("create_folder", f"{folder} CREATED.", folder=folder):
+                s3_client.put_object(Bucket=S3_BUCKET_NAME, Key=folder)
+                bucket_index.add(folder)
+        else:
+            print(f"Directory {folder} already exists\t SKIPPING.")
+
 
 # Download files from Data Lake
 dl_file_list = [
@@ -225,24 +453,85 @@ dl_file_list = [
     "https://covid19-lake.s3.us-east-2.amazonaws.com/static-datasets/csv/CountyPopulation/County_Population.csv",
     "https://covid19-lake.s3.us-east-2.amazonaws.com/static-datasets/csv/state-abv/states_abv.csv"
 ]
-for file_url in dl_file_list:
-    if len(file_url.split("/")) > 6:
-        upload_loc = f"{file_url.split('/')[3]}/{file_url.split('/')[-2]}/"
-    else:
-        upload_loc = f"{file_url.split('/')[3]}/"
-    filename = file_url.split("/")[-1]
-    url_download_upload(S3_BUCKET_NAME, upload_loc, filename, file_url)
 
 
-# Create Glue DB
-dbName = GLUE_DB
-glue_client.create_database(DatabaseInput={'Name': dbName})
+def get_upload_loc(file_url):
+    if len(file_url.split("/")) > 6:
+        return f"{file_url.split('/')[3]}/{file_url.split('/')[-2]}/"
+    return f"{file_url.split('/')[3]}/"
+
+
+# Downstream crawler and Athena table fed by each source file
+source_targets = {
+    "Enigma-JHU.csv.gz": ("enigma_jhu_crawl", "enigma_jhu"),
+    "us_county.csv": ("enigma_nytimes_crawl", "nytimes_data_us_county"),
+    "us_states.csv": ("enigma_nytimes_crawl", "nytimes_data_us_states"),
+    "states_daily.csv": ("rearc_testing_crawl", "rearc_testing_states_daily"),
+    "us_daily.csv": (None, None),
+    "usa-hospital-beds.geojson": ("rearc_beds_crawl", "rearc_usa_hospital_beds"),
+    "CountryCodeQS.csv": ("static_data_crawl", "d_static_countrycode"),
+    "County_Population.csv": ("static_data_crawl", "d_static_countypopulation"),
+    "states_abv.csv": ("static_data_crawl", "d_static_state_abv"),
+}
+
+
+def ingest_sources(state):
+    ingest_manifest = load_ingest_manifest(S3_BUCKET_NAME, INGEST_MANIFEST_KEY)
+
+    # Stream every source at once so the stage takes about as
+    # long as the slowest file instead of the sum of all files
+    ingest_stats = []
+    with spans.span("ingest_files") as s:
+        with ThreadPoolExecutor(max_workers=INGEST_MAX_WORKERS) as pool:
+            # Each upload runs in a copy of this context so its span nests under this one
+            futures = {pool.submit(contextvars.copy_context().run, url_download_upload, S3_BUCKET_NAME,
+                                   get_upload_loc(file_url), file_url.split("/")[-1], file_url,
+                                   ingest_manifest["sources"].get(file_url.split("/")[-1])): file_url.split("/")[-1]
+                       for file_url in dl_file_list}
+            failed = {}
+            for future in as_completed(futures):
+                try:
+                    ingest_stats.append(future.result())
+                except Exception as e:
+                    failed[futures[future]] = e
+        s.add(bytes=sum(st['bytes'] for st in ingest_stats))
+        s.done = (f"Data lake ingest COMPLETE. "
+                  f"{round(sum(st['bytes'] for st in ingest_stats) / 1024 ** 2, 2)}MB in {len(ingest_stats)} files.")
+    for st in sorted(ingest_stats, key=lambda st: st['seconds'], reverse=True):
+        print(f"    {st['file'] : <30} {st['bytes'] : >12} bytes  {st['seconds'] : >8}s  {st['mb_per_s'] : >8}MB/s"
+              f"  {'changed' if st['changed'] else 'unchanged'}")
+
+    manifest_fields = ["url", "key", "etag", "last_modified", "size", "sha256"]
+    for st in ingest_stats:
+        ingest_manifest["sources"][st["file"]] = {k: st.get(k) for k in manifest_fields}
+    save_ingest_manifest(S3_BUCKET_NAME, INGEST_MANIFEST_KEY, ingest_manifest)
+    # The sources that did upload are recorded above, the stage still fails
+    # so crawl and transform never run on a partly stale data lake
+    if failed:
+        raise RuntimeError(f"Data lake ingest FAILED for {sorted(failed)}: "
+                           f"{'; '.join(f'{file}: {e}' for file, e in sorted(failed.items()))}")
+
+    changed_files = {st["file"] for st in ingest_stats if st["changed"]}
+    changed_crawlers = {source_targets[file][0] for file in changed_files} - {None}
+    changed_tables = {source_targets[file][1] for file in changed_files} - {None}
+    print(f"Changed sources: {sorted(changed_files) or 'none'}")
+    return {"changed_files": sorted(changed_files), "changed_crawlers": sorted(changed_crawlers),
+            "changed_tables": sorted(changed_tables)}
+
 
 # Function to create crawlers without having
 # to repeat the code
 
 
 def my_s3_create_crawler(client, name, role, source, db, prefix='', description=''):
+    """Create a crawler, or switch an existing one to incremental crawls
+
+    The first crawl of a crawler has to crawl everything. On reruns the
+    crawler is updated to CRAWL_NEW_FOLDERS_ONLY so unchanged prefixes
+    are not crawled again.
+
+    :return: crawler name
+    """
     try:
         if type(source) is list:
             source = [{'Path': path, 'Exclusions': []} for path in source]
@@ -252,70 +541,155 @@ def my_s3_create_crawler(client, name, role, source, db, prefix='', description=
     except Exception as e:
         print(e)
 
-    client.create_crawler(
+    try:
+        client.get_crawler(Name=name)
+    except client.exceptions.EntityNotFoundException:
+        client.create_crawler(
+            Name=name,
+            Role=role,
+            Targets=targets,
+            DatabaseName=db,
+            Description=description,
+            Classifiers=[],
+            RecrawlPolicy={'RecrawlBehavior': 'CRAWL_EVERYTHING'},
+            SchemaChangePolicy={'UpdateBehavior': 'UPDATE_IN_DATABASE',
+                                'DeleteBehavior': 'DEPRECATE_IN_DATABASE'},
+            LineageConfiguration={'CrawlerLineageSettings': 'DISABLE'},
+            TablePrefix=prefix,
+            LakeFormationConfiguration={'UseLakeFormationCredentials': False,
+                                        'AccountId': ''}
+        )
+        return name
+
+    print(f"Crawler {name} already exists, switching to incremental crawls...")
+    # Incremental crawls require schema changes to be logged only
+    client.update_crawler(
         Name=name,
-        Role=role,
         Targets=targets,
-        DatabaseName=db,
-        Description=description,
-        Classifiers=[],
-        RecrawlPolicy={'RecrawlBehavior': 'CRAWL_EVERYTHING'},
-        SchemaChangePolicy={'UpdateBehavior': 'UPDATE_IN_DATABASE',
-                            'DeleteBehavior': 'DEPRECATE_IN_DATABASE'},
-        LineageConfiguration={'CrawlerLineageSettings': 'DISABLE'},
-        TablePrefix=prefix,
-        LakeFormationConfiguration={'UseLakeFormationCredentials': False,
-                                    'AccountId': ''}
+        RecrawlPolicy={'RecrawlBehavior': 'CRAWL_NEW_FOLDERS_ONLY'},
+        SchemaChangePolicy={'UpdateBehavior': 'LOG',
+                            'DeleteBehavior': 'LOG'},
     )
+    return name
 
 
-# Create Glue Crawlers
-my_s3_create_crawler(glue_client, 'enigma_jhu_crawl', GLUE_IAM_ROLE,
-                     f"s3://{S3_BUCKET_NAME}/enigma-jhu",
-                     'covid19_db', prefix='', description='enigma-jhu directory')
-my_s3_create_crawler(glue_client, 'enigma_nytimes_crawl', GLUE_IAM_ROLE,
-                     [f"s3://{S3_BUCKET_NAME}/enigma-nytimes-data-in-usa/us_county",
-                      f"s3://{S3_BUCKET_NAME}/enigma-nytimes-data-in-usa/us_states"],
-                     'covid19_db', prefix='nytimes_data_', description='nytimes data')
-my_s3_create_crawler(glue_client, 'rearc_beds_crawl', GLUE_IAM_ROLE,
-                     f"s3://{S3_BUCKET_NAME}/rearc-usa-hospital-beds",
-                     'covid19_db', prefix='', description='hospital beds data')
-my_s3_create_crawler(glue_client, 'rearc_testing_crawl', GLUE_IAM_ROLE,
-                     f"s3://{S3_BUCKET_NAME}/rearc-covid-19-testing-data/states_daily",
-                     'covid19_db', prefix='rearc_testing_', description='rearc testing data')
-my_s3_create_crawler(glue_client, 'static_data_crawl', GLUE_IAM_ROLE,
-                     [f"s3://{S3_BUCKET_NAME}/static-datasets/CountyPopulation",
-                      f"s3://{S3_BUCKET_NAME}/static-datasets/countrycode",
-                      f"s3://{S3_BUCKET_NAME}/static-datasets/state-abv"],
-                     'covid19_db', prefix='d_static_', description='static lookup data')
-
-
-crawlers = glue_client.list_crawlers()['CrawlerNames']
-
-# Run Crawlers
-t0 = time.time()
-for crawler in crawlers:
-    glue_client.start_crawler(Name=f"{crawler}")
-    t1 = time.time()
-    print(f"Running {crawler}...")
-    exit_v = 0
-    while not (exit_v):
-        response = glue_client.get_crawler(Name=f"{crawler}")
-        if response['Crawler']['State'] == 'STOPPING':
-            t2 = time.time()
-            texec = f"[{round(t2-t1, 2)}]s"
-            print(f"{response['Crawler']['Name']} COMPLETE"
-                  f"crawler is currently {response['Crawler']['State']}. {texec : >30}")
-            print("Waiting for crawler to stop...")
-            time.sleep(60)
-            exit_v = 1
-t3 = time.time()
-texec = f"[{round(t3-t0, 2)}min]"
-print(f"All crawlers COMPLETE. DB tables creates.  {texec : >30}")
-
-# Get List of tables in database
-db_tables = [table['Name'] for table in glue_client.get_tables(
-    DatabaseName=GLUE_DB, NextToken='', MaxResults=11)['TableList']]
+def last_crawl_start(crawler):
+    """Start time of the last finished crawl, None for a crawler that never ran"""
+    return crawler.get('LastCrawl', {}).get('StartTime')
+
+
+def run_crawlers(client, names, base_delay=5.0, max_delay=60.0):
+    """Start every crawler at once and wait until each finished a new crawl
+
+    A crawler can still report READY right after it is started, so it
+    only counts as done once it is READY with a last crawl newer than
+    the one it had before. That also covers a crawler that was already
+    running, and avoids comparing Glue's clock with ours.
+
+    :param client: Glue client
+    :param names: crawler names
+    :param base_delay: first wait between status checks in seconds
+    :param max_delay: cap for the exponential backoff in seconds
+    :return: crawler name -> last crawl status
+    """
+    with spans.span("wait_for_crawlers", crawlers=len(names)) as s:
+        previous = {}
+        for name in names:
+            previous[name] = last_crawl_start(client.get_crawler(Name=name)['Crawler'])
+            try:
+                client.start_crawler(Name=name)
+                print(f"Running {name}...")
+            except client.exceptions.CrawlerRunningException:
+                print(f"{name} is already running, waiting for it...")
+        pending = set(names)
+        statuses = {}
+        delay = base_delay
+        while pending:
+            time.sleep(delay)
+            delay = min(delay * 2, max_delay)
+            for name in sorted(pending):
+                crawler = client.get_crawler(Name=name)['Crawler']
+                start = last_crawl_start(crawler)
+                if crawler['State'] != 'READY' or start is None:
+                    continue
+                if previous[name] is None or start > previous[name]:
+                    pending.discard(name)
+                    statuses[name] = crawler['LastCrawl'].get('Status')
+                    print(f"{name} COMPLETE with status {statuses[name]}. {s.texec() : >30}")
+    return statuses
+
+
+def crawl_sources(state):
+    # Create Glue DB
+    dbName = GLUE_DB
+    try:
+        glue_client.create_database(DatabaseInput={'Name': dbName})
+    except glue_client.exceptions.AlreadyExistsException:
+        print(f"Glue DB {dbName} already exists\t SKIPPING.")
+
+    # Create Glue Crawlers
+    crawlers = [
+        my_s3_create_crawler(glue_client, 'enigma_jhu_crawl', GLUE_IAM_ROLE,
+                             f"s3://{S3_BUCKET_NAME}/enigma-jhu",
+                             'covid19_db', prefix='', description='enigma-jhu directory'),
+        my_s3_create_crawler(glue_client, 'enigma_nytimes_crawl', GLUE_IAM_ROLE,
+                             [f"s3://{S3_BUCKET_NAME}/enigma-nytimes-data-in-usa/us_county",
+                              f"s3://{S3_BUCKET_NAME}/enigma-nytimes-data-in-usa/us_states"],
+                             'covid19_db', prefix='nytimes_data_', description='nytimes data'),
+        my_s3_create_crawler(glue_client, 'rearc_beds_crawl', GLUE_IAM_ROLE,
+                             f"s3://{S3_BUCKET_NAME}/rearc-usa-hospital-beds",
+                             'covid19_db', prefix='', description='hospital beds data'),
+        my_s3_create_crawler(glue_client, 'rearc_testing_crawl', GLUE_IAM_ROLE,
+                             f"s3://{S3_BUCKET_NAME}/rearc-covid-19-testing-data/states_daily",
+                             'covid19_db', prefix='rearc_testing_', description='rearc testing data'),
+        my_s3_create_crawler(glue_client, 'static_data_crawl', GLUE_IAM_ROLE,
+                             [f"s3://{S3_BUCKET_NAME}/static-datasets/CountyPopulation",
+                              f"s3://{S3_BUCKET_NAME}/static-datasets/countrycode",
+                              f"s3://{S3_BUCKET_NAME}/static-datasets/state-abv"],
+                             'covid19_db', prefix='d_static_', description='static lookup data'),
+    ]
+
+    # Run Crawlers, crawlers over unchanged sources that have
+    # already crawled once are skipped
+    crawlers_to_run = [crawler for crawler in crawlers if crawler in state["changed_crawlers"]
+                       or 'LastCrawl' not in glue_client.get_crawler(Name=crawler)['Crawler']]
+    # The local backend does not read the Glue catalog
+    if QUERY_BACKEND == "duckdb" and TRANSFORM_ENGINE == "pandas":
+        crawlers_to_run = []
+    for crawler in sorted(set(crawlers) - set(crawlers_to_run)):
+        print(f"{crawler} sources unchanged\t SKIPPING.")
+    with spans.span("crawlers", "All crawlers COMPLETE. DB tables created."):
+        crawl_statuses = run_crawlers(glue_client, crawlers_to_run)
+    return {"crawlers": crawlers, "crawl_statuses": crawl_statuses}
+
+
+# Glue catalog types -> pandas dtypes used when parsing Athena results
+glue_dtype_map = {
+    "string": "string", "varchar": "string", "char": "string",
+    "bigint": "Int64", "int": "Int64", "smallint": "Int64", "tinyint": "Int64",
+    "double": "float64", "float": "float32", "boolean": "boolean",
+}
+# Codes are kept as text so leading zeros never need repairing
+code_columns = {"fips", "hq_zip_code"}
+# Repeated text values are stored once per category
+category_columns = {"province_state", "country_region", "state", "state_name",
+                    "county", "county_name", "hospital_type", "hq_state"}
+
+
+def glue_table_dtypes(table):
+    """Build a read_csv dtype map from a Glue catalog table definition"""
+    columns = table["StorageDescriptor"]["Columns"] + table.get("PartitionKeys", [])
+    dtypes = {}
+    for column in columns:
+        name, glue_type = column["Name"], column["Type"].split("(")[0].lower()
+        if name in code_columns:
+            dtypes[name] = "string"
+        elif name in category_columns:
+            dtypes[name] = "category"
+        else:
+            dtypes[name] = glue_dtype_map.get(glue_type, "string")
+    return dtypes
+
 
 # TODO possible implement awswrangler
 # or build class see
@@ -324,609 +698,875 @@ db_tables = [table['Name'] for table in glue_client.get_tables(
 Dict = {}
 
 
+def wait_for_queries(client: boto3.client, query_responses: Dict,
+                     base_delay: float = 0.25, max_delay: float = 8.0):
+    """Yield (table, query execution) pairs as each Athena query finishes
+
+    :param client: Athena client
+    :param query_responses: table name -> start_query_execution response
+    :param base_delay: first wait between status checks in seconds
+    :param max_delay: cap for the exponential backoff in seconds
+    """
+    pending = {table: response["QueryExecutionId"] for table, response in query_responses.items()}
+    delay = base_delay
+    while pending:
+        for table, query_id in list(pending.items()):
+            execution = client.get_query_execution(QueryExecutionId=query_id)["QueryExecution"]
+            state = execution["Status"]["State"]
+            if state == "SUCCEEDED":
+                del pending[table]
+                yield table, execution
+            elif state in ("FAILED", "CANCELLED"):
+                raise RuntimeError(f"{table} query {state}: "
+                                   f"{execution['Status'].get('StateChangeReason', '')}")
+        if pending:
+            time.sleep(delay)
+            delay = min(delay * 2, max_delay)
+
+
+def clean_codes(col: pd.Series) -> pd.Series:
+    """Strip float suffixes and leading zeros from a text code column
+
+    Gives the same digits an int round trip would, without the cast.
+    """
+    col = col.str.replace(r"\.0+$", "", regex=True).str.lstrip("0")
+    return col.mask((col == "").fillna(False), "0")
+
+
 def download_and_load_query_results(
-    client: boto3.client, query_response: Dict
+    client: boto3.client, query_execution: Dict, dtypes: Dict = None
 ) -> pd.DataFrame:
-    t0 = time.time()
-    print("Getting query results...")
-    while True:
-        try:
-            # This function only loads the first 1000 rows
-            client.get_query_results(
-                QueryExecutionId=query_response["QueryExecutionId"]
-            )
-            break
-        except Exception as err:
-            if "not yet finished" in str(err):
-                time.sleep(0.1)
-            else:
-                raise err
-    temp_file_location: str = "athena_query_results.csv"
-    s3_client.download_file(
-        S3_BUCKET_NAME,
-        f"{S3_STAGING_DIR}{query_response['QueryExecutionId']}.csv",
-        temp_file_location,
-    )
-    t1 = time.time()
-    texec = f"[{round(t1-t0, 2)}s]"
-    print(f"Query results downloaded. {texec : >30}")
-    return pd.read_csv(temp_file_location)
+    with spans.span("load_query_results") as s:
+        print(f"Getting query results for {query_execution['QueryExecutionId']}...")
+        bucket, key = split_s3_url(query_execution["ResultConfiguration"]["OutputLocation"])
+        # The parser pulls the object body in buffered reads, nothing is written to disk
+        body = client.get_object(Bucket=bucket, Key=key)["Body"]
+        df = pd.read_csv(body, dtype=dtypes)
+        for col in code_columns.intersection(df.columns):
+            df[col] = clean_codes(df[col])
+        s.add(rows_out=len(df))
+        s.done = f"Query results loaded. {len(df)} rows."
+    return df
+
+
+# Columns and row filters the transforms need from each table, pushed
+# down into the Athena queries. Tables not listed here are not extracted
+table_extracts = {
+    # dim_region
+    "enigma_jhu": {
+        "columns": ["fips", "province_state", "country_region", "latitude", "longitude"],
+        "distinct": True,
+        "where": "fips IS NOT NULL AND (province_state IS NULL OR province_state <> 'Grand Princess')",
+    },
+    "nytimes_data_us_county": {
+        "columns": ["fips", "county"],
+        "distinct": True,
+        "where": "fips IS NOT NULL",
+    },
+    # dim_hospital
+    "rearc_usa_hospital_beds": {
+        "columns": ["fips", "state_name", "county_name", "latitude", "longtitude", "hospital_name",
+                    "hq_address", "hq_city", "hq_state", "hq_zip_code", "hospital_type"],
+        "where": "fips IS NOT NULL AND state_name IS NOT NULL",
+    },
+    # dim_date and fact_covid
+    "rearc_testing_states_daily": {
+        "columns": ["fips", "date", "positive", "negative", "hospitalized", "state",
+                    "hospitalizedcurrently", "hospitalizeddischarged", "hospitalizedcumulative",
+                    "death", "recovered", "deathincrease", "hospitalizedincrease", "positiveincrease"],
+    },
+    # The crawler reads the header as a row, so every column is kept
+    "d_static_state_abv": {},
+}
+
+
+def table_query(table):
+    extract = table_extracts.get(table, {})
+    columns = ", ".join(f'"{col}"' for col in extract.get("columns", [])) or "*"
+    distinct = "DISTINCT " if extract.get("distinct") else ""
+    where = f" WHERE {extract['where']}" if extract.get("where") else ""
+    return f"SELECT {distinct}{columns} FROM {table}{where}"
 
 
 # Execute table query
-def get_query_response(table, database, output_location):
+def get_query_response(table, database, output_location, client=athena_client):
     print(f"Running Query for {table}...")
-    t0 = time.time()
-    response = athena_client.start_query_execution(
-        QueryString=f"SELECT * FROM {table}",
-        QueryExecutionContext={"Database": database},
-        ResultConfiguration={
-            "OutputLocation": f"{output_location}",
-            "EncryptionConfiguration": {"EncryptionOption": "SSE_S3"},
-        },
-    )
-    t1 = time.time()
-    texec = f"[{round(t1-t0, 2)}s]"
-    print(f"{table} query COMPLETE.  {texec : >30}")
+    with spans.span("submit_query", f"{table} query SUBMITTED.", table=table):
+        response = client.start_query_execution(
+            QueryString=table_query(table),
+            QueryExecutionContext={"Database": database},
+            ResultConfiguration={
+                "OutputLocation": f"{output_location}",
+                "EncryptionConfiguration": {"EncryptionOption": "SSE_S3"},
+            },
+        )
     return response
 
 
-# Create dataframes for each table in database
-d_static_countrycode, d_static_countypopulation, d_static_state_abv, \
-    enigma_jhu, nytimes_data_us_county, nytimes_data_us_states, \
-    rearc_testing_states_daily, rearc_usa_hospital_beds = [download_and_load_query_results(
-        athena_client, get_query_response(table, GLUE_DB, S3_STAGING_PATH)) for table in db_tables]
-
-# Trasnform data for data model
-d_static_state_abv.rename(columns=d_static_state_abv.iloc[0], inplace=True)
-d_static_state_abv.drop([0], inplace=True)
-d_static_state_abv.head()
-
-print("Creating DWH dim_region table...")
-t0 = time.time()
-dim_region1 = enigma_jhu[['fips', 'province_state', 'country_region',
-                          'latitude', 'longitude']][enigma_jhu['province_state'] != 'Grand Princess']
-dim_region1 = dim_region1.dropna(subset=['fips'])
-dim_region2 = nytimes_data_us_county[['fips', 'county']]
-dim_region = pd.merge(dim_region1, dim_region2, on='fips', how='inner')
-dim_region = dim_region.dropna(subset=['fips', 'latitude', 'longitude'])
-dim_region.drop_duplicates(inplace=True)
-dim_region.reset_index(drop=True, inplace=True)
-dim_region['fips'] = dim_region['fips'].astype(int)
-dim_region['fips'] = dim_region['fips'].astype(str).str.zfill(5)
-dim_region['state_fips'] = dim_region['fips'].str[:2]
-dim_region['county_fips'] = dim_region['fips'].str[-3:]
-dim_region.loc[dim_region['state_fips'] == '00', 'state_fips'] = '72'
-dim_region = dim_region.sort_values(by=['state_fips', 'county_fips']).reset_index(drop=True)
-dim_region['region_sk'] = dim_region.reset_index()['index']
-dim_region = dim_region.dropna(subset=['region_sk']).reset_index(drop=True)
-dim_region['region_sk'] = dim_region['region_sk'].astype(int) + 1
-dim_region = dim_region[['region_sk', 'fips', 'state_fips', 'county_fips',
-                         'province_state', 'county', 'country_region', 'latitude', 'longitude']]
-t1 = time.time()
-texec = f"[{round(t1-t0, 2)}s]"
-print(f"dim_region COMPLETE. {texec : >30}")
-
-
-print("Creating DWH dim_hospital table...")
-t0 = time.time()
-dim_hospital = rearc_usa_hospital_beds[['fips', 'state_name', 'county_name', 'latitude', 'longtitude',
-                                        'hospital_name', 'hq_address', 'hq_city', 'hq_state',
-                                        'hq_zip_code', 'hospital_type']].dropna(
-                                            subset=['fips', 'state_name']).reset_index(drop=True)
-dim_hospital.fips = dim_hospital.fips.astype(int)
-dim_hospital.fips = dim_hospital.fips.astype(str).str.zfill(5)
-dim_hospital['state_fips'] = dim_hospital['fips'].astype(str).str[:2]
-dim_hospital['county_fips'] = dim_hospital['fips'].astype(str).str[-3:]
-dim_hospital.hq_zip_code = dim_hospital.hq_zip_code.astype(str).str.zfill(5)
-dim_hospital = dim_hospital.sort_values(by=['state_fips', 'county_fips']).reset_index(drop=True)
-dim_hospital['hosp_sk'] = dim_hospital.reset_index()['index']
-dim_hospital['hosp_sk'] = dim_hospital['hosp_sk'].astype(int) + 1
-dim_hospital = dim_hospital[['hosp_sk', 'fips', 'state_fips', 'county_fips', 'state_name',
-                             'county_name', 'hospital_name', 'hq_address', 'hq_city',
-                             'hq_state', 'hq_zip_code', 'hospital_type', 'latitude', 'longtitude', ]]
-t1 = time.time()
-texec = f"[{round(t1-t0, 2)}s]"
-print(f"dim_hospital COMPLETE. {texec : >30}")
-
-# Create date_dim calendar table
-# This table could be passed an indefinite end date
-
-
-def create_date_dim(start, end):
-    print("Creating DWH dim_date table...")
-    t0 = time.time()
-    df = pd.DataFrame({"date": pd.date_range(start, end)})
-    df["day_name"] = df.date.dt.day_name()
-    df["day_of_week"] = df.date.dt.day_of_week + 1  # Start Monday at 1
-    df["day"] = df.date.dt.day
-    df["day_of_year"] = df.date.dt.day_of_year
-    df["month"] = df.date.dt.month
-    df["month_name"] = df.date.dt.month_name()
-    df["week"] = df.date.dt.isocalendar().week
-    df["quarter"] = df.date.dt.quarter
-    df["year"] = df.date.dt.year
-    df["year_half"] = df.date.dt.month.map(lambda mo: 1 if mo < 7 else 2)
-    df["is_weekend"] = df.date.dt.weekday >= 5
-    df.insert(0, 'date_id', (df.year.astype(str) + df.month.astype(str).str.zfill(2)
-                             + df.day.astype(str).str.zfill(2)).astype(int))
-    t1 = time.time()
-    texec = f"[{round(t1-t0, 2)}s]"
-    print(f"dim_date COMPLETE.  {texec : >30}")
-    return df
+def extract_tables(tables, database, output_location, dtypes=None, cached=None,
+                   athena=athena_client, s3=s3_client):
+    """Run a query per table concurrently and load each result into a DataFrame
 
+    Every query is submitted up front and each result is streamed from
+    S3 into its own DataFrame as soon as its query finishes.
 
-dim_date = create_date_dim(pd.to_datetime(rearc_testing_states_daily['date'], format='%Y%m%d').min(),
-                           pd.to_datetime(rearc_testing_states_daily['date'], format='%Y%m%d').max())
-
-print("Creating DWH fact_covid table...")
-t0 = time.time()
-fact_covid1 = rearc_testing_states_daily[['fips', 'date', 'positive', 'negative', 'hospitalized', 'state',
-                                          'hospitalizedcurrently', 'hospitalizeddischarged', 'hospitalizedcumulative',
-                                          'death', 'recovered', 'deathincrease', 'hospitalizedincrease',
-                                          'positiveincrease']]
-fact_covid1 = fact_covid1.dropna(subset=['fips', 'state']).reset_index(drop=True)
-fact_covid1['fips'] = fact_covid1['fips'].astype(int)
-fact_covid1['fips'] = fact_covid1['fips'].astype(str).str.zfill(2)
-fact_covid1['state_fips'] = fact_covid1['fips']
-fact_covid1.drop(['fips'], axis=1, inplace=True)
-fact_covid1 = fact_covid1.sort_values(by=['state_fips'])
-fact_covid1.set_index(['state_fips'], inplace=True)
-
-fact_covid2 = dim_region[['state_fips', 'region_sk']]
-fact_covid2 = fact_covid2.sort_values(by=['state_fips', 'region_sk']).reset_index(drop=True)
-fact_covid2.set_index(['state_fips'], inplace=True)
-fact_covid2 = fact_covid2.groupby(fact_covid2.index).first()
-
-fact_covid3 = dim_hospital[['state_fips', 'hosp_sk']]
-fact_covid3 = fact_covid3.sort_values(by=['state_fips', 'hosp_sk']).reset_index(drop=True)
-fact_covid3.set_index(['state_fips'], inplace=True)
-fact_covid3 = fact_covid3.groupby(fact_covid3.index).first()
-
-fact_covid4 = pd.merge(fact_covid1, fact_covid2, how='inner', left_index=True, right_index=True)
-fact_covid = pd.merge(fact_covid3, fact_covid4, how='inner', left_index=True, right_index=True)
-fact_covid.reset_index(inplace=True)
-fact_covid.fillna(0, inplace=True)
-fact_covid = fact_covid[['date', 'state_fips', 'state', 'positive', 'positiveincrease', 'negative',
-                         'death', 'deathincrease', 'recovered', 'hospitalized', 'hospitalizedcurrently',
-                         'hospitalizeddischarged', 'hospitalizedcumulative', 'hospitalizedincrease',
-                         'region_sk', 'hosp_sk']]
-t1 = time.time()
-texec = f"[{round(t1-t0, 2)}s]"
-print(f"fact_covid COMPLETE. {texec : >30}")
-
-
-# Function to get df name string
-def get_df_name(df):
-    name = [x for x in globals() if globals()[x] is df][0]
-    return name
+    :param dtypes: table name -> read_csv dtype map
+    :param cached: table name -> result location of an earlier query
+        that can be loaded again instead of querying
+    :return: dict of table name -> DataFrame, dict of table name -> result location
+    """
+    with spans.span("athena_extract") as s:
+        dtypes = dtypes or {}
+        cached = cached or {}
+        query_responses = {table: get_query_response(table, database, output_location, client=athena)
+                           for table in tables if table not in cached}
+        with ThreadPoolExecutor(max_workers=len(tables)) as pool:
+            futures = {}
+            for table, location in cached.items():
+                print(f"{table} source unchanged, reusing {location}")
+                execution = {"QueryExecutionId": "cached", "ResultConfiguration": {"OutputLocation": location}}
+                futures[table] = (location, pool.submit(contextvars.copy_context().run,
+                                                        download_and_load_query_results, s3, execution,
+                                                        dtypes.get(table)))
+            for table, execution in wait_for_queries(athena, query_responses):
+                futures[table] = (execution["ResultConfiguration"]["OutputLocation"],
+                                  pool.submit(contextvars.copy_context().run, download_and_load_query_results,
+                                              s3, execution, dtypes.get(table)))
+            dfs = {table: futures[table][1].result() for table in tables}
+        s.add(rows_out=sum(len(df) for df in dfs.values()))
+        s.done = f"Athena extraction COMPLETE for {len(tables)} tables, {len(cached)} reused."
+    return dfs, {table: location for table, (location, _) in futures.items()}
+
+
+def extract_local_tables(tables, cache_dir=LOCAL_CACHE_DIR):
+    """Run the extraction queries with DuckDB over cached copies of dl_file_list
+
+    Cached files that changed upstream are downloaded again first. The
+    frames come back with the same code and category columns as the
+    Athena results.
+
+    :return: dict of table name -> DataFrame
+    """
+    local = local_query.LocalQuery(cache_dir, text_columns=code_columns)
+    local.cache(dl_file_list)
+    local.register()
+    dfs = local.extract_tables({table: table_query(table) for table in tables if table in local.tables})
+    for df in dfs.values():
+        for col in code_columns.intersection(df.columns):
+            df[col] = clean_codes(df[col].astype("string"))
+        for col in category_columns.intersection(df.columns):
+            df[col] = df[col].astype("category")
+    return dfs
+
+
+def query_dwh(sql, table, client=redshift_client):
+    """First row of a query against a warehouse table
+
+    A missing cluster or table means nothing is loaded yet. A cluster that
+    is not available yet is read the same way, the loads that depend on
+    these reads replace or append idempotently.
+
+    :return: row tuple, None when there is no cluster or table yet
+    :raises redshift_connector.Error: when the query fails
+    """
+    try:
+        cluster = client.describe_clusters(ClusterIdentifier=DWH_CLUSTER_IDENTIFIER)['Clusters'][0]
+    except client.exceptions.ClusterNotFoundFault:
+        return None
+    if 'Endpoint' not in cluster or cluster['ClusterStatus'] != 'available':
+        print(f"{DWH_CLUSTER_IDENTIFIER} is {cluster['ClusterStatus']}, treating {table} as not loaded yet...")
+        return None
+    conn = redshift_connector.connect(
+        host=cluster['Endpoint']['Address'],
+        database=DWH_DB,
+        user=DWH_DB_USER,
+        password=DWH_DB_PASSWORD,
+    )
+    try:
+        cur = conn.cursor()
+        cur.execute("SELECT 1 FROM information_schema.tables WHERE table_name = %s", (table,))
+        if cur.fetchone() is None:
+            return None
+        cur.execute(sql)
+        return cur.fetchone()
+    finally:
+        conn.close()
 
 
-def upload_transform_csv(df, ind, bucket, output_loc):
-    buffer = StringIO()
-    filename = f"{get_df_name(df)}.csv"
-    location = f"{output_loc}{filename}"
-    print(f"Coverting dataframe {filename.split('.')[0]} to csv...")
-    t0 = time.time()
-    # Save transformed table data to S3
-    # create StringIO to convert data into binary
-    df.to_csv(buffer, index=ind)
-    t1 = time.time()
-    texec = f"[{round(t1-t0, 2)}s]"
-    print(f"Conversion COMPLETE. {texec : >30}")
-    print(f"uploading {bucket}/{location}.....")
-    t2 = time.time()
-    s3_resource.Object(bucket, location).put(Body=buffer.getvalue())
-    t3 = time.time()
-    texec = f"[{round(t3-t2, 2)}s]"
-    print(f"{bucket}/{location} upload complete.  {texec : >30}")
+def get_fact_watermark(client=redshift_client):
+    """Latest date already loaded into fact_covid
+
+    :return: date as a yyyymmdd int, None when there is no cluster or table yet
+    """
+    row = query_dwh("SELECT MAX(date) FROM fact_covid", "fact_covid", client)
+    return row[0] if row else None
+
 
+def get_loaded_dates(client=redshift_client):
+    """First and last date_id already loaded into dim_date, None when it is empty"""
+    row = query_dwh("SELECT MIN(date_id), MAX(date_id) FROM dim_date", "dim_date", client)
+    return tuple(row) if row and row[0] is not None else None
 
-# upload new tables to s3
-for df, ind in [(fact_covid, False), (dim_date, False), (dim_hospital, False), (dim_region, False)]:
-    upload_transform_csv(df, ind, S3_BUCKET_NAME, S3_OUTPUT_DIR)
 
+def get_copy_parts(client=redshift_client):
+    """Number of files each table is split into for COPY
 
-def create_schema_sqls(df_list):
+    Defaults to one per cluster slice, read from the cluster when it
+    already exists and from the configured node type otherwise.
+    """
+    if COPY_SPLIT_PARTS:
+        return COPY_SPLIT_PARTS
+    if TRANSFORM_OFFLINE:
+        return dwh_output.slice_count(DWH_NODE_TYPE, DWH_NUM_NODES)
+    try:
+        cluster = client.describe_clusters(ClusterIdentifier=DWH_CLUSTER_IDENTIFIER)['Clusters'][0]
+        return dwh_output.slice_count(cluster['NodeType'], cluster['NumberOfNodes'])
+    except client.exceptions.ClusterNotFoundFault:
+        return dwh_output.slice_count(DWH_NODE_TYPE, DWH_NUM_NODES)
+
+
+def upload_transform(df, name, ind, bucket, output_loc, parts=1,
+                     output_format=OUTPUT_FORMAT, compression=COPY_COMPRESSION):
+    """Split a table into compressed parts and upload them with a COPY manifest
+
+    With TRANSFORM_OFFLINE the parts are written under LOCAL_CACHE_DIR instead.
+
+    :return: S3 key of the manifest, or its local path offline
+    """
+    compression = None if output_format == "parquet" else compression
+    ext = dwh_output.file_extension(output_format, compression)
+    print(f"Coverting dataframe {name} to {parts} {ext} parts...")
+    # Save transformed table data to S3
+    with spans.span("serialize", table=name) as s:
+        bodies = dwh_output.serialize_parts(df, name, parts, output_format, ind, compression)
+        s.add(rows_in=len(df), bytes=sum(len(body) for body in bodies))
+        s.done = f"Conversion COMPLETE. {sum(len(body) for body in bodies)} bytes."
+    if TRANSFORM_OFFLINE:
+        local_dir = os.path.join(LOCAL_CACHE_DIR, output_loc)
+        with spans.span("write_parts", table=name) as s:
+            manifest_path = dwh_output.write_parts(bodies, name, local_dir, ext)
+            s.add(bytes=sum(len(body) for body in bodies))
+            s.done = f"{manifest_path} written."
+        return manifest_path
+    print(f"uploading {len(bodies)} parts to {bucket}/{output_loc}{name}/.....")
+    with spans.span("upload", table=name) as s:
+        manifest_key = dwh_output.put_parts(s3_client, bodies, name, bucket, output_loc, ext)
+        s.add(bytes=sum(len(body) for body in bodies))
+        s.done = f"{bucket}/{manifest_key} upload complete."
+    return manifest_key
+
+
+def create_table_ddl(tables, output_format=OUTPUT_FORMAT):
+    """Generate the warehouse DDL from the tables as they are written for COPY
+
+    Empty tables are left out, the load falls back to dwh_sql.TABLE_DDL for them.
+
+    :return: dict of table name -> DDL
+    """
     sqls = {}
-    for df in df_list:
-        t0 = time.time()
-        k = f"{get_df_name(df)}_sql"
-        dfname = k.split('_sql')[0]
-        print(f"Creating DDL for {dfname}...")
-        v = pd.io.sql.get_schema(df.reset_index(), dfname)
-        sqls[k] = v
-        t1 = time.time()
-        texec = f"[{round(t1-t0, 2)}s]"
-        print(f"{dfname} DDL created. {texec : >30}")
+    for name, df in tables.items():
+        if not len(df):
+            continue
+        with spans.span("table_ddl", f"{name} DDL created.", table=name):
+            print(f"Creating DDL for {name}...")
+            if output_format == "parquet":
+                df = df.astype(dwh_output.PARQUET_DTYPES.get(name, {}))
+            sqls[name] = dwh_ddl.table_ddl(name, df, exact_ints=output_format == "parquet")
     return sqls
 
 
-# Used to create DDL Statements
-sql_dict = create_schema_sqls([fact_covid, dim_date, dim_hospital, dim_region])
+def run_athena_queries(queries, database, output_location, client=athena_client):
+    """Run queries concurrently and wait for all of them
 
+    :param queries: name -> SQL
+    """
+    query_responses = {
+        name: client.start_query_execution(
+            QueryString=sql,
+            QueryExecutionContext={"Database": database},
+            ResultConfiguration={
+                "OutputLocation": f"{output_location}",
+                "EncryptionConfiguration": {"EncryptionOption": "SSE_S3"},
+            },
+        )
+        for name, sql in queries.items()
+    }
+    for name, execution in wait_for_queries(client, query_responses):
+        texec = f"[{round(execution['Statistics']['TotalExecutionTimeInMillis'] / 1000, 2)}s]"
+        print(f"{name} query COMPLETE. {texec : >30}")
 
-# Download needed wheel pkg
-filename = 'redshift_connector-2.0.909-py3-none-any.whl'
-file_url = ('https://files.pythonhosted.org/packages/24/3c/'
-            '471f5f7d43f1ed1be87494010f466849fe2376acf8bab49d4b676f870cf1/redshift_connector-2.0.909-py3-none-any.whl')
-url_download_upload(S3_BUCKET_NAME, EXT_PKG_DIR, filename, file_url)
 
-filename = 'boto3-1.26.23-py3-none-any.whl'
-file_url = ('https://files.pythonhosted.org/packages/67/03/'
-            '0e794cf0621ce8c3ee780bb5fdeeffeefc095dd1f7f264b1f434db207063/boto3-1.26.23-py3-none-any.whl')
-url_download_upload(S3_BUCKET_NAME, EXT_PKG_DIR, filename, file_url)
+def delete_prefix(bucket, prefix):
+    paginator = s3_client.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        objects = [{"Key": obj["Key"]} for obj in page.get("Contents", [])]
+        if objects:
+            s3_client.delete_objects(Bucket=bucket, Delete={"Objects": objects})
 
-filename = 's3transfer-0.6.0-py3-none-any.whl'
-file_url = ('https://files.pythonhosted.org/packages/5e/c6/'
-            'af903b5fab3f9b5b1e883f49a770066314c6dcceb589cf938d48c89556c1/s3transfer-0.6.0-py3-none-any.whl')
-url_download_upload(S3_BUCKET_NAME, EXT_PKG_DIR, filename, file_url)
 
-filename = 'botocore-1.29.23-py3-none-any.whl'
-file_url = ('https://files.pythonhosted.org/packages/19/eb/'
-            '1068bdad2424f509b5700ace7d8adb3b97595618000ec9bc1c3bd4224c98/botocore-1.29.23-py3-none-any.whl')
-url_download_upload(S3_BUCKET_NAME, EXT_PKG_DIR, filename, file_url)
+def run_ctas_transforms(database, output_location, cutoff=None, loaded_dates=None):
+    """Build the star schema with Athena CTAS queries
+
+    The dimensions are built concurrently, fact_covid once they exist.
+    Each table is written as Parquet under S3_OUTPUT_PATH with a COPY
+    manifest next to it, the same layout upload_transform produces.
+
+    :param database: Glue DB holding the crawled source tables
+    :param output_location: S3 path for the query metadata
+    :param cutoff: only build fact_covid rows after this yyyymmdd date
+    :param loaded_dates: (first, last) date_id already in dim_date
+    :return: table name -> number of Parquet parts written
+    """
+    with spans.span("athena_ctas", "Athena CTAS transforms COMPLETE."):
+        bucket, output_dir = split_s3_url(S3_OUTPUT_PATH)
+        written = {}
+        stages = [
+            {"dim_region": athena_ctas.dim_region_sql,
+             "dim_hospital": athena_ctas.dim_hospital_sql,
+             "dim_date": lambda db, location: athena_ctas.dim_date_sql(db, location, DIM_DATE_HORIZON_DAYS,
+                                                                       loaded_dates)},
+            {"fact_covid": lambda db, location: athena_ctas.fact_covid_sql(db, location, cutoff)},
+        ]
+        for stage in stages:
+            # CTAS needs an empty location and a free table name
+            run_athena_queries({f"drop {table}": athena_ctas.drop_sql(table, database) for table in stage},
+                               database, output_location)
+            for table in stage:
+                delete_prefix(bucket, f"{output_dir}{table}/")
+            run_athena_queries({table: build(database, f"{S3_OUTPUT_PATH}{table}/") for table, build in stage.items()},
+                               database, output_location)
+            for table in stage:
+                paginator = s3_client.get_paginator("list_objects_v2")
+                parts = [(f"s3://{bucket}/{obj['Key']}", obj["Size"])
+                         for page in paginator.paginate(Bucket=bucket, Prefix=f"{output_dir}{table}/")
+                         for obj in page.get("Contents", []) if obj["Size"]]
+                s3_client.put_object(Bucket=bucket, Key=f"{output_dir}{table}.manifest",
+                                     Body=dwh_output.build_manifest(parts))
+                written[table] = len(parts)
+                print(f"{table} written as {len(parts)} Parquet parts.")
+    return written
+
+
+def transform_tables(state):
+    """Build the star schema with the configured engine and stage it in S3 for COPY"""
+    if TRANSFORM_OFFLINE:
+        print("Transforming offline, every table is built in full...")
+    fact_watermark = get_fact_watermark() if FACT_LOAD_MODE == "incremental" and not TRANSFORM_OFFLINE else None
+    fact_cutoff = None
+    if fact_watermark is not None:
+        fact_cutoff = pd.to_datetime(str(fact_watermark), format='%Y%m%d') - pd.Timedelta(days=FACT_RESTATEMENT_DAYS)
+        fact_cutoff = fact_cutoff.year * 10000 + fact_cutoff.month * 100 + fact_cutoff.day
+        print(f"fact_covid loaded through {fact_watermark}, transforming days after {fact_cutoff}...")
+    # Only dates missing from the warehouse calendar are generated and appended
+    loaded_dates = None if TRANSFORM_OFFLINE else get_loaded_dates()
+    if loaded_dates is not None:
+        print(f"dim_date holds {loaded_dates[0]} to {loaded_dates[1]}, appending missing dates only...")
+
+    if TRANSFORM_ENGINE == "athena":
+        ctas_parts = run_ctas_transforms(GLUE_DB, S3_STAGING_PATH, fact_cutoff, loaded_dates)
+        return {"fact_watermark": fact_watermark, "fact_cutoff": fact_cutoff,
+                "new_dates": ctas_parts["dim_date"] > 0}
+
+    if QUERY_BACKEND == "duckdb":
+        athena_dfs = extract_local_tables(table_extracts)
+        extract_list = list(athena_dfs)
+    else:
+        # Get List of tables in database
+        glue_tables = glue_client.get_tables(DatabaseName=GLUE_DB, NextToken='', MaxResults=11)['TableList']
+        db_tables = [table['Name'] for table in glue_tables]
+        db_dtypes = {table['Name']: glue_table_dtypes(table) for table in glue_tables}
+        extract_list = [table for table in db_tables if table in table_extracts]
+
+        # Results of the last run can be reused for tables whose
+        # sources and query are unchanged
+        ingest_manifest = load_ingest_manifest(S3_BUCKET_NAME, INGEST_MANIFEST_KEY)
+        reusable_results = {
+            table: result["output_location"] for table, result in ingest_manifest["athena_results"].items()
+            if table in extract_list and table not in state["changed_tables"]
+            and result["query"] == table_query(table) and key_exists(*split_s3_url(result["output_location"]))
+        }
+
+        # Create dataframes for each table the transforms use
+        athena_dfs, result_locations = extract_tables(extract_list, GLUE_DB, S3_STAGING_PATH,
+                                                      db_dtypes, reusable_results)
+        ingest_manifest["athena_results"] = {table: {"query": table_query(table), "output_location": location}
+                                             for table, location in result_locations.items()}
+        save_ingest_manifest(S3_BUCKET_NAME, INGEST_MANIFEST_KEY, ingest_manifest)
+    if COMPACT_MEMORY:
+        for table in extract_list:
+            frame_memory.compact_frame(athena_dfs[table], keep_text=code_columns)
+        gc.collect()
+    d_static_state_abv, enigma_jhu, nytimes_data_us_county, \
+        rearc_testing_states_daily, rearc_usa_hospital_beds = [athena_dfs[table] for table in [
+            'd_static_state_abv', 'enigma_jhu', 'nytimes_data_us_county',
+            'rearc_testing_states_daily', 'rearc_usa_hospital_beds']]
+    athena_dfs.clear()
+    frame_memory.report_memory("extraction", locals())
+
+    # Trasnform data for data model
+    d_static_state_abv.rename(columns=d_static_state_abv.iloc[0], inplace=True)
+    d_static_state_abv.drop([0], inplace=True)
+    d_static_state_abv.head()
+
+    # Surrogate keys are looked up in the registries so they stay stable between runs
+    key_registries = {}
+    if KEY_REGISTRY_DIR and not TRANSFORM_OFFLINE:
+        key_registries = {dimension: key_registry.load_registry(s3_client, S3_BUCKET_NAME,
+                                                                f"{KEY_REGISTRY_DIR}{dimension}.parquet", dimension)
+                          for dimension in key_registry.REGISTRY_KEYS}
+    dim_region = transforms.build_dim_region(enigma_jhu, nytimes_data_us_county, key_registries.get("dim_region"))
+    if COMPACT_MEMORY:
+        del enigma_jhu, nytimes_data_us_county
+        gc.collect()
+    frame_memory.report_memory("dim_region", locals())
+
+    dim_hospital = transforms.build_dim_hospital(rearc_usa_hospital_beds, key_registries.get("dim_hospital"))
+    if COMPACT_MEMORY:
+        del rearc_usa_hospital_beds
+        gc.collect()
+    frame_memory.report_memory("dim_hospital", locals())
+    for dimension, registry in key_registries.items():
+        if registry.added:
+            key_registry.save_registry(s3_client, S3_BUCKET_NAME, f"{KEY_REGISTRY_DIR}{dimension}.parquet", registry)
+            print(f"{dimension} registry: {registry.added} new keys, {len(registry.keys)} total.")
+
+    source_dates = pd.to_datetime(rearc_testing_states_daily['date'], format='%Y%m%d')
+    dim_date = transforms.create_date_dim(
+        source_dates.min(),
+        max(source_dates.max(), pd.Timestamp.today().normalize()) + pd.Timedelta(days=DIM_DATE_HORIZON_DAYS),
+        loaded_dates)
+
+    fact_source = rearc_testing_states_daily
+    if fact_cutoff is not None:
+        fact_source = rearc_testing_states_daily[rearc_testing_states_daily['date'] > fact_cutoff]
+        print(f"{len(fact_source)} rows after {fact_cutoff}")
+    fact_covid = transforms.build_fact_covid(fact_source, dim_region, dim_hospital)
+    if COMPACT_MEMORY:
+        del rearc_testing_states_daily, fact_source
+        gc.collect()
+    frame_memory.report_memory("fact_covid", locals())
+
+    tables = {"fact_covid": fact_covid, "dim_date": dim_date, "dim_hospital": dim_hospital, "dim_region": dim_region}
+    # upload new tables to s3
+    copy_parts = get_copy_parts()
+    for name, df in tables.items():
+        if name == "dim_date" and not len(df):
+            print("dim_date has no new dates\t SKIPPING.")
+            continue
+        upload_transform(df, name, False, S3_BUCKET_NAME, S3_OUTPUT_DIR, copy_parts)
+
+    # Column types, encodings and distribution come from the loaded data
+    table_ddl = create_table_ddl(tables)
+    return {"fact_watermark": fact_watermark, "fact_cutoff": fact_cutoff, "new_dates": len(dim_date) > 0,
+            "table_ddl": table_ddl}
+
+
+def upload_glue_wheels(state):
+    """Upload the wheels of the Glue job, each under the digest of its content
+
+    The digest is part of the pinned PyPI URL, so a wheel is only
+    downloaded when no object with its digest is in the bucket yet.
+    """
+    index = get_bucket_index(S3_BUCKET_NAME)
+    keys = []
+    with spans.span("glue_wheels", "Glue job wheels ready.") as s:
+        for filename, file_url in glue_wheels.GLUE_JOB_WHEELS:
+            key = glue_wheels.wheel_key(EXT_PKG_DIR, filename, file_url)
+            keys.append(key)
+            if index.exists(key):
+                print(f"{key} already uploaded\t SKIPPING.")
+                continue
+            r = requests.get(file_url)
+            r.raise_for_status()
+            glue_wheels.check_digest(file_url, r.content)
+            s3_client.put_object(Bucket=S3_BUCKET_NAME, Key=key, Body=r.content)
+            index.add(key)
+            s.add(bytes=len(r.content))
+            print(f"{S3_BUCKET_NAME}/{key} upload SUCCESSFUL.")
+    return {"wheel_keys": keys}
 
-filename = 'awscli-1.27.23-py3-none-any.whl'
-file_url = ('https://files.pythonhosted.org/packages/f2/2a/'
-            'e199d0cfb949a6a1710c8b9ead4d0238690435457a6e32861b7c4214e0dd/awscli-1.27.23-py3-none-any.whl')
-url_download_upload(S3_BUCKET_NAME, EXT_PKG_DIR, filename, file_url)
 
 # Function to display key cluster info
 
 
 def prettyRedshiftProps(props):
-    pd.set_option('display.max_colwidth', -1)
     keysToShow = ["ClusterIdentifier", "NodeType", "ClusterStatus", "MasterUsername",
                   "DBName", "Endpoint", "NumberOfNodes", "VpcId", "VpcSecurityGroups"]
     x = [(k, v) for k, v in props.items() if k in keysToShow]
     return pd.DataFrame(data=x, columns=["Key", "Value"])
 
 
-# Create Redshift Cluster
-try:
-    t0 = time.time()
-    print(f"Creating Redshift Cluster {DWH_CLUSTER_IDENTIFIER}...")
-    response = redshift_client.create_cluster(
-        # add parameters for hardware
-        ClusterType=DWH_CLUSTER_TYPE,
-        NodeType=DWH_NODE_TYPE,
-        NumberOfNodes=int(DWH_NUM_NODES),
-        # add parameters for identifiers & credentials
-        DBName=DWH_DB,
-        ClusterIdentifier=DWH_CLUSTER_IDENTIFIER,
-        MasterUsername=DWH_DB_USER,
-        MasterUserPassword=DWH_DB_PASSWORD,
-        # add parameter for role (to allow s3 access)
-        IamRoles=[redshift_roleArn]
-    )
-    exit_v = 0
-    print('Waiting for Cluster Endpoint...')
-    while not (exit_v):
-        response = redshift_client.describe_clusters(ClusterIdentifier=DWH_CLUSTER_IDENTIFIER)['Clusters'][0]
-        if 'Endpoint' in response:
-            t1 = time.time()
-            texec = f"[{round(t1-t0, 2)}s]"
-            print(f"{DWH_CLUSTER_IDENTIFIER} Build COMPLETE "
-                  f"Cluster is currently {response['ClusterAvailabilityStatus']}. {texec : >30}")
-            time.sleep(5)
-            exit_v = 1
-except Exception as e:
-    print(e)
-
-myClusterProps = redshift_client.describe_clusters(ClusterIdentifier=DWH_CLUSTER_IDENTIFIER)['Clusters'][0]
-prettyRedshiftProps(myClusterProps)
-
-# ADD NEW DWH VARIABLES
-DWH_ENDPOINT = myClusterProps['Endpoint']['Address']
-DWH_VPCID = myClusterProps['VpcId']
-
-# Create Security group for Cluster
-try:
-    t0 = time.time()
-    print("Creating Security Group for Redshift Cluster...")
-    vpc = ec2_resource.Vpc(id=myClusterProps['VpcId'])
-    defaultSg = list(vpc.security_groups.all())[-1]
-
-    defaultSg.authorize_ingress(
-        GroupName=defaultSg.group_name,
-        CidrIp='0.0.0.0/0',
-        IpProtocol='TCP',
-        FromPort=int(DWH_PORT),
-        ToPort=int(DWH_PORT)
-    )
-    t1 = time.time()
-    texec = f"[{round(t1-t0, 2)}]s"
-    print(f"{myClusterProps['VpcSecurityGroups'][-1]['VpcSecurityGroupId']} updated. {texec : >30}")
-except Exception as e:
-    print(e)
-
-# Create Glue-Redshift job script
-with open('create_rs_tables.py', 'w') as f:
-    f.write(
-        cleandoc(f'''
-                import sys
-                sys.path.insert(0, '/glue/lib/installation')
-                keys = [k for k in sys.modules.keys() if 'boto' in k]
-                for k in keys:
-                    if 'boto' in k:
-                    del sys.modules[k]
-
-                import awscli
-                import s3transfer
-                import redshift_connector
-
-                # Estabish DWH Connection
-                conn = redshift_connector.connect(
-                   host='{DWH_ENDPOINT}',
-                   database='{DWH_DB}',
-                   user='{DWH_DB_USER}',
-                   password='{DWH_DB_PASSWORD}',
-                )
-
-                conn.autocommit = True
-                cur = conn.cursor()
-
-                # Create DWH Tables
-                cur.execute("""
-                            CREATE TABLE IF NOT EXISTS "dim_date" (
-                                "date_id" INTEGER,
-                                "date" DATE NOT NULL,
-                                "day_name" VARCHAR(9) NOT NULL,
-                                "day_of_week" INTEGER NOT NULL,
-                                "day" INTEGER NOT NULL,
-                                "day_of_year" INTEGER NOT NULL,
-                                "month" INTEGER NOT NULL,
-                                "month_name" VARCHAR(10) NOT NULL,
-                                "week" INTEGER NOT NULL,
-                                "quarter" INTEGER NOT NULL,
-                                "year" INTEGER NOT NULL,
-                                "year_half" INTEGER NOT NULL,
-                                "is_weekend" BOOLEAN NOT NULL,
-                                PRIMARY KEY (date_id)
-                                )
-                                SORTKEY (date)
-                            """)
-
-                cur.execute("""
-                            CREATE TABLE IF NOT EXISTS "dim_hospital" (
-                                "hosp_sk" INTEGER IDENTITY(1, 1),
-                                "fips" VARCHAR(6) NOT NULL,
-                                "state_fips" VARCHAR(2) NOT NULL,
-                                "county_fips" VARCHAR(3) NOT NULL,
-                                "state_name" VARCHAR(30) NOT NULL,
-                                "county_name" VARCHAR(120),
-                                "hospital_name" TEXT NOT NULL,
-                                "hq_address" VARCHAR(150),
-                                "hq_city" VARCHAR(150),
-                                "hq_state" CHAR(2),
-                                "hq_zip_code" CHAR(5),
-                                "hospital_type" VARCHAR(150),
-                                "latitude" REAL,
-                                "longtitude" REAL,
-                                PRIMARY KEY (hosp_sk)
-                                )
-                                SORTKEY (state_name)
-                            """)
-
-                cur.execute("""
-                            CREATE TABLE IF NOT EXISTS "dim_region" (
-                                "region_SK" INTEGER IDENTITY(1,1),
-                                "fips" VARCHAR(6) NOT NULL,
-                                "state_fips" VARCHAR(2) NOT NULL,
-                                "county_fips" VARCHAR(3) NOT NULL,
-                                "state" VARCHAR(30) NOT NULL,
-                                "county" VARCHAR(120),
-                                "country" VARCHAR(20),
-                                "latitude" REAL,
-                                "longitude" REAL,
-                                PRIMARY KEY (region_SK)
-                                )
-                                SORTKEY (state)
-                            """)
-
-                cur.execute("""
-                            CREATE TABLE IF NOT EXISTS "fact_covid" (
-                                "date" INTEGER,
-                                "state_fips" VARCHAR(3) NOT NULL,
-                                "state" VARCHAR(30) NOT NULL,
-                                "positive" REAL,
-                                "positiveincrease" INTEGER,
-                                "negative" REAL,
-                                "death" REAL,
-                                "deathincrease" INTEGER,
-                                "recovered" REAL,
-                                "hospitalized" REAL,
-                                "hospitalizedcurrently" REAL,
-                                "hospitalizeddischarged" REAL,
-                                "hospitalizedcumulative" REAL,
-                                "hospitalizedincrease" INTEGER,
-                                "region_sk" INTEGER,
-                                "hosp_sk" INTEGER,
-                                PRIMARY KEY (date, state_fips),
-                                FOREIGN KEY (date) REFERENCES dim_date (date_id),
-                                FOREIGN KEY (region_sk) REFERENCES dim_region (region_sk),
-                                FOREIGN KEY (hosp_sk) REFERENCES dim_hospital (hosp_sk)
-                                )
-                                SORTKEY (date, state)
-                            """)
-
-                # Load data from S3 Bucket
-                cur.execute("""
-                            copy dim_date from 's3://{S3_BUCKET_NAME}/output/dim_date.csv'
-                            credentials 'aws_iam_role={redshift_roleArn}'
-                            region '{AWS_REGION_NAME}'
-                            delimiter ','
-                            IGNOREHEADER 1
-                            COMPUPDATE OFF
-                        """)
-
-                cur.execute("""
-                            copy dim_region from 's3://{S3_BUCKET_NAME}/output/dim_region.csv'
-                            credentials 'aws_iam_role={redshift_roleArn}'
-                            region '{AWS_REGION_NAME}'
-                            delimiter ','
-                            explicit_ids
-                            IGNOREHEADER 1
-                            COMPUPDATE OFF
-                        """)
-
-                cur.execute("""
-                            copy dim_hospital from 's3://{S3_BUCKET_NAME}/output/dim_hospital.csv'
-                            credentials 'aws_iam_role={redshift_roleArn}'
-                            region '{AWS_REGION_NAME}'
-                            delimiter ','
-                            explicit_ids
-                            IGNOREHEADER 1
-                            COMPUPDATE OFF
-                        """)
-
-                cur.execute("""
-                            copy fact_covid from 's3://{S3_BUCKET_NAME}/output/fact_covid.csv'
-                            credentials 'aws_iam_role={redshift_roleArn}'
-                            region '{AWS_REGION_NAME}'
-                            delimiter ','
-                            IGNOREHEADER 1
-                            COMPUPDATE OFF
-                        """)
-
-                # Create Views for Visualizations
-                # /* total by state positive, death, hospitalized */
-                cur.execute("""
-                            CREATE OR REPLACE VIEW state_totals (state, state_abv, total_positive_cases,
-                            total_deaths, avg_hospitalized) AS
-                                SELECT dr.state as state_name, fc.state, SUM(positive) as positive_cases,
-                                    SUM(death) as deaths, ROUND(AVG(hospitalizedcurrently), 0) avg_hospitalized
-                                FROM fact_covid fc
-                                    JOIN dim_region dr ON fc.region_sk = dr.region_sk
-                                GROUP BY dr.state, fc.state
-                                ORDER BY fc.state
-                        """)
-
-                # /* total US */
-                cur.execute("""
-                            CREATE OR REPLACE VIEW us_totals (postive_cases, deaths, begin_data, end_data) AS
-                                SELECT SUM(positive) as positive_cases, SUM(death) as deaths,
-                                MIN(date) as From, MAX(date) as To
-                                FROM fact_covid
-                        """)
-                # /* Daily */
-                cur.execute("""
-                            CREATE OR REPLACE VIEW state_daily (
-                                date, state, state_abv, positive, pos_increase,
-                                negative, deaths, death_increase, recovered, hospitalized, hosp_currently,
-                                hosp_increase, lattitude, longitude) AS
-                                SELECT dd.date, dr.state as state_name, fc.state, fc.positive, fc.positiveincrease,
-                                        fc.negative, fc.death, fc.deathincrease, fc.recovered, fc.hospitalized,
-                                        fc.hospitalizedcurrently, fc.hospitalizedincrease,
-                                        min(dr.latitude) as latitude, min(dr.longitude) as longitude
-                                FROM fact_covid fc
-                                JOIN dim_date dd ON fc.date = dd.date_id
-                                JOIN dim_region dr ON fc.region_sk = dr.region_sk
-                                GROUP BY dd.date, dr.state , fc.state, fc.positive, fc.positiveincrease,
-                                        negative, death, deathincrease, recovered, hospitalized, hospitalizedcurrently,
-                                        hospitalizedincrease
-                                ORDER BY dd.date, fc.state
-                        """)
-
-                cur.close()
-                conn.close()
-                ''')
-    )
+def describe_cluster(client=redshift_client):
+    """The DWH cluster, None when it does not exist"""
+    try:
+        return client.describe_clusters(ClusterIdentifier=DWH_CLUSTER_IDENTIFIER)['Clusters'][0]
+    except client.exceptions.ClusterNotFoundFault:
+        return None
 
-# Upload shema and data transfer script to S3
-upload_local_file('create_rs_tables.py', S3_BUCKET_NAME, S3_SCRIPTS_DIR)
-
-# Create Glue Job
-etl_job = glue_client.create_job(Name='s3RedShiftGlue',
-                                 Role=GLUE_IAM_ROLE,
-                                 Command={
-                                     'Name': 'pythonshell',
-                                     'ScriptLocation': f"s3://{S3_BUCKET_NAME}/{S3_SCRIPTS_DIR}create_rs_tables.py",
-                                     'PythonVersion': '3.9'
-                                 },
-                                 DefaultArguments={'--extra-py-files': cleandoc(f"""
-                                        s3://{S3_BUCKET_NAME}/{EXT_PKG_DIR}awscli-1.27.23-py3-none-any.whl,
-                                        s3://{S3_BUCKET_NAME}/{EXT_PKG_DIR}botocore-1.29.23-py3-none-any.whl,
-                                        s3://{S3_BUCKET_NAME}/{EXT_PKG_DIR}redshift_connector-2.0.909-py3-none-any.whl,
-                                        s3://{S3_BUCKET_NAME}/{EXT_PKG_DIR}boto3-1.26.23-py3-none-any.whl,
-                                        s3://{S3_BUCKET_NAME}/{EXT_PKG_DIR}s3transfer-0.6.0-py3-none-any.whl
-                                        """)
-                                                   }
-                                 )
-
-# Run Glue Job
-run_id = glue_client.start_job_run(JobName=GLUE_ETL_JOB)
-
-# Estabish DWH Connection
-conn = redshift_connector.connect(
-    host=DWH_ENDPOINT,
-    database=DWH_DB,
-    user=DWH_DB_USER,
-    password=DWH_DB_PASSWORD,
-)
 
-conn.autocommit = True
-cur = conn.cursor()
-
-# Exract data for visualization
-# US Totals
-cur.execute(f"""
-            UNLOAD
-            ('SELECT * FROM covid_dw.public.us_totals')
-            TO 's3://hernanjs-covid19-de/queries/us_totals'
-            CREDENTIALS 'aws_iam_role={redshift_roleArn}'
-            REGION '{AWS_REGION_NAME}'
-            DELIMITER AS ','
-            HEADER
-            ADDQUOTES
-            NULL AS ''
-            PARALLEL OFF
-            """
-            )
-# State Totals
-cur.execute(f"""
-            UNLOAD
-            ('SELECT * FROM covid_dw.public.state_totals')
-            TO 's3://hernanjs-covid19-de/queries/state_totals'
-            CREDENTIALS 'aws_iam_role={redshift_roleArn}'
-            REGION '{AWS_REGION_NAME}'
-            DELIMITER AS ','
-            HEADER
-            ADDQUOTES
-            NULL AS ''
-            PARALLEL OFF
-            """
-            )
-# Daily State
-cur.execute(f"""
-            UNLOAD
-            ('SELECT * FROM covid_dw.public.states_daily')
-            TO 's3://hernanjs-covid19-de/queries/states_daily'
-            CREDENTIALS 'aws_iam_role={redshift_roleArn}'
-            REGION '{AWS_REGION_NAME}'
-            DELIMITER AS ','
-            HEADER
-            ADDQUOTES
-            NULL AS ''
-            PARALLEL OFF
-            """
+def latest_snapshot(client=redshift_client):
+    """Newest available final snapshot of the DWH cluster, None when there is none"""
+    snapshots = [snapshot for snapshot in client.describe_cluster_snapshots(
+                     ClusterIdentifier=DWH_CLUSTER_IDENTIFIER, SnapshotType='manual')['Snapshots']
+                 if snapshot['SnapshotIdentifier'].startswith(DWH_SNAPSHOT_PREFIX)
+                 and snapshot['Status'] == 'available']
+    if not snapshots:
+        return None
+    return max(snapshots, key=lambda snapshot: snapshot['SnapshotCreateTime'])
+
+
+def wait_for_cluster(client=redshift_client, base_delay=10.0, max_delay=60.0):
+    """Wait until the cluster is available with an endpoint, resuming it if it is paused
+
+    :return: cluster description
+    """
+    with spans.span("wait_for_cluster") as s:
+        delay = base_delay
+        # The cluster keeps reporting paused for a while after the resume
+        # request, asking again then fails with InvalidClusterStateFault
+        resumed = False
+        while True:
+            cluster = client.describe_clusters(ClusterIdentifier=DWH_CLUSTER_IDENTIFIER)['Clusters'][0]
+            if cluster['ClusterStatus'] == 'available' and 'Endpoint' in cluster:
+                s.done = f"{DWH_CLUSTER_IDENTIFIER} is {cluster['ClusterAvailabilityStatus']}."
+                return cluster
+            if cluster['ClusterStatus'] == 'deleting':
+                raise RuntimeError(f"{DWH_CLUSTER_IDENTIFIER} is being deleted")
+            if cluster['ClusterStatus'] == 'paused' and not resumed:
+                print(f"Resuming Redshift Cluster {DWH_CLUSTER_IDENTIFIER}...")
+                client.resume_cluster(ClusterIdentifier=DWH_CLUSTER_IDENTIFIER)
+                resumed = True
+            time.sleep(delay)
+            delay = min(delay * 2, max_delay)
+
+
+def wait_for_cluster_deleted(client=redshift_client, base_delay=10.0, max_delay=60.0):
+    """Wait until a cluster that is being deleted is gone"""
+    with spans.span("wait_for_cluster_deleted", f"{DWH_CLUSTER_IDENTIFIER} deleted."):
+        delay = base_delay
+        while describe_cluster(client) is not None:
+            time.sleep(delay)
+            delay = min(delay * 2, max_delay)
+
+
+def start_cluster(role_arn, client=redshift_client):
+    """Reuse the DWH cluster, restore it from its last final snapshot, or create it
+
+    A cluster the last run is still deleting cannot be reused, it is
+    waited for so its final snapshot can be restored or a new one created.
+    """
+    cluster = describe_cluster(client)
+    if cluster is not None and cluster['ClusterStatus'] == 'deleting':
+        print(f"Redshift Cluster {DWH_CLUSTER_IDENTIFIER} is still being deleted, waiting for it...")
+        wait_for_cluster_deleted(client)
+        cluster = None
+    if cluster is not None:
+        print(f"Redshift Cluster {DWH_CLUSTER_IDENTIFIER} is {cluster['ClusterStatus']}, reusing it...")
+        return wait_for_cluster(client)
+    snapshot = latest_snapshot(client) if DWH_LIFECYCLE == "snapshot" else None
+    if snapshot is not None:
+        print(f"Restoring Redshift Cluster {DWH_CLUSTER_IDENTIFIER} from {snapshot['SnapshotIdentifier']}...")
+        client.restore_from_cluster_snapshot(
+            ClusterIdentifier=DWH_CLUSTER_IDENTIFIER,
+            SnapshotIdentifier=snapshot['SnapshotIdentifier'],
+            NodeType=DWH_NODE_TYPE,
+            NumberOfNodes=int(DWH_NUM_NODES),
+            IamRoles=[role_arn],
+        )
+    else:
+        print(f"Creating Redshift Cluster {DWH_CLUSTER_IDENTIFIER}...")
+        client.create_cluster(
+            # add parameters for hardware
+            ClusterType=DWH_CLUSTER_TYPE,
+            NodeType=DWH_NODE_TYPE,
+            NumberOfNodes=int(DWH_NUM_NODES),
+            # add parameters for identifiers & credentials
+            DBName=DWH_DB,
+            ClusterIdentifier=DWH_CLUSTER_IDENTIFIER,
+            MasterUsername=DWH_DB_USER,
+            MasterUserPassword=DWH_DB_PASSWORD,
+            # add parameter for role (to allow s3 access)
+            IamRoles=[role_arn]
+        )
+    return wait_for_cluster(client)
+
+
+def release_cluster(client=redshift_client):
+    """Delete or pause the cluster at the end of a run as DWH_LIFECYCLE says"""
+    if DWH_LIFECYCLE == "pause":
+        print(f"Pausing Redshift Cluster {DWH_CLUSTER_IDENTIFIER}...")
+        client.pause_cluster(ClusterIdentifier=DWH_CLUSTER_IDENTIFIER)
+    elif DWH_LIFECYCLE == "snapshot":
+        # Only the newest snapshot is kept next to the one taken now
+        previous = latest_snapshot(client)
+        for snapshot in client.describe_cluster_snapshots(
+                ClusterIdentifier=DWH_CLUSTER_IDENTIFIER, SnapshotType='manual')['Snapshots']:
+            if (snapshot['SnapshotIdentifier'].startswith(DWH_SNAPSHOT_PREFIX) and previous is not None
+                    and snapshot['SnapshotIdentifier'] != previous['SnapshotIdentifier']):
+                client.delete_cluster_snapshot(SnapshotIdentifier=snapshot['SnapshotIdentifier'])
+        final_snapshot = f"{DWH_SNAPSHOT_PREFIX}-{time.strftime('%Y%m%d%H%M%S')}"
+        print(f"Deleting Redshift Cluster {DWH_CLUSTER_IDENTIFIER}, keeping snapshot {final_snapshot}...")
+        client.delete_cluster(ClusterIdentifier=DWH_CLUSTER_IDENTIFIER, SkipFinalClusterSnapshot=False,
+                              FinalClusterSnapshotIdentifier=final_snapshot)
+    else:
+        client.delete_cluster(ClusterIdentifier=DWH_CLUSTER_IDENTIFIER, SkipFinalClusterSnapshot=True)
+
+
+def provision_cluster(state):
+    with spans.span("start_cluster", f"{DWH_CLUSTER_IDENTIFIER} Build COMPLETE."):
+        myClusterProps = start_cluster(state["redshift_role_arn"])
+    print(prettyRedshiftProps(myClusterProps).to_string(index=False))
+
+    # Create Security group for Cluster
+    try:
+        print("Creating Security Group for Redshift Cluster...")
+        with spans.span("security_group",
+                        f"{myClusterProps['VpcSecurityGroups'][-1]['VpcSecurityGroupId']} updated."):
+            vpc = ec2_resource.Vpc(id=myClusterProps['VpcId'])
+            defaultSg = list(vpc.security_groups.all())[-1]
+
+            defaultSg.authorize_ingress(
+                GroupName=defaultSg.group_name,
+                CidrIp='0.0.0.0/0',
+                IpProtocol='TCP',
+                FromPort=int(DWH_PORT),
+                ToPort=int(DWH_PORT)
             )
+    except Exception as e:
+        print(e)
+    # ADD NEW DWH VARIABLES
+    return {"dwh_endpoint": myClusterProps['Endpoint']['Address'], "dwh_vpc_id": myClusterProps['VpcId']}
+
+
+def wait_for_job_run(client, job_name, run_id, base_delay=5.0, max_delay=60.0):
+    """Wait for a Glue job run with exponential backoff, raises if it does not succeed"""
+    with spans.span("wait_for_job_run", f"{job_name} run COMPLETE.", job=job_name):
+        delay = base_delay
+        while True:
+            run = client.get_job_run(JobName=job_name, RunId=run_id)['JobRun']
+            if run['JobRunState'] == 'SUCCEEDED':
+                return run
+            if run['JobRunState'] in ('FAILED', 'STOPPED', 'TIMEOUT', 'ERROR'):
+                raise RuntimeError(f"{job_name} run {run['JobRunState']}: {run.get('ErrorMessage', '')}")
+            time.sleep(delay)
+            delay = min(delay * 2, max_delay)
+
+
+def build_load_statements(state):
+    """DDL, COPY/MERGE, rollup and view statements of one warehouse load"""
+    # CTAS always writes Parquet
+    copy_format = "parquet" if TRANSFORM_ENGINE == "athena" else OUTPUT_FORMAT
+    copy_options = dwh_output.copy_format_options(copy_format, COPY_COMPRESSION, manifest=True)
+    # Generated DDL where the pandas engine produced it, the static DDL otherwise
+    table_ddl = state.get("table_ddl", {})
+    load_statements = [table_ddl.get(table, ddl) for table, ddl in dwh_sql.TABLE_DDL.items()]
+    load_statements += list(dwh_sql.ROLLUP_DDL.values())
+    # dim_region and dim_hospital are replaced on every run,
+    # dim_date only gets the dates it is missing, even when the
+    # transform could not tell which dates were loaded
+    for table in ['dim_region', 'dim_hospital']:
+        load_statements += dwh_sql.replace_statements(
+            table, f"s3://{S3_BUCKET_NAME}/{S3_OUTPUT_DIR}{table}.manifest",
+            state["redshift_role_arn"], AWS_REGION_NAME, copy_options)
+    if state["new_dates"]:
+        load_statements += dwh_sql.append_statements(
+            'dim_date', dwh_sql.DIM_DATE_KEY, f"s3://{S3_BUCKET_NAME}/{S3_OUTPUT_DIR}dim_date.manifest",
+            state["redshift_role_arn"], AWS_REGION_NAME, copy_options)
+    fact_manifest_url = f"s3://{S3_BUCKET_NAME}/{S3_OUTPUT_DIR}fact_covid.manifest"
+    if state["fact_watermark"] is None:
+        load_statements += dwh_sql.replace_statements(
+            'fact_covid', fact_manifest_url, state["redshift_role_arn"], AWS_REGION_NAME, copy_options)
+    else:
+        load_statements += dwh_sql.merge_statements(
+            'fact_covid', dwh_sql.FACT_KEY, dwh_sql.FACT_COLUMNS, fact_manifest_url,
+            state["redshift_role_arn"], AWS_REGION_NAME, copy_options)
+    # The dashboard views read rollups refreshed for the days just loaded
+    load_statements += dwh_sql.rollup_statements(
+        state["fact_cutoff"] if state["fact_watermark"] is not None else None)
+    load_statements += dwh_sql.VIEW_SQL
+    return load_statements
 
-cur.close()
-conn.close()
 
-download_to_local(S3_BUCKET_NAME, "queries/state_daily000", "output/state_daily.csv")
-download_to_local(S3_BUCKET_NAME, "queries/state_totals000", "output/state_totals.csv")
-download_to_local(S3_BUCKET_NAME, "queries/us_totals000", "output/us_totals.csv")
+def wait_for_statement(statement_id, client=redshift_data_client, base_delay=1.0, max_delay=30.0):
+    """Poll a Redshift Data API statement with backoff until it finishes
 
-# Resource Cleanup
-# Glue
-for crawler in crawlers:
-    print(f"Deleting {crawler}...")
-    glue_client.delete_crawler(Name=crawler)
+    :return: statement description
+    """
+    delay = base_delay
+    while True:
+        statement = client.describe_statement(Id=statement_id)
+        if statement['Status'] == 'FINISHED':
+            return statement
+        if statement['Status'] in ('FAILED', 'ABORTED'):
+            raise RuntimeError(f"{statement.get('StatementName', statement_id)} {statement['Status']}: "
+                               f"{statement.get('Error', '')}")
+        time.sleep(delay)
+        delay = min(delay * 2, max_delay)
+
+
+def run_data_api_load(load_statements, client=redshift_data_client):
+    """Run the load as one batch through the Redshift Data API and wait for it
+
+    The batch runs as a single transaction, so a failed COPY leaves the
+    warehouse as it was.
+
+    :return: statement description
+    """
+    print(f"Running {len(load_statements)} load statements through the Redshift Data API...")
+    with spans.span("data_api_load", "Warehouse load COMPLETE.", statements=len(load_statements)) as s:
+        batch_id = client.batch_execute_statement(
+            ClusterIdentifier=DWH_CLUSTER_IDENTIFIER,
+            Database=DWH_DB,
+            DbUser=DWH_DB_USER,
+            Sqls=load_statements,
+            StatementName="covid_dw_load",
+        )['Id']
+        statement = wait_for_statement(batch_id, client)
+        for sub in statement.get('SubStatements', []):
+            s.add(rows_out=max(sub.get('ResultRows', 0), 0))
+            print(f"    {' '.join(sub['QueryString'].split())[:60] : <60} "
+                  f"{round(sub.get('Duration', 0) / 1e9, 2) : >8}s  {sub.get('ResultRows', 0) : >10} rows")
+    return statement
+
+
+def run_glue_load(state, load_statements):
+    """Run the load from a Glue python shell job and wait for it"""
+    # Create Glue-Redshift job script
+    with open('create_rs_tables.py', 'w') as f:
+        f.write(
+            cleandoc(f'''
+                    import sys
+                    sys.path.insert(0, '/glue/lib/installation')
+                    keys = [k for k in sys.modules.keys() if 'boto' in k]
+                    for k in keys:
+                        del sys.modules[k]
+
+                    import awscli
+                    import s3transfer
+                    import redshift_connector
+
+                    # Estabish DWH Connection
+                    conn = redshift_connector.connect(
+                       host='{state["dwh_endpoint"]}',
+                       database='{DWH_DB}',
+                       user='{DWH_DB_USER}',
+                       password='{DWH_DB_PASSWORD}',
+                    )
+
+                    conn.autocommit = True
+                    cur = conn.cursor()
+                    ''')
+        )
+        # Create DWH Tables, load data from S3 bucket and create views
+        f.write(f"\n\nstatements = {json.dumps(load_statements, indent=4)}\n\n"
+                "for sql in statements:\n"
+                "    cur.execute(sql)\n\n"
+                "cur.close()\n"
+                "conn.close()\n")
+
+    # Upload shema and data transfer script to S3
+    upload_local_file('create_rs_tables.py', S3_BUCKET_NAME, S3_SCRIPTS_DIR)
+
+    # Create Glue Job, an existing job is pointed at the current wheels
+    job = {
+        'Role': GLUE_IAM_ROLE,
+        'Command': {
+            'Name': 'pythonshell',
+            'ScriptLocation': f"s3://{S3_BUCKET_NAME}/{S3_SCRIPTS_DIR}create_rs_tables.py",
+            'PythonVersion': '3.9'
+        },
+        'DefaultArguments': {'--extra-py-files': ",".join(f"s3://{S3_BUCKET_NAME}/{key}"
+                                                          for key in state['wheel_keys'])},
+    }
+    try:
+        glue_client.create_job(Name='s3RedShiftGlue', **job)
+    except glue_client.exceptions.AlreadyExistsException:
+        print("Glue job s3RedShiftGlue already exists, updating it...")
+        glue_client.update_job(JobName='s3RedShiftGlue', JobUpdate=job)
 
-glue_client.delete_database(Name=GLUE_DB)
-glue_client.delete_job(JobName=GLUE_ETL_JOB)
-# Redshift
-redshift_client.delete_cluster(ClusterIdentifier=DWH_CLUSTER_IDENTIFIER, SkipFinalClusterSnapshot=True)
+    # Run Glue Job, the views are only there once it has finished
+    run_id = glue_client.start_job_run(JobName=GLUE_ETL_JOB)['JobRunId']
+    wait_for_job_run(glue_client, GLUE_ETL_JOB, run_id)
+    return run_id
+
+
+def load_warehouse(state):
+    load_statements = build_load_statements(state)
+    if LOAD_METHOD == "glue":
+        return {"job_run_id": run_glue_load(state, load_statements)}
+    return {"load_statement_id": run_data_api_load(load_statements)['Id']}
+
+
+def export_views(state):
+    """UNLOAD the dashboard views and rebuild the output/ files from the parts
+
+    The views are unloaded at the same time through the Data API, each
+    by every slice of the cluster unless EXPORT_PARALLEL is off.
+    """
+    with spans.span("unload_views"):
+        statement_ids = {
+            view: redshift_data_client.execute_statement(
+                ClusterIdentifier=DWH_CLUSTER_IDENTIFIER,
+                Database=DWH_DB,
+                DbUser=DWH_DB_USER,
+                Sql=view_export.unload_sql(view, DWH_DB, f"s3://{S3_BUCKET_NAME}/{S3_EXPORT_DIR}{view}/part_",
+                                           state["redshift_role_arn"], AWS_REGION_NAME, EXPORT_FORMAT,
+                                           EXPORT_PARALLEL),
+                StatementName=f"covid_dw_unload_{view}",
+            )['Id']
+            for view in view_export.EXPORT_VIEWS
+        }
+        for view, statement_id in statement_ids.items():
+            statement = wait_for_statement(statement_id)
+            print(f"{view} unloaded. {statement.get('ResultRows', 0)} rows.")
+
+    with spans.span("download_views", "View export COMPLETE.") as s:
+        for view, order_by in view_export.EXPORT_VIEWS.items():
+            rows = view_export.export_view(s3_client, S3_BUCKET_NAME, f"{S3_EXPORT_DIR}{view}/part_manifest",
+                                           f"output/{view}.csv", EXPORT_FORMAT, order_by, EXPORT_DOWNLOAD_WORKERS)
+            s.add(rows_out=rows)
+            print(f"output/{view}.csv written. {rows} rows.")
+
+
+def cleanup(state):
+    # Resource Cleanup
+    # Glue
+    if not GLUE_KEEP_CATALOG:
+        for crawler in state["crawlers"]:
+            print(f"Deleting {crawler}...")
+            glue_client.delete_crawler(Name=crawler)
+
+        glue_client.delete_database(Name=GLUE_DB)
+    if LOAD_METHOD == "glue":
+        glue_client.delete_job(JobName=GLUE_ETL_JOB)
+    # Redshift
+    release_cluster()
+
+
+# Stages and the stages they need. Cluster provisioning, and the wheel
+# uploads for the Glue loader, run alongside ingest, crawl and transform
+load_deps = ["transform", "cluster"] + (["wheels"] if LOAD_METHOD == "glue" else [])
+pipeline_tasks = [
+    pipeline.Task("iam", create_iam_roles),
+    pipeline.Task("bucket", create_bucket_folders),
+    pipeline.Task("ingest", ingest_sources, ["bucket"]),
+    pipeline.Task("crawl", crawl_sources, ["iam", "ingest"]),
+    # A kept cluster holds the watermarks the transforms read
+    pipeline.Task("transform", transform_tables, ["crawl"] + (["cluster"] if DWH_LIFECYCLE != "delete" else [])),
+    pipeline.Task("cluster", provision_cluster, ["iam"]),
+    pipeline.Task("load", load_warehouse, load_deps),
+    pipeline.Task("export", export_views, ["load"]),
+    pipeline.Task("cleanup", cleanup, ["export"]),
+]
+# The Glue job is the only user of the wheels
+if LOAD_METHOD == "glue":
+    pipeline_tasks.append(pipeline.Task("wheels", upload_glue_wheels, ["bucket"]))
+
+if __name__ == "__main__":
+    spans.configure(METRICS_DIR)
+    try:
+        pipeline.Pipeline(pipeline_tasks, PIPELINE_CHECKPOINT, resume=PIPELINE_RESUME,
+                          max_workers=PIPELINE_MAX_WORKERS).run()
+    finally:
+        if METRICS_DIR:
+            spans.write_prometheus(f"{METRICS_DIR}covid_pipeline.prom")
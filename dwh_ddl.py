@@ -0,0 +1,149 @@
+# Redshift DDL generated from the final warehouse DataFrames. Column
+# types, compression encodings and the distribution style are chosen
+# from the stats of the data about to be loaded
+import math
+
+import pandas as pd
+
+# Keys and distribution hints per table. Sort keys follow the join and
+# filter paths of the load and the rollup refresh in dwh_sql
+TABLE_LAYOUT = {
+    "dim_date": {"primary_key": ["date_id"], "sortkey": ["date_id"]},
+    "dim_hospital": {"primary_key": ["hosp_sk"], "sortkey": ["hosp_sk"]},
+    "dim_region": {"primary_key": ["region_sk"], "sortkey": ["region_sk"],
+                   "rename": {"province_state": "state", "country_region": "country"}},
+    "fact_covid": {"primary_key": ["date", "state_fips"], "sortkey": ["date", "state_fips"],
+                   "distkey": "state_fips",
+                   "foreign_keys": {"date": ("dim_date", "date_id"),
+                                    "region_sk": ("dim_region", "region_sk"),
+                                    "hosp_sk": ("dim_hospital", "hosp_sk")}},
+}
+
+# Tables up to this many rows are copied to every node
+DISTSTYLE_ALL_MAX_ROWS = 1_000_000
+# A distribution key needs enough distinct values to spread over the slices
+MIN_DISTKEY_CARDINALITY = 32
+# String columns with at most this many distinct values use a dictionary
+BYTEDICT_MAX_DISTINCT = 255
+
+# The tables are created once and then only loaded into, so column types
+# are sized from the data with headroom for later loads. Text gets the
+# next power of two above STRING_HEADROOM times its longest value and
+# integers the narrowest type that holds INT_HEADROOM times their largest
+# value. Keys only grow and a foreign key holds the keys of another
+# table, so key columns are at least INTEGER. Codes keep their fixed width
+STRING_HEADROOM = 2
+MIN_STRING_WIDTH = 16
+MAX_STRING_WIDTH = 65535
+INT_HEADROOM = 100
+CODE_WIDTHS = {"fips": 5, "state_fips": 2, "county_fips": 3}
+
+INT_TYPES = [(2, "SMALLINT"), (4, "INTEGER"), (8, "BIGINT")]
+
+
+def column_stats(col):
+    """Stats of one column the type and encoding are chosen from"""
+    values = col.dropna()
+    stats = {"rows": len(col), "distinct": int(values.nunique())}
+    if pd.api.types.is_bool_dtype(col):
+        stats["kind"] = "bool"
+    elif pd.api.types.is_integer_dtype(col):
+        stats.update(kind="int", bytes=col.dtype.itemsize,
+                     max_abs=int(values.abs().max()) if len(values) else None)
+    elif pd.api.types.is_float_dtype(col):
+        stats.update(kind="float", bytes=col.dtype.itemsize)
+    elif pd.api.types.is_datetime64_any_dtype(col):
+        stats["kind"] = "date" if (values == values.dt.normalize()).all() else "timestamp"
+    else:
+        widths = values.astype(str).str.encode("utf-8").str.len()
+        stats.update(kind="string", max_width=int(widths.max()) if len(widths) else 1)
+    return stats
+
+
+def int_type(max_abs, min_bytes=2):
+    """Narrowest integer type of at least min_bytes that holds INT_HEADROOM times max_abs"""
+    bound = max_abs * INT_HEADROOM
+    return next(name for nbytes, name in INT_TYPES
+                if nbytes >= min_bytes and (nbytes == 8 or bound < 2 ** (8 * nbytes - 1)))
+
+
+def string_width(max_width):
+    width = 2 ** math.ceil(math.log2(max(max_width * STRING_HEADROOM, MIN_STRING_WIDTH)))
+    return min(width, MAX_STRING_WIDTH)
+
+
+def column_type(name, stats, exact_ints=False, key=False):
+    """Redshift type of a column, sized from its stats with headroom for later loads
+
+    :param exact_ints: keep integer columns as wide as their dtype, Parquet
+        COPY needs the physical type to match
+    :param key: the column is a primary or foreign key
+    """
+    kind = stats["kind"]
+    if kind == "bool":
+        return "BOOLEAN"
+    if kind == "int":
+        if exact_ints:
+            return dict(INT_TYPES)[max(stats["bytes"], 2)]
+        return "BIGINT" if stats["max_abs"] is None else int_type(stats["max_abs"], 4 if key else 2)
+    if kind == "float":
+        return "REAL" if stats["bytes"] == 4 else "DOUBLE PRECISION"
+    if kind in ("date", "timestamp"):
+        return kind.upper()
+    if name in CODE_WIDTHS and stats["max_width"] <= CODE_WIDTHS[name]:
+        return f"CHAR({CODE_WIDTHS[name]})"
+    return f"VARCHAR({string_width(stats['max_width'])})"
+
+
+def column_encoding(stats, leading_sortkey=False):
+    """Compression encoding, the leading sort key is left RAW so range restricted scans can skip blocks"""
+    if leading_sortkey:
+        return "RAW"
+    if stats["kind"] in ("int", "date", "timestamp"):
+        return "AZ64"
+    if stats["kind"] == "string" and stats["distinct"] <= BYTEDICT_MAX_DISTINCT:
+        return "BYTEDICT"
+    return "ZSTD"
+
+
+def dist_style(stats, layout):
+    """DISTKEY when the hinted key spreads well, ALL for small tables, EVEN otherwise"""
+    distkey = layout.get("distkey")
+    if distkey and stats[distkey]["distinct"] >= MIN_DISTKEY_CARDINALITY:
+        return f"DISTKEY ({distkey})"
+    if next(iter(stats.values()))["rows"] <= DISTSTYLE_ALL_MAX_ROWS:
+        return "DISTSTYLE ALL"
+    return "DISTSTYLE EVEN"
+
+
+def table_ddl(name, df, exact_ints=False):
+    """CREATE TABLE statement for a warehouse table
+
+    :param name: table name, selects the layout in TABLE_LAYOUT
+    :param df: the table as it is written for COPY, columns in load order
+    :param exact_ints: see column_type
+    :return: DDL string
+    """
+    layout = TABLE_LAYOUT[name]
+    df = df.rename(columns=layout.get("rename", {}))
+    stats = {col: column_stats(df[col]) for col in df.columns}
+    keys = set(layout["primary_key"]) | set(layout["sortkey"]) | {layout.get("distkey")}
+    references = set(layout["primary_key"]) | set(layout.get("foreign_keys", {}))
+    lines = []
+    for col, col_stats in stats.items():
+        # A column without nulls today can get them in a later load
+        null = " NOT NULL" if col in keys else ""
+        encoding = column_encoding(col_stats, col == layout["sortkey"][0])
+        col_type = column_type(col, col_stats, exact_ints, col in references)
+        lines.append(f'"{col}" {col_type}{null} ENCODE {encoding}')
+    lines.append(f"PRIMARY KEY ({', '.join(layout['primary_key'])})")
+    for col, (table, ref) in layout.get("foreign_keys", {}).items():
+        lines.append(f"FOREIGN KEY ({col}) REFERENCES {table} ({ref})")
+    columns = ",\n            ".join(lines)
+    return f"""
+        CREATE TABLE IF NOT EXISTS "{name}" (
+            {columns}
+            )
+            {dist_style(stats, layout)}
+            SORTKEY ({', '.join(layout['sortkey'])})
+        """
@@ -0,0 +1,162 @@
+# Serializers for the warehouse tables that are written
+# to S3 and loaded into Redshift with COPY
+import gzip
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO, StringIO
+
+import numpy as np
+import pandas as pd
+
+OUTPUT_FORMATS = ("parquet", "csv")
+# Codecs COPY can read for text input, parquet compresses internally
+CSV_COMPRESSIONS = ("gzip", "zstd")
+
+# Slices per node, used to size the COPY input split
+NODE_SLICES = {
+    "dc2.large": 2, "dc2.8xlarge": 16,
+    "ds2.xlarge": 2, "ds2.8xlarge": 16,
+    "ra3.xlplus": 2, "ra3.4xlarge": 4, "ra3.16xlarge": 16,
+}
+
+# Column types matching the Redshift DDL. Parquet COPY maps
+# columns by position and physical type, so every table is
+# cast to these before it is written
+PARQUET_DTYPES = {
+    "fact_covid": {
+        "date": "int32", "state_fips": "string", "state": "string",
+        "positive": "float32", "positiveincrease": "int32", "negative": "float32",
+        "death": "float32", "deathincrease": "int32", "recovered": "float32",
+        "hospitalized": "float32", "hospitalizedcurrently": "float32",
+        "hospitalizeddischarged": "float32", "hospitalizedcumulative": "float32",
+        "hospitalizedincrease": "int32", "region_sk": "int32", "hosp_sk": "int32",
+    },
+    "dim_date": {
+        "date_id": "int32", "day_name": "string", "day_of_week": "int32", "day": "int32",
+        "day_of_year": "int32", "month": "int32", "month_name": "string", "week": "int32",
+        "quarter": "int32", "year": "int32", "year_half": "int32", "is_weekend": "bool",
+    },
+    "dim_hospital": {
+        "hosp_sk": "int32", "latitude": "float32", "longtitude": "float32",
+    },
+    "dim_region": {
+        "region_sk": "int32", "latitude": "float32", "longitude": "float32",
+    },
+}
+# DATE columns are written as parquet date32
+PARQUET_DATE_COLUMNS = {"dim_date": ["date"]}
+
+
+def file_extension(output_format, compression=None):
+    if output_format == "parquet":
+        return "parquet"
+    return {None: "csv", "gzip": "csv.gz", "zstd": "csv.zst"}[compression]
+
+
+def slice_count(node_type, num_nodes):
+    return NODE_SLICES.get(node_type, 1) * int(num_nodes)
+
+
+def compress(body, compression):
+    if compression == "gzip":
+        return gzip.compress(body, compresslevel=6)
+    if compression == "zstd":
+        try:
+            import zstandard
+        except ImportError as e:
+            raise ImportError("zstd compression requires the zstandard package") from e
+        return zstandard.ZstdCompressor().compress(body)
+    return body
+
+
+def to_csv_bytes(df, ind=False, compression=None):
+    buffer = StringIO()
+    df.to_csv(buffer, index=ind)
+    return compress(buffer.getvalue().encode(), compression)
+
+
+def to_parquet_bytes(df, name, ind=False, compression="snappy"):
+    """Serialize a warehouse table to typed, compressed parquet
+
+    :param df: DataFrame to serialize
+    :param name: Warehouse table name, selects the column types
+    :param ind: Write the index as a column
+    :param compression: Parquet codec
+    :return: parquet file as bytes
+    """
+    df = df.astype(PARQUET_DTYPES.get(name, {}))
+    for col in PARQUET_DATE_COLUMNS.get(name, []):
+        df[col] = pd.to_datetime(df[col]).dt.date
+    buffer = BytesIO()
+    df.to_parquet(buffer, engine="pyarrow", index=ind, compression=compression)
+    return buffer.getvalue()
+
+
+def serialize(df, name, output_format, ind=False, compression=None):
+    if output_format == "parquet":
+        return to_parquet_bytes(df, name, ind)
+    return to_csv_bytes(df, ind, compression)
+
+
+def split_frame(df, parts):
+    """Split a table into at most `parts` contiguous, similar sized row ranges"""
+    bounds = np.linspace(0, len(df), max(min(parts, len(df)), 1) + 1).astype(int)
+    return [df.iloc[start:stop] for start, stop in zip(bounds[:-1], bounds[1:])]
+
+
+def serialize_parts(df, name, parts, output_format, ind=False, compression=None):
+    """Serialize a table as up to `parts` files, see split_frame"""
+    return [serialize(part, name, output_format, ind, compression) for part in split_frame(df, parts)]
+
+
+def put_parts(client, bodies, name, bucket, output_loc, ext):
+    """Upload the parts of a table concurrently and write their COPY manifest
+
+    :return: S3 key of the manifest
+    """
+    keys = [f"{output_loc}{name}/part-{i:04d}.{ext}" for i in range(len(bodies))]
+    with ThreadPoolExecutor(max_workers=len(keys)) as pool:
+        list(pool.map(lambda key, body: client.put_object(Bucket=bucket, Key=key, Body=body), keys, bodies))
+    manifest_key = f"{output_loc}{name}.manifest"
+    client.put_object(Bucket=bucket, Key=manifest_key, Body=build_manifest(
+        [(f"s3://{bucket}/{key}", len(body)) for key, body in zip(keys, bodies)]))
+    return manifest_key
+
+
+def write_parts(bodies, name, directory, ext):
+    """Write the parts of a table to a local directory, laid out like put_parts
+
+    :return: path of the manifest
+    """
+    os.makedirs(os.path.join(directory, name), exist_ok=True)
+    paths = [os.path.join(directory, name, f"part-{i:04d}.{ext}") for i in range(len(bodies))]
+    for path, body in zip(paths, bodies):
+        with open(path, "wb") as f:
+            f.write(body)
+    manifest_path = os.path.join(directory, f"{name}.manifest")
+    with open(manifest_path, "w") as f:
+        f.write(build_manifest([(path, len(body)) for path, body in zip(paths, bodies)]))
+    return manifest_path
+
+
+def build_manifest(entries):
+    """COPY manifest for a list of (s3 url, content length) pairs
+
+    content_length is required by COPY for parquet input and is
+    harmless for text input.
+    """
+    return json.dumps({"entries": [{"url": url, "mandatory": True, "meta": {"content_length": length}}
+                                   for url, length in entries]}, indent=2)
+
+
+def copy_format_options(output_format, compression=None, manifest=False):
+    """COPY options that describe how the table files are laid out"""
+    options = ["MANIFEST"] if manifest else []
+    if output_format == "parquet":
+        options.append("FORMAT AS PARQUET")
+    else:
+        options.append("delimiter ',' IGNOREHEADER 1")
+        if compression:
+            options.append(compression.upper())
+    return " ".join(options)
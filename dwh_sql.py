@@ -0,0 +1,264 @@
+# SQL run against the Redshift warehouse by the load script
+
+# Static DDL, used for the tables dwh_ddl has no DataFrame to generate it from
+
+TABLE_DDL = {
+    "dim_date": """
+        CREATE TABLE IF NOT EXISTS "dim_date" (
+            "date_id" INTEGER,
+            "date" DATE NOT NULL,
+            "day_name" VARCHAR(9) NOT NULL,
+            "day_of_week" INTEGER NOT NULL,
+            "day" INTEGER NOT NULL,
+            "day_of_year" INTEGER NOT NULL,
+            "month" INTEGER NOT NULL,
+            "month_name" VARCHAR(10) NOT NULL,
+            "week" INTEGER NOT NULL,
+            "quarter" INTEGER NOT NULL,
+            "year" INTEGER NOT NULL,
+            "year_half" INTEGER NOT NULL,
+            "is_weekend" BOOLEAN NOT NULL,
+            PRIMARY KEY (date_id)
+            )
+            DISTSTYLE ALL
+            SORTKEY (date_id)
+        """,
+    "dim_hospital": """
+        CREATE TABLE IF NOT EXISTS "dim_hospital" (
+            "hosp_sk" INTEGER NOT NULL,
+            "fips" VARCHAR(6) NOT NULL,
+            "state_fips" VARCHAR(2) NOT NULL,
+            "county_fips" VARCHAR(3) NOT NULL,
+            "state_name" VARCHAR(30) NOT NULL,
+            "county_name" VARCHAR(120),
+            "hospital_name" TEXT NOT NULL,
+            "hq_address" VARCHAR(150),
+            "hq_city" VARCHAR(150),
+            "hq_state" CHAR(2),
+            "hq_zip_code" CHAR(5),
+            "hospital_type" VARCHAR(150),
+            "latitude" REAL,
+            "longtitude" REAL,
+            PRIMARY KEY (hosp_sk)
+            )
+            DISTSTYLE ALL
+            SORTKEY (hosp_sk)
+        """,
+    "dim_region": """
+        CREATE TABLE IF NOT EXISTS "dim_region" (
+            "region_SK" INTEGER NOT NULL,
+            "fips" VARCHAR(6) NOT NULL,
+            "state_fips" VARCHAR(2) NOT NULL,
+            "county_fips" VARCHAR(3) NOT NULL,
+            "state" VARCHAR(30) NOT NULL,
+            "county" VARCHAR(120),
+            "country" VARCHAR(20),
+            "latitude" REAL,
+            "longitude" REAL,
+            PRIMARY KEY (region_SK)
+            )
+            DISTSTYLE ALL
+            SORTKEY (region_SK)
+        """,
+    "fact_covid": """
+        CREATE TABLE IF NOT EXISTS "fact_covid" (
+            "date" INTEGER,
+            "state_fips" VARCHAR(3) NOT NULL,
+            "state" VARCHAR(30) NOT NULL,
+            "positive" REAL,
+            "positiveincrease" INTEGER,
+            "negative" REAL,
+            "death" REAL,
+            "deathincrease" INTEGER,
+            "recovered" REAL,
+            "hospitalized" REAL,
+            "hospitalizedcurrently" REAL,
+            "hospitalizeddischarged" REAL,
+            "hospitalizedcumulative" REAL,
+            "hospitalizedincrease" INTEGER,
+            "region_sk" INTEGER,
+            "hosp_sk" INTEGER,
+            PRIMARY KEY (date, state_fips),
+            FOREIGN KEY (date) REFERENCES dim_date (date_id),
+            FOREIGN KEY (region_sk) REFERENCES dim_region (region_sk),
+            FOREIGN KEY (hosp_sk) REFERENCES dim_hospital (hosp_sk)
+            )
+            DISTKEY (state_fips)
+            SORTKEY (date, state_fips)
+        """,
+}
+
+# Column order of fact_covid, matches the DDL and the uploaded files
+FACT_COLUMNS = ["date", "state_fips", "state", "positive", "positiveincrease", "negative",
+                "death", "deathincrease", "recovered", "hospitalized", "hospitalizedcurrently",
+                "hospitalizeddischarged", "hospitalizedcumulative", "hospitalizedincrease",
+                "region_sk", "hosp_sk"]
+FACT_KEY = ["date", "state_fips"]
+DIM_DATE_KEY = ["date_id"]
+
+# Rollup tables the dashboard views read from. They are refreshed in the
+# load transaction, so reads never join or aggregate fact_covid
+ROLLUP_DDL = {
+    "agg_state_daily": """
+        CREATE TABLE IF NOT EXISTS "agg_state_daily" (
+            "date_id" INTEGER NOT NULL,
+            "date" DATE NOT NULL,
+            "state_fips" VARCHAR(3) NOT NULL,
+            "state_name" VARCHAR(30),
+            "state_abv" VARCHAR(30) NOT NULL,
+            "positive" REAL,
+            "positiveincrease" INTEGER,
+            "negative" REAL,
+            "death" REAL,
+            "deathincrease" INTEGER,
+            "recovered" REAL,
+            "hospitalized" REAL,
+            "hospitalizedcurrently" REAL,
+            "hospitalizedincrease" INTEGER,
+            "latitude" REAL,
+            "longitude" REAL,
+            PRIMARY KEY (date_id, state_fips)
+            )
+            DISTKEY (state_fips)
+            SORTKEY (date_id, state_fips)
+        """,
+    "agg_state_totals": """
+        CREATE TABLE IF NOT EXISTS "agg_state_totals" (
+            "state_fips" VARCHAR(3) NOT NULL,
+            "state_name" VARCHAR(30),
+            "state_abv" VARCHAR(30) NOT NULL,
+            "positive_sum" DOUBLE PRECISION,
+            "death_sum" DOUBLE PRECISION,
+            "hosp_currently_sum" DOUBLE PRECISION,
+            "hosp_currently_count" BIGINT,
+            "first_date_id" INTEGER,
+            "last_date_id" INTEGER,
+            PRIMARY KEY (state_fips)
+            )
+            DISTSTYLE ALL
+            SORTKEY (state_abv)
+        """,
+}
+
+VIEW_SQL = [
+    # /* total by state positive, death, hospitalized */
+    """
+    CREATE OR REPLACE VIEW state_totals (state, state_abv, total_positive_cases,
+    total_deaths, avg_hospitalized) AS
+        SELECT state_name, state_abv, positive_sum, death_sum,
+            ROUND(hosp_currently_sum / NULLIF(hosp_currently_count, 0), 0)
+        FROM agg_state_totals
+        ORDER BY state_abv
+    """,
+    # /* total US */
+    """
+    CREATE OR REPLACE VIEW us_totals (postive_cases, deaths, begin_data, end_data) AS
+        SELECT SUM(positive_sum), SUM(death_sum), MIN(first_date_id), MAX(last_date_id)
+        FROM agg_state_totals
+    """,
+    # /* Daily */
+    """
+    CREATE OR REPLACE VIEW state_daily (
+        date, state, state_abv, positive, pos_increase,
+        negative, deaths, death_increase, recovered, hospitalized, hosp_currently,
+        hosp_increase, lattitude, longitude) AS
+        SELECT date, state_name, state_abv, positive, positiveincrease,
+                negative, death, deathincrease, recovered, hospitalized,
+                hospitalizedcurrently, hospitalizedincrease, latitude, longitude
+        FROM agg_state_daily
+        ORDER BY date, state_abv
+    """,
+]
+
+
+def rollup_statements(cutoff=None):
+    """Refresh the rollup tables after a fact_covid load
+
+    Only the days after cutoff are recomputed in agg_state_daily, the
+    whole table when cutoff is None. agg_state_totals has a row per
+    state and is rebuilt from agg_state_daily without touching the
+    star schema.
+
+    :param cutoff: date_id the fact load replaced the days after, None for a full load
+    """
+    after = f"WHERE fc.date > {int(cutoff)}" if cutoff is not None else ""
+    delete = f"DELETE FROM agg_state_daily WHERE date_id > {int(cutoff)}" if cutoff is not None \
+        else "DELETE FROM agg_state_daily"
+    return [
+        delete,
+        f"""
+        INSERT INTO agg_state_daily
+        SELECT fc.date, dd.date, fc.state_fips, dr.state, fc.state, fc.positive, fc.positiveincrease,
+            fc.negative, fc.death, fc.deathincrease, fc.recovered, fc.hospitalized,
+            fc.hospitalizedcurrently, fc.hospitalizedincrease, dr.latitude, dr.longitude
+        FROM fact_covid fc
+            JOIN dim_date dd ON fc.date = dd.date_id
+            JOIN dim_region dr ON fc.region_sk = dr.region_sk
+        {after}
+        """,
+        "DELETE FROM agg_state_totals",
+        """
+        INSERT INTO agg_state_totals
+        SELECT state_fips, MIN(state_name), state_abv, SUM(positive), SUM(death),
+            SUM(hospitalizedcurrently), COUNT(hospitalizedcurrently), MIN(date_id), MAX(date_id)
+        FROM agg_state_daily
+        GROUP BY state_fips, state_abv
+        """,
+    ]
+
+
+def copy_sql(table, manifest_url, iam_role, region, options):
+    return f"""
+        copy {table} from '{manifest_url}'
+        credentials 'aws_iam_role={iam_role}'
+        region '{region}'
+        {options}
+    """
+
+
+def replace_statements(table, manifest_url, iam_role, region, options):
+    """Reload a whole table
+
+    DELETE instead of TRUNCATE, which would commit the load transaction halfway.
+    """
+    return [f"DELETE FROM {table}", copy_sql(table, manifest_url, iam_role, region, options)]
+
+
+def append_statements(table, key_columns, manifest_url, iam_role, region, options):
+    """Load rows into a staging table and insert the ones whose key the target does not have yet
+
+    Loading the same rows again leaves the table as it was.
+    """
+    stage = f"{table}_stage"
+    match = " AND ".join(f"{table}.{col} = {stage}.{col}" for col in key_columns)
+    return [
+        f"CREATE TEMP TABLE {stage} (LIKE {table})",
+        copy_sql(stage, manifest_url, iam_role, region, options),
+        f"""
+        INSERT INTO {table}
+        SELECT * FROM {stage}
+        WHERE NOT EXISTS (SELECT 1 FROM {table} WHERE {match})
+        """,
+        f"DROP TABLE {stage}",
+    ]
+
+
+def merge_statements(table, key_columns, columns, manifest_url, iam_role, region, options):
+    """Load a delta into a staging table and merge it into the target on its key
+
+    Rows whose key already exists are updated, new keys are inserted.
+    """
+    stage = f"{table}_stage"
+    match = " AND ".join(f"{table}.{col} = {stage}.{col}" for col in key_columns)
+    updates = ", ".join(f"{col} = {stage}.{col}" for col in columns if col not in key_columns)
+    values = ", ".join(f"{stage}.{col}" for col in columns)
+    return [
+        f"CREATE TEMP TABLE {stage} (LIKE {table})",
+        copy_sql(stage, manifest_url, iam_role, region, options),
+        f"""
+        MERGE INTO {table} USING {stage} ON {match}
+        WHEN MATCHED THEN UPDATE SET {updates}
+        WHEN NOT MATCHED THEN INSERT VALUES ({values})
+        """,
+        f"DROP TABLE {stage}",
+    ]
@@ -0,0 +1,59 @@
+# Vectorized FIPS code parsing shared by the dimension and fact builders
+import numpy as np
+import pandas as pd
+
+# Zero padded text for every possible state and county code, so
+# padded columns from different tables share one dtype and join on codes
+STATE_FIPS_DTYPE = pd.CategoricalDtype([str(code).zfill(2) for code in range(100)], ordered=True)
+COUNTY_FIPS_DTYPE = pd.CategoricalDtype([str(code).zfill(3) for code in range(1000)], ordered=True)
+# State code 00 in the sources is Puerto Rico
+STATE_CODE_REMAP = {0: 72}
+
+
+def to_codes(col):
+    """FIPS codes as text or numbers -> int32 array, missing values are not allowed"""
+    return pd.to_numeric(col).to_numpy(dtype="int32")
+
+
+def padded(codes, width, index=None):
+    """Zero padded text of integer codes as a categorical
+
+    Only the distinct codes are formatted.
+    """
+    uniques, inverse = np.unique(codes, return_inverse=True)
+    dtype = pd.CategoricalDtype([str(code).zfill(width) for code in uniques], ordered=True)
+    return pd.Series(pd.Categorical.from_codes(inverse, dtype=dtype), index=index)
+
+
+def state_fips(state_codes, index=None):
+    return pd.Series(pd.Categorical.from_codes(state_codes, dtype=STATE_FIPS_DTYPE), index=index)
+
+
+def county_fips(county_codes, index=None):
+    return pd.Series(pd.Categorical.from_codes(county_codes, dtype=COUNTY_FIPS_DTYPE), index=index)
+
+
+def parse_state_fips(col):
+    """State FIPS codes -> zero padded categorical"""
+    return state_fips(to_codes(col), col.index)
+
+
+def parse_county_fips(col):
+    """Split county FIPS codes into their state and county parts
+
+    :param col: 5 digit FIPS codes as text or numbers
+    :return: DataFrame with fips, state_fips and county_fips as zero
+        padded categoricals and the integer state_code and county_code
+    """
+    fips = to_codes(col)
+    state_code = fips // 1000
+    county_code = fips % 1000
+    for code, remap in STATE_CODE_REMAP.items():
+        state_code[state_code == code] = remap
+    return pd.DataFrame({
+        "fips": padded(fips, 5, col.index),
+        "state_fips": state_fips(state_code, col.index),
+        "county_fips": county_fips(county_code, col.index),
+        "state_code": state_code.astype("int8"),
+        "county_code": county_code.astype("int16"),
+    }, index=col.index)
@@ -0,0 +1,73 @@
+# DataFrame memory helpers for running the transforms on small workers
+import resource
+import sys
+
+import numpy as np
+import pandas as pd
+
+# Text columns repeated on every row of the source tables
+REPEATED_TEXT_COLUMNS = {"province_state", "country_region", "county", "county_name",
+                         "state", "state_name", "hospital_type", "hq_state"}
+# Other text columns become categoricals when at most this share is distinct
+CATEGORY_MAX_UNIQUE_RATIO = 0.5
+
+NULLABLE_INTS = ["Int8", "Int16", "Int32", "Int64"]
+
+
+def smallest_int(col):
+    """Narrowest integer dtype that holds every value, nullable if the column is"""
+    if col.isna().all():
+        return col.dtype
+    lo, hi = col.min(), col.max()
+    for nullable in NULLABLE_INTS:
+        info = np.iinfo(nullable.lower())
+        if info.min <= lo and hi <= info.max:
+            return nullable if col.hasnans else nullable.lower()
+    return col.dtype
+
+
+def compact_frame(df, keep_text=()):
+    """Downcast numbers and store repeated text once per category
+
+    :param df: DataFrame to compact in place
+    :param keep_text: text columns that must stay plain strings, e.g. codes that are parsed later
+    :return: the same DataFrame
+    """
+    for col in df.columns:
+        dtype = df[col].dtype
+        if pd.api.types.is_bool_dtype(dtype) or isinstance(dtype, pd.CategoricalDtype):
+            continue
+        if pd.api.types.is_integer_dtype(dtype):
+            df[col] = df[col].astype(smallest_int(df[col]))
+        elif pd.api.types.is_float_dtype(dtype):
+            df[col] = df[col].astype("float32")
+        elif col not in keep_text and (col in REPEATED_TEXT_COLUMNS or
+                                       df[col].nunique() <= CATEGORY_MAX_UNIQUE_RATIO * len(df)):
+            df[col] = df[col].astype("category")
+    return df
+
+
+def deep_memory_mb(df):
+    return round(df.memory_usage(deep=True).sum() / 1024 ** 2, 2)
+
+
+def peak_rss_mb():
+    # ru_maxrss is in KiB on Linux and bytes on macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(rss / 1024 ** 2 if sys.platform == "darwin" else rss / 1024, 2)
+
+
+def report_memory(stage, frames):
+    """Print the deep memory usage of the live DataFrames after a stage
+
+    :param stage: Stage name
+    :param frames: name -> object, non DataFrames are ignored
+    :return: total MB held by the DataFrames
+    """
+    sizes = {name: deep_memory_mb(df) for name, df in frames.items()
+             if isinstance(df, pd.DataFrame) and not name.startswith("_")}
+    total = round(sum(sizes.values()), 2)
+    print(f"Memory after {stage}: {total}MB in {len(sizes)} DataFrames, peak RSS {peak_rss_mb()}MB")
+    for name, size in sorted(sizes.items(), key=lambda item: item[1], reverse=True):
+        print(f"    {name : <30} {size : >10}MB")
+    return total
@@ -0,0 +1,43 @@
+# Wheels the Glue load job installs, uploaded under the digest of their content
+import hashlib
+from urllib.parse import urlparse
+
+# Pinned wheels of the Glue load job. The PyPI paths embed the digest of each file
+GLUE_JOB_WHEELS = [
+    ("redshift_connector-2.0.909-py3-none-any.whl",
+     "https://files.pythonhosted.org/packages/24/3c/"
+     "471f5f7d43f1ed1be87494010f466849fe2376acf8bab49d4b676f870cf1/redshift_connector-2.0.909-py3-none-any.whl"),
+    ("boto3-1.26.23-py3-none-any.whl",
+     "https://files.pythonhosted.org/packages/67/03/"
+     "0e794cf0621ce8c3ee780bb5fdeeffeefc095dd1f7f264b1f434db207063/boto3-1.26.23-py3-none-any.whl"),
+    ("s3transfer-0.6.0-py3-none-any.whl",
+     "https://files.pythonhosted.org/packages/5e/c6/"
+     "af903b5fab3f9b5b1e883f49a770066314c6dcceb589cf938d48c89556c1/s3transfer-0.6.0-py3-none-any.whl"),
+    ("botocore-1.29.23-py3-none-any.whl",
+     "https://files.pythonhosted.org/packages/19/eb/"
+     "1068bdad2424f509b5700ace7d8adb3b97595618000ec9bc1c3bd4224c98/botocore-1.29.23-py3-none-any.whl"),
+    ("awscli-1.27.23-py3-none-any.whl",
+     "https://files.pythonhosted.org/packages/f2/2a/"
+     "e199d0cfb949a6a1710c8b9ead4d0238690435457a6e32861b7c4214e0dd/awscli-1.27.23-py3-none-any.whl"),
+]
+
+
+def url_digest(url):
+    """blake2b-256 digest of a PyPI file, its path is packages/<2>/<2>/<60 hex digits>/<file name>"""
+    return "".join(urlparse(url).path.split("/")[2:5])
+
+
+def wheel_key(prefix, filename, url):
+    """S3 key of a wheel under the digest of its bytes, read from its URL
+
+    The file name is kept as it is, Glue only installs files from
+    --extra-py-files that are named like a wheel.
+    """
+    return f"{prefix}{url_digest(url)[:16]}/{filename}"
+
+
+def check_digest(url, body):
+    """Raise ValueError when a downloaded wheel does not have the digest in its URL"""
+    digest = hashlib.blake2b(body, digest_size=32).hexdigest()
+    if digest != url_digest(url):
+        raise ValueError(f"{url} downloaded with blake2b {digest}")
@@ -0,0 +1,72 @@
+# Surrogate keys that stay stable across runs. Each registry maps
+# the natural key of a dimension member to the key it was first given
+import io
+
+import pandas as pd
+
+# Dimension -> (natural key columns, surrogate key column)
+REGISTRY_KEYS = {
+    "dim_region": (["fips", "county"], "region_sk"),
+    "dim_hospital": (["fips", "hospital_name", "hq_address"], "hosp_sk"),
+}
+
+
+class KeyRegistry:
+    """Natural key -> surrogate key map of one dimension
+
+    Lookups go through a hash index on the natural key columns. Members
+    that are not registered yet get the next keys in the order they come
+    in, keys are never reused or renumbered.
+
+    :param natural_keys: natural key columns
+    :param sk: surrogate key column
+    :param keys: registry DataFrame with the natural key columns and sk
+    """
+
+    def __init__(self, natural_keys, sk, keys=None):
+        self.natural_keys = list(natural_keys)
+        self.sk = sk
+        if keys is None:
+            keys = pd.DataFrame({col: pd.Series(dtype="string") for col in self.natural_keys})
+            keys[sk] = pd.Series(dtype="int32")
+        self.keys = keys[self.natural_keys + [sk]].reset_index(drop=True)
+        self.added = 0
+
+    def index(self, df):
+        return pd.MultiIndex.from_frame(df[self.natural_keys].astype("string").fillna(""))
+
+    def assign(self, df):
+        """Look up the surrogate key of every row, registering new members
+
+        :param df: rows with the natural key columns, one per member
+        :return: int32 Series of keys aligned with df
+        """
+        positions = self.index(self.keys).get_indexer(self.index(df))
+        new = positions == -1
+        if new.any():
+            start = int(self.keys[self.sk].max()) + 1 if len(self.keys) else 1
+            members = df.loc[new, self.natural_keys].astype("string").reset_index(drop=True)
+            members[self.sk] = range(start, start + len(members))
+            self.keys = pd.concat([self.keys, members], ignore_index=True)
+            self.added += len(members)
+            positions[new] = range(len(self.keys) - len(members), len(self.keys))
+        return pd.Series(self.keys[self.sk].to_numpy()[positions], index=df.index).astype("int32")
+
+    def to_parquet(self):
+        buffer = io.BytesIO()
+        self.keys.to_parquet(buffer, index=False)
+        return buffer.getvalue()
+
+
+def load_registry(client, bucket, key, dimension):
+    """Read a dimension's registry from S3, empty on the first run"""
+    natural_keys, sk = REGISTRY_KEYS[dimension]
+    try:
+        body = client.get_object(Bucket=bucket, Key=key)["Body"].read()
+    except client.exceptions.NoSuchKey:
+        return KeyRegistry(natural_keys, sk)
+    return KeyRegistry(natural_keys, sk, pd.read_parquet(io.BytesIO(body)))
+
+
+def save_registry(client, bucket, key, registry):
+    client.put_object(Bucket=bucket, Key=key, Body=registry.to_parquet())
@@ -0,0 +1,148 @@
+# DuckDB stand-in for the Athena query layer. The crawled table
+# names are served from local copies of the data lake files so the
+# extraction and transforms can run without Glue or Athena
+import json
+import os
+
+import duckdb
+import requests
+
+import spans
+
+# Validators of the cached files, kept next to them
+VALIDATORS_FILE = "validators.json"
+
+# Table name -> (source file, DuckDB reader, reader options)
+# Names match what the Glue crawlers create
+SOURCE_TABLES = {
+    "enigma_jhu": ("Enigma-JHU.csv.gz", "read_csv_auto", {}),
+    "nytimes_data_us_county": ("us_county.csv", "read_csv_auto", {}),
+    "nytimes_data_us_states": ("us_states.csv", "read_csv_auto", {}),
+    "rearc_testing_states_daily": ("states_daily.csv", "read_csv_auto", {}),
+    "rearc_usa_hospital_beds": ("usa-hospital-beds.geojson", "read_json_auto", {}),
+    "d_static_countrycode": ("CountryCodeQS.csv", "read_csv_auto", {}),
+    "d_static_countypopulation": ("County_Population.csv", "read_csv_auto", {}),
+    # The crawler reads the header of this file as a row
+    "d_static_state_abv": ("states_abv.csv", "read_csv_auto", {"header": False, "all_varchar": True}),
+}
+
+
+def reader_sql(reader, path, options):
+    args = "".join(f", {key} = {str(value).lower() if isinstance(value, bool) else repr(value)}"
+                   for key, value in options.items())
+    return f"{reader}('{path}'{args})"
+
+
+class LocalQuery:
+    """Run the extraction queries with DuckDB over cached source files
+
+    :param cache_dir: directory the data lake files are cached in
+    :param text_columns: columns cast to text in every view, e.g. codes
+        with leading zeros
+    """
+
+    def __init__(self, cache_dir, text_columns=()):
+        self.cache_dir = cache_dir
+        self.text_columns = set(text_columns)
+        self.conn = duckdb.connect()
+        self.tables = []
+
+    def cache(self, urls):
+        """Download the files that are not cached yet or changed upstream
+
+        Cached files are revalidated with the ETag and Last-Modified they
+        were downloaded with, the validators the ingest manifest keeps for
+        the same sources. When a source cannot be reached its cached copy
+        is used as it is.
+
+        :return: list of file names downloaded
+        """
+        os.makedirs(self.cache_dir, exist_ok=True)
+        validators = self.load_validators()
+        downloaded = []
+        for url in urls:
+            file = url.split("/")[-1]
+            path = os.path.join(self.cache_dir, file)
+            headers = {}
+            if os.path.exists(path):
+                previous = validators.get(file, {})
+                if previous.get("etag"):
+                    headers["If-None-Match"] = previous["etag"]
+                if previous.get("last_modified"):
+                    headers["If-Modified-Since"] = previous["last_modified"]
+            try:
+                r = requests.get(url, stream=True, headers=headers)
+            except requests.ConnectionError as e:
+                if not os.path.exists(path):
+                    raise
+                print(f"{file} source unreachable, using the cached copy: {e}")
+                continue
+            with r:
+                if headers and r.status_code == 304:
+                    print(f"{file} unchanged upstream, using the cached copy.")
+                    continue
+                r.raise_for_status()
+                with spans.span("cache_file", f"{file} cached in {self.cache_dir}.", file=file) as s:
+                    with open(f"{path}.part", "wb") as f:
+                        for chunk in r.iter_content(chunk_size=1024 ** 2):
+                            f.write(chunk)
+                    os.replace(f"{path}.part", path)
+                    s.add(bytes=os.path.getsize(path))
+                validators[file] = {"etag": r.headers.get("ETag"), "last_modified": r.headers.get("Last-Modified")}
+                self.save_validators(validators)
+                downloaded.append(file)
+        return downloaded
+
+    def load_validators(self):
+        """file name -> validators of the cached copy, empty for a new cache"""
+        try:
+            with open(os.path.join(self.cache_dir, VALIDATORS_FILE)) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+
+    def save_validators(self, validators):
+        with open(os.path.join(self.cache_dir, VALIDATORS_FILE), "w") as f:
+            json.dump(validators, f, indent=2)
+
+    def register(self):
+        """Create a view per cached source under its crawled table name
+
+        Column names are lower cased like the Glue catalog does.
+        """
+        for table, (file, reader, options) in SOURCE_TABLES.items():
+            path = os.path.join(self.cache_dir, file)
+            if not os.path.exists(path):
+                continue
+            source = reader_sql(reader, path, options)
+            columns = [row[0] for row in self.conn.execute(f"DESCRIBE SELECT * FROM {source}").fetchall()]
+            if options.get("header") is False:
+                # Athena names headerless columns col0, col1, ...
+                names = [f"col{i}" for i in range(len(columns))]
+            else:
+                names = [col.lower() for col in columns]
+            select = ", ".join(
+                f'CAST("{col}" AS VARCHAR) AS "{name}"' if name in self.text_columns else f'"{col}" AS "{name}"'
+                for col, name in zip(columns, names))
+            self.conn.execute(f"CREATE OR REPLACE VIEW {table} AS SELECT {select} FROM {source}")
+            self.tables.append(table)
+        return self.tables
+
+    def query(self, sql, arrow=False):
+        """Run a query and return a DataFrame, or an Arrow table with arrow=True"""
+        result = self.conn.execute(sql)
+        return result.arrow() if arrow else result.df()
+
+    def extract_tables(self, queries, arrow=False):
+        """Run a query per table
+
+        :param queries: table name -> SQL
+        :return: dict of table name -> DataFrame or Arrow table
+        """
+        with spans.span("local_extract", f"Local extraction COMPLETE for {len(queries)} tables.") as s:
+            results = {}
+            for table, sql in queries.items():
+                results[table] = self.query(sql, arrow)
+                print(f"{table} queried locally. {results[table].shape[0]} rows.")
+            s.add(rows_out=sum(result.shape[0] for result in results.values()))
+        return results
@@ -0,0 +1,118 @@
+# Runs the pipeline stages as a dependency graph. Stages whose
+# dependencies are done run at the same time, and every finished stage
+# is checkpointed so a rerun after a failure starts where it stopped
+import contextvars
+import json
+import os
+import threading
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import spans
+
+
+class Task:
+    """A named stage
+
+    :param name: task name, also the checkpoint key
+    :param fn: called with the shared state dict, returns a dict of
+        JSON serializable values to add to it or None
+    :param deps: names of the tasks that have to finish first
+    """
+
+    def __init__(self, name, fn, deps=()):
+        self.name = name
+        self.fn = fn
+        self.deps = list(deps)
+
+
+def load_checkpoint(path):
+    """Checkpoint left by a failed run, empty when there is none"""
+    if not os.path.exists(path):
+        return {"done": {}, "state": {}}
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_checkpoint(path, checkpoint):
+    with open(f"{path}.tmp", "w") as f:
+        json.dump(checkpoint, f, indent=2, default=str)
+    os.replace(f"{path}.tmp", path)
+
+
+class Pipeline:
+    """Run tasks as soon as their dependencies are done
+
+    :param tasks: list of Task
+    :param checkpoint_path: file finished tasks and their state are kept in
+    :param resume: skip the tasks a previous run already finished
+    :param max_workers: tasks running at once
+    """
+
+    def __init__(self, tasks, checkpoint_path, resume=True, max_workers=4):
+        self.tasks = {task.name: task for task in tasks}
+        for task in tasks:
+            missing = set(task.deps) - set(self.tasks)
+            if missing:
+                raise ValueError(f"{task.name} depends on unknown tasks {sorted(missing)}")
+        self.checkpoint_path = checkpoint_path
+        self.checkpoint = load_checkpoint(checkpoint_path) if resume else {"done": {}, "state": {}}
+        self.state = dict(self.checkpoint["state"])
+        self.max_workers = max_workers
+        self.lock = threading.Lock()
+
+    def run_task(self, task):
+        print(f"Starting task {task.name}...")
+        with spans.span(task.name, f"Task {task.name} COMPLETE.") as s:
+            result = task.fn(self.state) or {}
+        return result, round(s.wall, 2)
+
+    def run(self):
+        """Run every task, raises the first task error after saving the checkpoint
+
+        :return: the shared state
+        """
+        with spans.span("pipeline") as s:
+            self.run_tasks()
+            stage_total = round(sum(self.checkpoint["done"][name]["seconds"] for name in self.tasks), 2)
+            s.done = f"Pipeline COMPLETE, {stage_total}s of stages."
+        if os.path.exists(self.checkpoint_path):
+            os.remove(self.checkpoint_path)
+        return self.state
+
+    def run_tasks(self):
+        """Schedule the tasks on the pool until all are done or one failed"""
+        done = set(self.checkpoint["done"])
+        for name in sorted(done):
+            print(f"Task {name} finished in an earlier run\t SKIPPING.")
+        running = {}
+        error = None
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            while True:
+                if error is None:
+                    for task in self.tasks.values():
+                        if (task.name not in done and task.name not in running.values()
+                                and all(dep in done for dep in task.deps)):
+                            # Task spans nest under the pipeline span
+                            running[pool.submit(contextvars.copy_context().run, self.run_task, task)] = task.name
+                if not running:
+                    break
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    name = running.pop(future)
+                    try:
+                        result, seconds = future.result()
+                    except Exception as e:
+                        print(f"Task {name} FAILED: {e}")
+                        error = error or e
+                        continue
+                    with self.lock:
+                        self.state.update(result)
+                        done.add(name)
+                        self.checkpoint["done"][name] = {"seconds": seconds}
+                        self.checkpoint["state"] = self.state
+                        save_checkpoint(self.checkpoint_path, self.checkpoint)
+        if error is not None:
+            raise error
+        pending = set(self.tasks) - done
+        if pending:
+            raise RuntimeError(f"Tasks never became ready: {sorted(pending)}")
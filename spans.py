@@ -0,0 +1,167 @@
+# Nested timing spans for the pipeline stages. A span records wall
+# and CPU time, peak RSS and the rows and bytes it handled, prints the
+# stage's COMPLETE line and is written as a JSON line when it closes.
+# The totals per span go to a Prometheus textfile at the end of a run
+import contextlib
+import contextvars
+import functools
+import json
+import os
+import threading
+import time
+
+import frame_memory
+
+METRIC_PREFIX = "covid_pipeline"
+
+_current = contextvars.ContextVar("span", default=None)
+
+
+class Span:
+    """One timed piece of work
+
+    :param name: span name, nested spans are identified by their path
+    :param parent: enclosing Span or None
+    :param attrs: extra JSON serializable fields to record
+    """
+
+    def __init__(self, name, parent=None, **attrs):
+        self.name = name
+        self.path = f"{parent.path}/{name}" if parent else name
+        self.attrs = attrs
+        self.rows_in = 0
+        self.rows_out = 0
+        self.bytes = 0
+        self.done = None
+        self.error = None
+        self.start = time.time()
+        self.wall = 0.0
+        self.cpu = 0.0
+        self.peak_rss_mb = 0.0
+
+    def add(self, rows_in=0, rows_out=0, bytes=0):
+        """Count rows read, rows produced and bytes transferred"""
+        self.rows_in += int(rows_in)
+        self.rows_out += int(rows_out)
+        self.bytes += int(bytes)
+
+    def elapsed(self):
+        """Seconds since the span started, its wall time once it finished"""
+        return self.wall or time.time() - self.start
+
+    def texec(self):
+        return f"[{round(self.elapsed(), 2)}s]"
+
+    def record(self):
+        return {"span": self.path, "name": self.name, "start": round(self.start, 3),
+                "wall_s": round(self.wall, 4), "cpu_s": round(self.cpu, 4), "peak_rss_mb": self.peak_rss_mb,
+                "rows_in": self.rows_in, "rows_out": self.rows_out, "bytes": self.bytes,
+                "error": self.error, **self.attrs}
+
+
+class Recorder:
+    """Finished spans of a run, appended to <metrics_dir><run_id>.jsonl when a directory is set"""
+
+    def __init__(self, metrics_dir=None):
+        self.metrics_dir = metrics_dir
+        self.run_id = time.strftime("%Y%m%dT%H%M%S")
+        self.spans = []
+        self.lock = threading.Lock()
+        if metrics_dir:
+            os.makedirs(metrics_dir, exist_ok=True)
+
+    def add(self, span):
+        record = span.record()
+        with self.lock:
+            self.spans.append(record)
+            if self.metrics_dir:
+                with open(os.path.join(self.metrics_dir, f"{self.run_id}.jsonl"), "a") as f:
+                    f.write(json.dumps(record, default=str) + "\n")
+
+
+RECORDER = Recorder()
+
+
+def configure(metrics_dir):
+    """Start a new run whose spans are written under metrics_dir"""
+    global RECORDER
+    RECORDER = Recorder(metrics_dir)
+    return RECORDER
+
+
+@contextlib.contextmanager
+def span(name, done=None, **attrs):
+    """Time the enclosed block as a child of the current span
+
+    CPU time is that of the thread the span runs in. Spans opened in
+    other threads nest under it when the thread runs in a copy of the
+    context, see contextvars.copy_context.
+
+    :param done: printed with the wall time when the block finishes,
+        can be replaced through Span.done once the counts are known
+    :yield: the Span
+    """
+    current = Span(name, _current.get(), **attrs)
+    current.done = done
+    token = _current.set(current)
+    t0, c0 = time.perf_counter(), time.thread_time()
+    try:
+        yield current
+    except BaseException as e:
+        current.error = repr(e)
+        raise
+    finally:
+        current.wall = time.perf_counter() - t0
+        current.cpu = time.thread_time() - c0
+        current.peak_rss_mb = frame_memory.peak_rss_mb()
+        _current.reset(token)
+        RECORDER.add(current)
+        if current.done and current.error is None:
+            print(f"{current.done} {current.texec() : >30}")
+
+
+def traced(name=None, done=None):
+    """Decorator that runs the function in a span named after it"""
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with span(name or fn.__name__, done):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def metric_lines(records):
+    """Prometheus text exposition of the span totals, one series per span path"""
+    totals = {}
+    for record in records:
+        total = totals.setdefault(record["span"], {"count": 0, "wall_seconds": 0.0, "cpu_seconds": 0.0,
+                                                   "rows_in": 0, "rows_out": 0, "bytes": 0,
+                                                   "peak_rss_bytes": 0, "errors": 0})
+        total["count"] += 1
+        total["wall_seconds"] += record["wall_s"]
+        total["cpu_seconds"] += record["cpu_s"]
+        total["rows_in"] += record["rows_in"]
+        total["rows_out"] += record["rows_out"]
+        total["bytes"] += record["bytes"]
+        total["peak_rss_bytes"] = max(total["peak_rss_bytes"], int(record["peak_rss_mb"] * 1024 ** 2))
+        total["errors"] += record["error"] is not None
+    lines = []
+    for metric in ["count", "wall_seconds", "cpu_seconds", "rows_in", "rows_out", "bytes",
+                   "peak_rss_bytes", "errors"]:
+        lines.append(f"# TYPE {METRIC_PREFIX}_span_{metric} gauge")
+        for path, total in sorted(totals.items()):
+            lines.append(f'{METRIC_PREFIX}_span_{metric}{{span="{path}"}} {round(total[metric], 4)}')
+    return lines
+
+
+def write_prometheus(path, recorder=None):
+    """Write the run's span totals as a Prometheus textfile, replaced atomically"""
+    recorder = recorder or RECORDER
+    lines = metric_lines(recorder.spans)
+    lines.append(f"# TYPE {METRIC_PREFIX}_last_run_timestamp_seconds gauge")
+    lines.append(f"{METRIC_PREFIX}_last_run_timestamp_seconds {round(time.time())}")
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(f"{path}.tmp", "w") as f:
+        f.write("\n".join(lines) + "\n")
+    os.replace(f"{path}.tmp", path)
@@ -0,0 +1,64 @@
+# Shared fixtures. covid_aws_de reads its settings when it is imported,
+# so the environment is filled in here before any test module imports it
+#
+# pip install -r requirements-test.txt
+# python -m pytest tests
+import os
+import sys
+from pathlib import Path
+
+import boto3
+import pytest
+from moto import mock_aws
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+REGION = "us-east-1"
+BUCKET = "test-covid19-de"
+
+TEST_SETTINGS = {
+    "PROFILE": "default",
+    "AWS_ACCESS_KEY_ID": "testing",
+    "AWS_SECRET_ACCESS_KEY": "testing",
+    "AWS_REGION_NAME": REGION,
+    "S3_STAGING_PATH": f"s3://{BUCKET}/staging/",
+    "S3_OUTPUT_PATH": f"s3://{BUCKET}/output/",
+    "S3_BUCKET_NAME": BUCKET,
+    "S3_STAGING_DIR": "staging/",
+    "S3_OUTPUT_DIR": "output/",
+    "S3_SCRIPTS_DIR": "scripts/",
+    "GLUE_IAM_ROLE": "glue-s3-dev",
+    "GLUE_DB": "covid19_db",
+    "GLUE_ETL_JOB": "s3RedShiftGlue",
+    "EXT_PKG_DIR": "packages/",
+    "DWH_CLUSTER_TYPE": "single-node",
+    "DWH_NUM_NODES": "1",
+    "DWH_NODE_TYPE": "dc2.large",
+    "DWH_CLUSTER_IDENTIFIER": "covid-de-dc",
+    "DWH_DB": "covid_dw",
+    "DWH_DB_USER": "dwuser",
+    "DWH_DB_PASSWORD": "testing",
+    "DWH_PORT": "5439",
+    "DWH_IAM_ROLE_NAME": "redshift-s3-access",
+    "METRICS_DIR": "",
+}
+for name, value in TEST_SETTINGS.items():
+    os.environ.setdefault(name, value)
+
+
+@pytest.fixture
+def aws():
+    """Mocked AWS for the duration of a test, with the project bucket created"""
+    with mock_aws():
+        boto3.client("s3", region_name=REGION).create_bucket(Bucket=BUCKET)
+        yield
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    """Record the backoff waits instead of sleeping"""
+    import covid_aws_de
+
+    delays = []
+    monkeypatch.setattr(covid_aws_de.time, "sleep", delays.append)
+    return delays
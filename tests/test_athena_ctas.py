@@ -0,0 +1,180 @@
+# The CTAS tables, run under DuckDB, against the pandas transforms on the same sources
+import duckdb
+import pandas as pd
+import pytest
+
+import athena_ctas
+import covid_aws_de
+import transforms
+
+# Raw tables as the crawlers type them, codes crawled as doubles. Ties on
+# the leading sort columns make the surrogate keys depend on the full order
+ENIGMA_JHU = pd.DataFrame({
+    "fips": [6037.0, 1001.0, 1001.0, 1001.0, 72001.0, 6037.0, 6075.0, None],
+    "province_state": ["California", "Alabama", "Alabama", "Alabama", "Puerto Rico", "Grand Princess",
+                       None, "Alabama"],
+    "country_region": ["US"] * 8,
+    "latitude": [34.3, 32.5, 32.4, 32.5, 18.2, 37.7, 37.7, 33.0],
+    "longitude": [-118.2, -86.6, -86.7, -86.6, -66.7, -122.4, -122.4, -87.0],
+})
+NYTIMES_DATA_US_COUNTY = pd.DataFrame({
+    "fips": [1001.0, 6037.0, 72001.0, 6075.0, 6075.0],
+    "county": ["Autauga", "Los Angeles", "Adjuntas", "San Francisco", "SF"],
+})
+REARC_USA_HOSPITAL_BEDS = pd.DataFrame({
+    "fips": [6037.0, 1001.0, 6037.0, 6037.0, 1001.0, None],
+    "state_name": ["California", "Alabama", "California", "California", "Alabama", "Alabama"],
+    "county_name": ["Los Angeles", "Autauga", "Los Angeles", "Los Angeles", "Autauga", None],
+    "latitude": [34.0, 32.4, 34.1, 34.1, 32.4, 33.0],
+    "longtitude": [-118.3, -86.5, -118.4, -118.4, -86.5, -87.0],
+    "hospital_name": ["Cedars", "Prattville Baptist", "Good Samaritan", "Good Samaritan", "Prattville Baptist",
+                      "Nowhere"],
+    "hq_address": ["8700 Beverly Blvd", "124 S Memorial Dr", "1225 Wilshire Blvd", "1225 Wilshire Blvd",
+                   "124 S Memorial Dr", None],
+    "hq_city": ["Los Angeles", "Prattville", "Los Angeles", "Los Angeles", "Prattville", None],
+    "hq_state": ["CA", "AL", "CA", "CA", "AL", "AL"],
+    "hq_zip_code": [90048.0, 36067.0, 90017.0, 90017.0, 2134.0, None],
+    "hospital_type": ["Short Term Acute Care Hospital", "Critical Access Hospital", "Psychiatric Hospital",
+                      "Short Term Acute Care Hospital", "Critical Access Hospital", None],
+})
+REARC_TESTING_STATES_DAILY = pd.DataFrame({
+    "fips": [1.0, 6.0, 1.0, 6.0, 72.0, None, 1.0],
+    "date": [20210301, 20210301, 20210302, 20210302, 20210302, 20210302, 20210303],
+    "state": ["AL", "CA", "AL", "CA", "PR", "XX", None],
+    **{col: [None, 5.0, 7.0, 9.5, 1.0, 2.0, 3.0]
+       for col in ["positive", "negative", "hospitalized", "hospitalizedcurrently", "hospitalizeddischarged",
+                   "hospitalizedcumulative", "death", "recovered"]},
+    **{col: pd.array([None, 1, 2, 3, 4, 5, 6], dtype="Int64")
+       for col in ["deathincrease", "hospitalizedincrease", "positiveincrease"]},
+})
+DATABASE = "covid19_db"
+# The Athena date functions dim_date_select uses, in DuckDB terms
+ATHENA_DATE_FUNCTIONS = [
+    "CREATE MACRO date_parse(s, f) AS strptime(s, f)",
+    "CREATE MACRO date_format(d, f) AS strftime(d, CASE f WHEN '%W' THEN '%A' WHEN '%M' THEN '%B' ELSE f END)",
+    "CREATE MACRO date_add(unit, n, d) AS d + to_days(n)",
+    "CREATE MACRO sequence(first, last, step) AS generate_series(first, last, step)",
+    "CREATE MACRO day_of_week(d) AS isodow(d)",
+    "CREATE MACRO day_of_year(d) AS dayofyear(d)",
+]
+
+
+@pytest.fixture
+def athena():
+    """DuckDB holding the raw tables, dividing integers like Athena does"""
+    conn = duckdb.connect()
+    conn.execute("SET integer_division = true")
+    for sql in ATHENA_DATE_FUNCTIONS:
+        conn.execute(sql)
+    for name, df in [("enigma_jhu", ENIGMA_JHU), ("nytimes_data_us_county", NYTIMES_DATA_US_COUNTY),
+                     ("rearc_usa_hospital_beds", REARC_USA_HOSPITAL_BEDS),
+                     ("rearc_testing_states_daily", REARC_TESTING_STATES_DAILY)]:
+        conn.register(name, df)
+    yield conn
+    conn.close()
+
+
+def extracted(df, category_columns=()):
+    """A raw table as the typed extraction loads it"""
+    df = df.copy()
+    for col in covid_aws_de.code_columns.intersection(df.columns):
+        df[col] = covid_aws_de.clean_codes(df[col].astype("string"))
+    for col in category_columns:
+        df[col] = df[col].astype("category")
+    return df
+
+
+def comparable(df):
+    """Text as strings and floats at the real precision the warehouse stores"""
+    return pd.DataFrame({
+        col: df[col].astype("float32") if pd.api.types.is_float_dtype(df[col])
+        else df[col].astype("int64") if pd.api.types.is_integer_dtype(df[col])
+        else df[col].astype("string")
+        for col in df.columns
+    })
+
+
+@pytest.mark.parametrize("rows", [slice(None), slice(None, None, -1)])
+def test_dim_region_matches_the_pandas_transform(athena, rows):
+    ctas = athena.execute(f"SELECT * FROM ({athena_ctas.dim_region_select()}) ORDER BY region_sk").df()
+    enigma_jhu = extracted(ENIGMA_JHU[rows], ["province_state", "country_region"])
+    nytimes_data_us_county = extracted(NYTIMES_DATA_US_COUNTY[rows], ["county"])
+    pandas = transforms.build_dim_region(enigma_jhu, nytimes_data_us_county)
+
+    assert list(ctas.columns) == transforms.DIM_REGION_COLUMNS
+    pd.testing.assert_frame_equal(comparable(ctas), comparable(pandas))
+
+
+@pytest.mark.parametrize("rows", [slice(None), slice(None, None, -1)])
+def test_dim_hospital_matches_the_pandas_transform(athena, rows):
+    ctas = athena.execute(f"SELECT * FROM ({athena_ctas.dim_hospital_select()}) ORDER BY hosp_sk").df()
+    beds = extracted(REARC_USA_HOSPITAL_BEDS[rows], ["state_name", "county_name", "hospital_type", "hq_state"])
+    pandas = transforms.build_dim_hospital(beds)
+
+    assert list(ctas.columns) == transforms.DIM_HOSPITAL_COLUMNS
+    assert ctas["hq_zip_code"].tolist()[:2] == ["02134", "36067"]
+    pd.testing.assert_frame_equal(comparable(ctas), comparable(pandas))
+
+
+def test_numbering_does_not_depend_on_the_source_row_order():
+    conn = duckdb.connect()
+    conn.execute("SET integer_division = true")
+    conn.register("rearc_usa_hospital_beds", REARC_USA_HOSPITAL_BEDS.sample(frac=1, random_state=7))
+    shuffled = conn.execute(f"SELECT * FROM ({athena_ctas.dim_hospital_select()}) ORDER BY hosp_sk").df()
+    conn.register("rearc_usa_hospital_beds", REARC_USA_HOSPITAL_BEDS)
+    ordered = conn.execute(f"SELECT * FROM ({athena_ctas.dim_hospital_select()}) ORDER BY hosp_sk").df()
+    pd.testing.assert_frame_equal(shuffled, ordered)
+
+
+@pytest.mark.parametrize("zip_codes", [["90048", "036067", "90017", "90017", "02134", None],
+                                       ["90048.0", "36067", "0", "90017", "2134", None]])
+def test_text_codes_are_normalised_like_clean_codes(athena, zip_codes):
+    beds = REARC_USA_HOSPITAL_BEDS.assign(fips=["06037", "1001.0", "6037", "006037", "01001", None],
+                                          hq_zip_code=zip_codes)
+    athena.register("rearc_usa_hospital_beds", beds)
+    ctas = athena.execute(f"SELECT * FROM ({athena_ctas.dim_hospital_select()}) ORDER BY hosp_sk").df()
+    pandas = transforms.build_dim_hospital(
+        extracted(beds, ["state_name", "county_name", "hospital_type", "hq_state"]))
+
+    assert ctas["fips"].tolist() == ["01001", "01001", "06037", "06037", "06037"]
+    pd.testing.assert_frame_equal(comparable(ctas), comparable(pandas))
+
+
+def fact_rows(df):
+    """fact_covid has no surrogate key, rows are compared by date and state"""
+    return comparable(df).sort_values(["date", "state_fips"]).reset_index(drop=True)
+
+
+@pytest.mark.parametrize("cutoff", [None, 20210301])
+def test_fact_covid_matches_the_pandas_transform(athena, cutoff):
+    athena.execute(f"CREATE SCHEMA {DATABASE}")
+    for table, select in [("dim_region", athena_ctas.dim_region_select()),
+                          ("dim_hospital", athena_ctas.dim_hospital_select())]:
+        athena.execute(f"CREATE TABLE {DATABASE}.{athena_ctas.CTAS_PREFIX}{table} AS {select}")
+    ctas = athena.execute(athena_ctas.fact_covid_select(DATABASE, cutoff)).df()
+
+    dim_region = transforms.build_dim_region(extracted(ENIGMA_JHU, ["province_state", "country_region"]),
+                                             extracted(NYTIMES_DATA_US_COUNTY, ["county"]))
+    dim_hospital = transforms.build_dim_hospital(
+        extracted(REARC_USA_HOSPITAL_BEDS, ["state_name", "county_name", "hospital_type", "hq_state"]))
+    daily = extracted(REARC_TESTING_STATES_DAILY, ["state"])
+    if cutoff is not None:
+        daily = daily[daily["date"] > cutoff]
+    pandas = transforms.build_fact_covid(daily, dim_region, dim_hospital)
+
+    assert list(ctas.columns) == transforms.FACT_COVID_COLUMNS
+    assert len(ctas) == (2 if cutoff else 4)
+    pd.testing.assert_frame_equal(fact_rows(ctas), fact_rows(pandas))
+
+
+@pytest.mark.parametrize("loaded", [None, (20210302, 20210304)])
+def test_dim_date_matches_the_pandas_transform(athena, loaded):
+    ctas = athena.execute(f"SELECT * FROM ({athena_ctas.dim_date_select(3, loaded)}) ORDER BY date_id").df()
+    last = max(pd.Timestamp("2021-03-03"), pd.Timestamp.today().normalize()) + pd.Timedelta(days=3)
+    pandas = transforms.create_date_dim(pd.Timestamp("2021-03-01"), last, loaded).reset_index(drop=True)
+
+    assert list(ctas.columns) == list(pandas.columns)
+    assert ctas["date_id"].iloc[0] == 20210301
+    ctas["date"] = ctas["date"].astype("datetime64[ns]")
+    pandas["date"] = pandas["date"].astype("datetime64[ns]")
+    pd.testing.assert_frame_equal(comparable(ctas), comparable(pandas))
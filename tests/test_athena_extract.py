@@ -0,0 +1,109 @@
+# Concurrent Athena extraction against a moto Athena and S3
+import boto3
+import pytest
+import requests
+from moto.athena.models import athena_backends
+from moto.core import DEFAULT_ACCOUNT_ID
+from moto.moto_api import state_manager
+
+from conftest import BUCKET, REGION
+
+import covid_aws_de
+
+OUTPUT_LOCATION = f"s3://{BUCKET}/staging/"
+
+
+@pytest.fixture
+def athena(aws):
+    return boto3.client("athena", region_name=REGION)
+
+
+@pytest.fixture
+def polls():
+    """Make every query take this many status checks per state change"""
+    def set_polls(times):
+        state_manager.set_transition(model_name="athena::execution",
+                                     transition={"progression": "manual", "times": times})
+    yield set_polls
+    state_manager.unset_transition("athena::execution")
+
+
+def queue_results(*tables):
+    """Queue the CSV rows moto writes for the next queries, header row first"""
+    results = [{"rows": [{"Data": [{"VarCharValue": str(value)} for value in row]} for row in rows],
+                "column_info": [{"Name": name, "Type": "varchar"} for name in rows[0]]}
+               for rows in tables]
+    resp = requests.post("http://motoapi.amazonaws.com/moto-api/static/athena/query-results",
+                         json={"region": REGION, "results": results})
+    assert resp.status_code == 201
+
+
+def start(client, sql="SELECT 1"):
+    return client.start_query_execution(QueryString=sql, QueryExecutionContext={"Database": "covid19_db"},
+                                        ResultConfiguration={"OutputLocation": OUTPUT_LOCATION})
+
+
+def set_state(response, state):
+    athena_backends[DEFAULT_ACCOUNT_ID][REGION].executions[response["QueryExecutionId"]].status = state
+
+
+def test_wait_for_queries_backs_off_until_every_query_succeeds(athena, polls, sleeps):
+    polls(2)
+    responses = {"a": start(athena), "b": start(athena)}
+    done = [table for table, execution in covid_aws_de.wait_for_queries(athena, responses, max_delay=1.0)]
+    assert sorted(done) == ["a", "b"]
+    # QUEUED -> RUNNING -> SUCCEEDED takes four checks, the waits double up to the cap
+    assert sleeps == [0.25, 0.5, 1.0]
+
+
+@pytest.mark.parametrize("state", ["FAILED", "CANCELLED"])
+def test_wait_for_queries_raises_on_a_failed_query(athena, polls, sleeps, state):
+    polls(1)
+    responses = {"ok": start(athena), "broken": start(athena)}
+    set_state(responses["broken"], state)
+    with pytest.raises(RuntimeError, match=f"broken query {state}"):
+        list(covid_aws_de.wait_for_queries(athena, responses))
+
+
+def test_extract_tables_loads_each_result_with_its_dtypes(athena, sleeps):
+    queue_results([("fips", "county"), ("1001.0", "Autauga"), ("06037", "Los Angeles")],
+                  [("fips", "state"), ("1", "AL")])
+    s3 = boto3.client("s3", region_name=REGION)
+    dfs, locations = covid_aws_de.extract_tables(
+        ["nytimes_data_us_county", "rearc_testing_states_daily"], "covid19_db", OUTPUT_LOCATION,
+        dtypes={"nytimes_data_us_county": {"fips": "string", "county": "category"},
+                "rearc_testing_states_daily": {"fips": "string", "state": "category"}},
+        athena=athena, s3=s3)
+    county = dfs["nytimes_data_us_county"]
+    assert county["fips"].tolist() == ["1001", "6037"]
+    assert county["county"].dtype == "category"
+    assert dfs["rearc_testing_states_daily"]["state"].tolist() == ["AL"]
+    assert all(location.startswith(OUTPUT_LOCATION) for location in locations.values())
+
+
+def test_extract_tables_reuses_cached_results_without_querying(athena, sleeps):
+    s3 = boto3.client("s3", region_name=REGION)
+    s3.put_object(Bucket=BUCKET, Key="staging/old.csv", Body=b'"fips","county"\n"1001","Autauga"\n')
+    dfs, locations = covid_aws_de.extract_tables(
+        ["nytimes_data_us_county"], "covid19_db", OUTPUT_LOCATION,
+        dtypes={"nytimes_data_us_county": {"fips": "string"}},
+        cached={"nytimes_data_us_county": f"{OUTPUT_LOCATION}old.csv"}, athena=athena, s3=s3)
+    assert dfs["nytimes_data_us_county"]["county"].tolist() == ["Autauga"]
+    assert locations == {"nytimes_data_us_county": f"{OUTPUT_LOCATION}old.csv"}
+    assert athena.list_query_executions()["QueryExecutionIds"] == []
+
+
+def test_extract_tables_raises_when_a_query_fails(athena, polls, sleeps, monkeypatch):
+    polls(1)
+    submit = covid_aws_de.get_query_response
+
+    def failing_response(table, database, output_location, client):
+        response = submit(table, database, output_location, client=client)
+        if table == "enigma_jhu":
+            set_state(response, "FAILED")
+        return response
+
+    monkeypatch.setattr(covid_aws_de, "get_query_response", failing_response)
+    with pytest.raises(RuntimeError, match="enigma_jhu query FAILED"):
+        covid_aws_de.extract_tables(["enigma_jhu", "nytimes_data_us_county"], "covid19_db", OUTPUT_LOCATION,
+                                    athena=athena, s3=boto3.client("s3", region_name=REGION))
@@ -0,0 +1,28 @@
+# The per-stage benchmark runs on the dtypes the extraction produces
+import sys
+from pathlib import Path
+
+import boto3
+import pandas as pd
+
+from conftest import REGION
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "benchmarks"))
+import bench_stages  # noqa: E402
+from synthetic_sources import make_sources  # noqa: E402
+
+
+def test_sources_carry_the_extraction_dtypes():
+    sources = make_sources(1)
+    assert isinstance(sources["rearc_testing_states_daily"]["state"].dtype, pd.CategoricalDtype)
+    assert sources["nytimes_data_us_county"]["fips"].dtype == "string"
+    assert sources["enigma_jhu"]["fips"].dropna().str.len().between(4, 5).all()
+
+
+def test_every_stage_runs_at_the_smallest_scale(aws):
+    client = boto3.client("s3", region_name=REGION)
+    client.create_bucket(Bucket=bench_stages.BUCKET)
+    results = bench_stages.bench_scale(1, 1, 2, client)
+    assert [result["stage"] for result in results] == [
+        "dim_region", "dim_hospital", "dim_date", "fact_covid", "upload_parquet", "upload_csv"]
+    assert all(result["rows"] > 0 for result in results)
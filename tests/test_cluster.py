@@ -0,0 +1,73 @@
+# Reusing a kept Redshift cluster
+from datetime import datetime, timezone
+
+import boto3
+import pytest
+from botocore.stub import Stubber
+
+import covid_aws_de
+from conftest import REGION
+
+ROLE_ARN = "arn:aws:iam::123456789012:role/redshift-s3-access"
+
+
+def cluster(status, endpoint=False):
+    description = {"ClusterIdentifier": covid_aws_de.DWH_CLUSTER_IDENTIFIER, "ClusterStatus": status,
+                   "ClusterAvailabilityStatus": "Available" if endpoint else "Unavailable"}
+    if endpoint:
+        description["Endpoint"] = {"Address": "covid-de-dc.example", "Port": 5439}
+    return {"Clusters": [description]}
+
+
+def test_wait_for_cluster_resumes_a_paused_cluster_once(sleeps):
+    client = boto3.client("redshift", region_name=REGION)
+    identifier = {"ClusterIdentifier": covid_aws_de.DWH_CLUSTER_IDENTIFIER}
+    with Stubber(client) as stub:
+        stub.add_response("describe_clusters", cluster("paused"), identifier)
+        stub.add_response("resume_cluster", {}, identifier)
+        # Still paused right after the request, then resuming
+        stub.add_response("describe_clusters", cluster("paused"), identifier)
+        stub.add_response("describe_clusters", cluster("resuming"), identifier)
+        stub.add_response("describe_clusters", cluster("available", endpoint=True), identifier)
+        description = covid_aws_de.wait_for_cluster(client)
+        stub.assert_no_pending_responses()
+    assert description["Endpoint"]["Address"] == "covid-de-dc.example"
+    assert sleeps == [10.0, 20.0, 40.0]
+
+
+def test_a_cluster_still_being_deleted_is_waited_for_then_restored(sleeps, monkeypatch):
+    monkeypatch.setattr(covid_aws_de, "DWH_LIFECYCLE", "snapshot")
+    client = boto3.client("redshift", region_name=REGION)
+    identifier = {"ClusterIdentifier": covid_aws_de.DWH_CLUSTER_IDENTIFIER}
+    snapshot = f"{covid_aws_de.DWH_SNAPSHOT_PREFIX}-20210308000000"
+    with Stubber(client) as stub:
+        stub.add_response("describe_clusters", cluster("deleting"), identifier)
+        stub.add_response("describe_clusters", cluster("deleting"), identifier)
+        stub.add_client_error("describe_clusters", "ClusterNotFound", expected_params=identifier)
+        stub.add_response("describe_cluster_snapshots", {"Snapshots": [
+            {"SnapshotIdentifier": snapshot, "Status": "available",
+             "SnapshotCreateTime": datetime(2021, 3, 8, tzinfo=timezone.utc)}]},
+            {**identifier, "SnapshotType": "manual"})
+        stub.add_response("restore_from_cluster_snapshot", {}, {
+            **identifier, "SnapshotIdentifier": snapshot, "NodeType": covid_aws_de.DWH_NODE_TYPE,
+            "NumberOfNodes": int(covid_aws_de.DWH_NUM_NODES), "IamRoles": [ROLE_ARN]})
+        stub.add_response("describe_clusters", cluster("creating"), identifier)
+        stub.add_response("describe_clusters", cluster("available", endpoint=True), identifier)
+        description = covid_aws_de.start_cluster(ROLE_ARN, client)
+        stub.assert_no_pending_responses()
+    assert description["ClusterStatus"] == "available"
+    assert sleeps == [10.0, 10.0]
+
+
+def test_waiting_for_a_cluster_that_is_being_deleted_fails(sleeps):
+    client = boto3.client("redshift", region_name=REGION)
+    with Stubber(client) as stub:
+        stub.add_response("describe_clusters", cluster("deleting"))
+        with pytest.raises(RuntimeError, match="being deleted"):
+            covid_aws_de.wait_for_cluster(client)
+
+
+def test_cluster_properties_print_on_the_installed_pandas(capsys):
+    description = cluster("available", endpoint=True)["Clusters"][0]
+    print(covid_aws_de.prettyRedshiftProps(description).to_string(index=False))
+    assert "covid-de-dc.example" in capsys.readouterr().out
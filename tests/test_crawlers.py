@@ -0,0 +1,59 @@
+# Waiting for the Glue crawlers of the crawl stage
+from datetime import datetime, timezone
+
+import boto3
+from botocore.stub import Stubber
+
+import covid_aws_de
+from conftest import REGION
+
+LAST_RUN = datetime(2021, 3, 1, tzinfo=timezone.utc)
+THIS_RUN = datetime(2021, 3, 8, tzinfo=timezone.utc)
+
+
+def crawler(name, state, last_start=None):
+    description = {"Name": name, "State": state}
+    if last_start:
+        description["LastCrawl"] = {"Status": "SUCCEEDED", "StartTime": last_start}
+    return {"Crawler": description}
+
+
+def test_a_new_crawler_still_ready_without_a_crawl_is_not_done(sleeps):
+    client = boto3.client("glue", region_name=REGION)
+    name = {"Name": "enigma_jhu_crawl"}
+    with Stubber(client) as stub:
+        stub.add_response("get_crawler", crawler("enigma_jhu_crawl", "READY"), name)
+        stub.add_response("start_crawler", {}, name)
+        stub.add_response("get_crawler", crawler("enigma_jhu_crawl", "READY"), name)
+        stub.add_response("get_crawler", crawler("enigma_jhu_crawl", "RUNNING"), name)
+        stub.add_response("get_crawler", crawler("enigma_jhu_crawl", "READY", THIS_RUN), name)
+        statuses = covid_aws_de.run_crawlers(client, ["enigma_jhu_crawl"])
+        stub.assert_no_pending_responses()
+    assert statuses == {"enigma_jhu_crawl": "SUCCEEDED"}
+    assert len(sleeps) == 3
+
+
+def test_ready_with_the_previous_crawl_is_not_done(sleeps):
+    client = boto3.client("glue", region_name=REGION)
+    name = {"Name": "enigma_jhu_crawl"}
+    with Stubber(client) as stub:
+        stub.add_response("get_crawler", crawler("enigma_jhu_crawl", "READY", LAST_RUN), name)
+        stub.add_response("start_crawler", {}, name)
+        stub.add_response("get_crawler", crawler("enigma_jhu_crawl", "READY", LAST_RUN), name)
+        stub.add_response("get_crawler", crawler("enigma_jhu_crawl", "READY", THIS_RUN), name)
+        covid_aws_de.run_crawlers(client, ["enigma_jhu_crawl"])
+        stub.assert_no_pending_responses()
+    assert len(sleeps) == 2
+
+
+def test_a_crawler_already_running_is_waited_for(sleeps):
+    client = boto3.client("glue", region_name=REGION)
+    name = {"Name": "enigma_jhu_crawl"}
+    with Stubber(client) as stub:
+        stub.add_response("get_crawler", crawler("enigma_jhu_crawl", "RUNNING", LAST_RUN), name)
+        stub.add_client_error("start_crawler", "CrawlerRunningException", expected_params=name)
+        stub.add_response("get_crawler", crawler("enigma_jhu_crawl", "STOPPING", LAST_RUN), name)
+        stub.add_response("get_crawler", crawler("enigma_jhu_crawl", "READY", THIS_RUN), name)
+        statuses = covid_aws_de.run_crawlers(client, ["enigma_jhu_crawl"])
+        stub.assert_no_pending_responses()
+    assert statuses == {"enigma_jhu_crawl": "SUCCEEDED"}
@@ -0,0 +1,71 @@
+# Generated warehouse DDL sized from the data, with headroom for later loads
+import pandas as pd
+
+import dwh_ddl
+
+
+def dim_hospital(names, addresses, zip_codes, sks=None):
+    return pd.DataFrame({
+        "hosp_sk": pd.array(sks or range(1, len(names) + 1), dtype="int64"),
+        "fips": ["01001", "06037"][:len(names)],
+        "state_fips": ["01", "06"][:len(names)],
+        "hospital_name": names,
+        "hq_address": addresses,
+        "hq_zip_code": zip_codes,
+        "latitude": pd.array([32.4, 34.0][:len(names)], dtype="float32"),
+    })
+
+
+def test_only_key_columns_are_not_null():
+    ddl = dwh_ddl.table_ddl("dim_hospital", dim_hospital(["Cedars"], ["1 Main St"], ["36067"]))
+    not_null = [line.split()[0] for line in ddl.splitlines() if "NOT NULL" in line]
+    assert not_null == ['"hosp_sk"']
+
+
+def test_text_is_sized_from_its_longest_value_with_headroom():
+    ddl = dwh_ddl.table_ddl("dim_hospital", dim_hospital(
+        ["Prattville Baptist Hospital Medical Center", "Cedars"], ["124 South Memorial Drive", None],
+        ["36067", "90048"]))
+    # 42, 24 and 5 bytes at most, twice that rounded up to a power of two
+    assert '"hospital_name" VARCHAR(128)' in ddl
+    assert '"hq_address" VARCHAR(64)' in ddl
+    assert '"hq_zip_code" VARCHAR(16)' in ddl
+    assert '"fips" CHAR(5)' in ddl and '"state_fips" CHAR(2)' in ddl
+    assert '"latitude" REAL' in ddl
+
+
+def test_a_later_load_within_the_headroom_fits_the_types_of_the_first():
+    today = dim_hospital(["Cedars Sinai", "Good Samaritan"], ["1 Main St", "2 Main St"], ["36067", "90048"])
+    later = dim_hospital(["Cedars Sinai Medical Ctr", "X"], ["1234 Main Street", None], ["36067-1234", None],
+                         sks=[12, 13])
+    for col in ["hospital_name", "hq_address", "hq_zip_code"]:
+        width = int(dwh_ddl.column_type(col, dwh_ddl.column_stats(today[col]))[len("VARCHAR("):-1])
+        assert dwh_ddl.column_stats(later[col])["max_width"] <= width
+    assert dwh_ddl.column_type("hosp_sk", dwh_ddl.column_stats(today["hosp_sk"]), key=True) == "INTEGER"
+
+
+def test_integers_get_the_narrowest_type_with_headroom():
+    assert dwh_ddl.int_type(300) == "SMALLINT"
+    assert dwh_ddl.int_type(400) == "INTEGER"
+    assert dwh_ddl.int_type(20_000_000) == "INTEGER"
+    assert dwh_ddl.int_type(30_000_000) == "BIGINT"
+    fact = pd.DataFrame({"date": [20210301], "state_fips": ["01"], "positiveincrease": pd.array([120]),
+                         "hosp_sk": pd.array([3])})
+    ddl = dwh_ddl.table_ddl("fact_covid", fact)
+    assert '"positiveincrease" SMALLINT' in ddl
+    # Keys are at least INTEGER so they match the table they reference
+    assert '"hosp_sk" INTEGER' in ddl and '"date" INTEGER NOT NULL' in ddl
+    # Parquet COPY needs the physical width of the column
+    assert '"hosp_sk" BIGINT NOT NULL' in dwh_ddl.table_ddl(
+        "dim_hospital", dim_hospital(["Cedars"], ["1 Main St"], ["36067"]), exact_ints=True)
+
+
+def test_columns_without_values_keep_safe_types():
+    df = dim_hospital(["Cedars"], [None], ["36067"]).astype({"hq_address": "object"})
+    df["hosp_sk"] = pd.array([None], dtype="Int64")
+    ddl = dwh_ddl.table_ddl("dim_hospital", df)
+    assert '"hosp_sk" BIGINT NOT NULL' in ddl and '"hq_address" VARCHAR(16)' in ddl
+
+
+def test_text_longer_than_the_largest_varchar_is_capped():
+    assert dwh_ddl.string_width(40_000) == dwh_ddl.MAX_STRING_WIDTH
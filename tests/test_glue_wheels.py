@@ -0,0 +1,65 @@
+# Content-addressed uploads of the Glue job wheels
+import hashlib
+
+import boto3
+import pytest
+import responses
+
+import covid_aws_de
+import glue_wheels
+from conftest import BUCKET, REGION
+
+
+def pypi_url(filename, body):
+    """Files URL PyPI would serve body under"""
+    digest = hashlib.blake2b(body, digest_size=32).hexdigest()
+    return f"https://files.pythonhosted.org/packages/{digest[:2]}/{digest[2:4]}/{digest[4:]}/{filename}"
+
+
+BODIES = {"a-1.0-py3-none-any.whl": b"a wheel", "b-2.0-py3-none-any.whl": b"b wheel"}
+WHEELS = [(filename, pypi_url(filename, body)) for filename, body in BODIES.items()]
+
+
+@pytest.fixture
+def wheels(aws, monkeypatch):
+    monkeypatch.setattr(glue_wheels, "GLUE_JOB_WHEELS", WHEELS)
+    monkeypatch.setattr(covid_aws_de, "bucket_indexes", {})
+    with responses.RequestsMock() as mock:
+        for filename, url in WHEELS:
+            mock.get(url, body=BODIES[filename])
+        yield mock
+
+
+def uploaded():
+    s3 = boto3.client("s3", region_name=REGION)
+    return sorted(obj["Key"] for obj in s3.list_objects_v2(Bucket=BUCKET).get("Contents", []))
+
+
+def test_wheels_are_uploaded_under_the_digest_in_their_url(wheels):
+    keys = covid_aws_de.upload_glue_wheels({})["wheel_keys"]
+    assert keys == [f"packages/{glue_wheels.url_digest(url)[:16]}/{filename}" for filename, url in WHEELS]
+    assert uploaded() == sorted(keys)
+    assert len(wheels.calls) == len(WHEELS)
+
+
+def test_a_rerun_makes_no_http_calls(wheels, monkeypatch):
+    keys = covid_aws_de.upload_glue_wheels({})["wheel_keys"]
+    wheels.reset()
+    # A fresh index, as in the next run
+    monkeypatch.setattr(covid_aws_de, "bucket_indexes", {})
+    assert covid_aws_de.upload_glue_wheels({})["wheel_keys"] == keys
+    assert len(wheels.calls) == 0
+
+
+def test_a_download_that_does_not_match_its_digest_is_not_uploaded(wheels):
+    wheels.replace(responses.GET, WHEELS[1][1], body=b"tampered")
+    with pytest.raises(ValueError, match="blake2b"):
+        covid_aws_de.upload_glue_wheels({})
+    assert uploaded() == [glue_wheels.wheel_key("packages/", *WHEELS[0])]
+
+
+def test_wheel_keys_of_the_pinned_wheels():
+    filename, url = glue_wheels.GLUE_JOB_WHEELS[0]
+    assert glue_wheels.wheel_key("packages/", filename, url) == f"packages/243c471f5f7d43f1/{filename}"
+    with pytest.raises(ValueError):
+        glue_wheels.check_digest(url, b"not the wheel")
@@ -0,0 +1,66 @@
+# Conditional ingest of a source URL into S3
+import boto3
+import pytest
+import responses
+
+import covid_aws_de
+from conftest import BUCKET, REGION
+
+URL = "https://covid19-lake.s3.us-east-2.amazonaws.com/enigma-jhu/csv/Enigma-JHU.csv.gz"
+LAST_MODIFIED = "Mon, 01 Mar 2021 00:00:00 GMT"
+
+
+@pytest.fixture
+def s3(aws, monkeypatch):
+    monkeypatch.setattr(covid_aws_de, "bucket_indexes", {})
+    client = boto3.client("s3", region_name=REGION)
+    client.put_object(Bucket=BUCKET, Key="enigma-jhu/", Body=b"")
+    return client
+
+
+def ingest(previous=None):
+    return covid_aws_de.url_download_upload(BUCKET, "enigma-jhu/", "Enigma-JHU.csv.gz", URL, previous)
+
+
+def uploaded(s3):
+    return s3.get_object(Bucket=BUCKET, Key="enigma-jhu/Enigma-JHU.csv.gz")["Body"].read()
+
+
+@responses.activate
+def test_an_unchanged_source_is_skipped_and_a_changed_one_uploaded_again(s3):
+    responses.get(URL, body=b"v1 rows", headers={"ETag": '"v1"'})
+    first = ingest()
+    assert first["changed"] and first["etag"] == '"v1"' and uploaded(s3) == b"v1 rows"
+
+    responses.replace(responses.GET, URL, status=304,
+                      match=[responses.matchers.header_matcher({"If-None-Match": '"v1"'})])
+    again = ingest(first)
+    assert not again["changed"] and again["bytes"] == 0 and again["etag"] == '"v1"'
+
+    responses.replace(responses.GET, URL, body=b"v2 rows", headers={"ETag": '"v2"'})
+    changed = ingest(first)
+    assert changed["changed"] and changed["etag"] == '"v2"' and uploaded(s3) == b"v2 rows"
+
+
+@responses.activate
+def test_a_server_without_conditional_requests_is_compared_by_its_headers(s3):
+    responses.get(URL, body=b"v1 rows", headers={"Last-Modified": LAST_MODIFIED, "Content-Length": "7"})
+    first = ingest()
+    assert first["last_modified"] == LAST_MODIFIED and first["size"] == len(b"v1 rows")
+    assert not ingest(first)["changed"]
+
+    responses.replace(responses.GET, URL, body=b"v2 rows, one more",
+                      headers={"Last-Modified": LAST_MODIFIED, "Content-Length": "17"})
+    assert ingest(first)["changed"]
+    assert uploaded(s3) == b"v2 rows, one more"
+
+
+@responses.activate
+def test_the_validators_are_ignored_once_our_copy_is_gone(s3):
+    responses.get(URL, body=b"v1 rows", headers={"ETag": '"v1"'})
+    first = ingest()
+    s3.delete_object(Bucket=BUCKET, Key="enigma-jhu/Enigma-JHU.csv.gz")
+    covid_aws_de.bucket_indexes.clear()
+    assert ingest(first)["changed"]
+    assert "If-None-Match" not in responses.calls[-1].request.headers
+    assert uploaded(s3) == b"v1 rows"
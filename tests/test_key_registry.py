@@ -0,0 +1,69 @@
+# Surrogate keys that stay stable across runs
+import boto3
+import pandas as pd
+
+import key_registry
+import transforms
+from conftest import BUCKET, REGION
+
+KEY = "registry/dim_hospital.parquet"
+
+
+def hospitals(*rows):
+    return pd.DataFrame(rows, columns=["fips", "hospital_name", "hq_address"])
+
+
+def registry(keys=None):
+    return key_registry.KeyRegistry(*key_registry.REGISTRY_KEYS["dim_hospital"], keys)
+
+
+def test_new_members_get_keys_after_the_current_max():
+    keys = hospitals(("01001", "Prattville Baptist", "124 S Memorial Dr"),
+                     ("06037", "Cedars", "8700 Beverly Blvd")).assign(hosp_sk=[1, 7])
+    reg = registry(keys)
+    assigned = reg.assign(hospitals(("06037", "Good Samaritan", "1225 Wilshire Blvd"),
+                                    ("06037", "Cedars", "8700 Beverly Blvd"),
+                                    ("06037", "Olive View", None)))
+    assert assigned.tolist() == [8, 7, 9]
+    assert assigned.dtype == "int32" and reg.added == 2
+
+
+def test_keys_are_kept_across_runs(aws):
+    s3 = boto3.client("s3", region_name=REGION)
+    first = key_registry.load_registry(s3, BUCKET, KEY, "dim_hospital")
+    run1 = hospitals(("01001", "Prattville Baptist", "124 S Memorial Dr"), ("06037", "Cedars", "8700 Beverly Blvd"))
+    assert first.assign(run1).tolist() == [1, 2]
+    key_registry.save_registry(s3, BUCKET, KEY, first)
+
+    # Prattville left the source for a run, Cedars moved up and a hospital was added
+    second = key_registry.load_registry(s3, BUCKET, KEY, "dim_hospital")
+    run2 = hospitals(("06037", "Good Samaritan", "1225 Wilshire Blvd"), ("06037", "Cedars", "8700 Beverly Blvd"))
+    assert second.assign(run2).tolist() == [3, 2]
+    key_registry.save_registry(s3, BUCKET, KEY, second)
+
+    third = key_registry.load_registry(s3, BUCKET, KEY, "dim_hospital")
+    assert third.assign(pd.concat([run2, run1[:1]], ignore_index=True)).tolist() == [3, 2, 1]
+    assert third.added == 0
+
+
+def test_keys_do_not_depend_on_the_source_row_order():
+    beds = pd.DataFrame({
+        "fips": pd.array(["6037", "1001", "6037", "6037"], dtype="string"),
+        "state_name": pd.Categorical(["California", "Alabama", "California", "California"]),
+        "county_name": pd.Categorical(["Los Angeles", "Autauga", "Los Angeles", "Los Angeles"]),
+        "latitude": [34.0, 32.4, 34.1, 34.2],
+        "longtitude": [-118.3, -86.5, -118.4, -118.5],
+        "hospital_name": pd.array(["Cedars", "Prattville Baptist", "Good Samaritan", "Olive View"], dtype="string"),
+        "hq_address": pd.array(["8700 Beverly Blvd", "124 S Memorial Dr", "1225 Wilshire Blvd", None],
+                               dtype="string"),
+        "hq_city": pd.array(["Los Angeles", "Prattville", "Los Angeles", "Sylmar"], dtype="string"),
+        "hq_state": pd.Categorical(["CA", "AL", "CA", "CA"]),
+        "hq_zip_code": pd.array(["90048", "36067", "90017", "91342"], dtype="string"),
+        "hospital_type": pd.Categorical(["Short Term Acute Care Hospital"] * 4),
+    })
+
+    def keys(rows):
+        dim_hospital = transforms.build_dim_hospital(rows, registry())
+        return dict(zip(dim_hospital["hospital_name"], dim_hospital["hosp_sk"]))
+
+    assert keys(beds) == keys(beds[::-1]) == keys(beds.sample(frac=1, random_state=3))
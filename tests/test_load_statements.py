@@ -0,0 +1,168 @@
+# The warehouse load batch and its run through a moto Redshift Data API
+import boto3
+import pytest
+from moto.core import DEFAULT_ACCOUNT_ID
+from moto.redshiftdata.models import redshiftdata_backends
+
+import covid_aws_de
+import dwh_sql
+from conftest import REGION
+
+ROLE_ARN = "arn:aws:iam::123456789012:role/redshift-s3-access"
+
+
+def load_state(**state):
+    return {"redshift_role_arn": ROLE_ARN, "new_dates": True, "fact_watermark": None, "fact_cutoff": None,
+            **state}
+
+
+def flat(sql):
+    return " ".join(sql.split())
+
+
+def position(statements, prefix):
+    """Index of the first statement starting with prefix"""
+    return next(i for i, sql in enumerate(statements) if flat(sql).startswith(prefix))
+
+
+def test_statements_create_load_refresh_and_expose_in_order():
+    statements = covid_aws_de.build_load_statements(load_state())
+    ddl = [position(statements, f'CREATE TABLE IF NOT EXISTS "{table}"')
+           for table in list(dwh_sql.TABLE_DDL) + list(dwh_sql.ROLLUP_DDL)]
+    assert ddl == list(range(len(ddl)))
+    loads = [position(statements, f"copy {table}") for table in ["dim_region", "dim_hospital", "dim_date_stage",
+                                                                 "fact_covid"]]
+    assert ddl[-1] < loads[0] and loads == sorted(loads)
+    refresh = position(statements, "DELETE FROM agg_state_daily")
+    views = position(statements, "CREATE OR REPLACE VIEW")
+    assert loads[-1] < refresh < position(statements, "INSERT INTO agg_state_totals") < views
+    assert len(statements) - views == len(dwh_sql.VIEW_SQL)
+
+
+def test_generated_ddl_replaces_the_static_ddl():
+    statements = covid_aws_de.build_load_statements(load_state(table_ddl={"dim_region": "CREATE TABLE generated"}))
+    assert statements[list(dwh_sql.TABLE_DDL).index("dim_region")] == "CREATE TABLE generated"
+    assert statements.count(dwh_sql.TABLE_DDL["dim_hospital"]) == 1
+
+
+def test_dim_date_is_skipped_without_new_dates_and_appended_by_key_otherwise():
+    skipped = [flat(sql) for sql in covid_aws_de.build_load_statements(load_state(new_dates=False))]
+    assert not any("dim_date_stage" in sql for sql in skipped)
+    appended = [flat(sql) for sql in covid_aws_de.build_load_statements(load_state())]
+    assert not any(sql.startswith("copy dim_date ") for sql in appended)
+    insert = next(sql for sql in appended if sql.startswith("INSERT INTO dim_date"))
+    assert "WHERE NOT EXISTS (SELECT 1 FROM dim_date WHERE dim_date.date_id = dim_date_stage.date_id)" in insert
+
+
+def test_full_load_replaces_fact_covid_and_rebuilds_the_rollups():
+    statements = [flat(sql) for sql in covid_aws_de.build_load_statements(load_state())]
+    assert "DELETE FROM fact_covid" in statements
+    assert not any(sql.startswith("MERGE INTO fact_covid") for sql in statements)
+    assert "DELETE FROM agg_state_daily" in statements
+    rollup = next(sql for sql in statements if sql.startswith("INSERT INTO agg_state_daily"))
+    assert "WHERE fc.date >" not in rollup
+
+
+def test_incremental_load_merges_fact_covid_and_refreshes_the_days_after_the_cutoff():
+    statements = [flat(sql) for sql in covid_aws_de.build_load_statements(
+        load_state(fact_watermark=20210307, fact_cutoff=20210228))]
+    assert "DELETE FROM fact_covid" not in statements
+    merge = statements.index(next(sql for sql in statements if sql.startswith("MERGE INTO fact_covid")))
+    assert statements[merge - 2] == "CREATE TEMP TABLE fact_covid_stage (LIKE fact_covid)"
+    assert statements[merge + 1] == "DROP TABLE fact_covid_stage"
+    assert "DELETE FROM agg_state_daily WHERE date_id > 20210228" in statements
+    rollup = next(sql for sql in statements if sql.startswith("INSERT INTO agg_state_daily"))
+    assert rollup.endswith("WHERE fc.date > 20210228")
+
+
+def test_athena_engine_copies_parquet(monkeypatch):
+    monkeypatch.setattr(covid_aws_de, "TRANSFORM_ENGINE", "athena")
+    monkeypatch.setattr(covid_aws_de, "OUTPUT_FORMAT", "csv")
+    copies = [flat(sql) for sql in covid_aws_de.build_load_statements(load_state()) if flat(sql).startswith("copy")]
+    assert copies and all(sql.endswith("MANIFEST FORMAT AS PARQUET") for sql in copies)
+
+
+class BatchClient:
+    """moto has no batch_execute_statement, the batch runs as one statement there"""
+
+    def __init__(self, client):
+        self.client = client
+        self.sqls = None
+
+    def batch_execute_statement(self, Sqls, StatementName, **kwargs):
+        self.sqls = Sqls
+        return self.client.execute_statement(Sql=";\n".join(Sqls), **kwargs)
+
+    def describe_statement(self, **kwargs):
+        return self.client.describe_statement(**kwargs)
+
+
+@pytest.fixture
+def redshift_data(aws):
+    return boto3.client("redshift-data", region_name=REGION)
+
+
+@pytest.fixture
+def finish_after(monkeypatch):
+    """Move a statement to a final state once it has been polled this many times"""
+    def finish(statement_id, polls, status="FINISHED"):
+        delays = []
+
+        def sleep(delay):
+            delays.append(delay)
+            if len(delays) == polls:
+                redshiftdata_backends[DEFAULT_ACCOUNT_ID][REGION].statements[statement_id].status = status
+        monkeypatch.setattr(covid_aws_de.time, "sleep", sleep)
+        return delays
+    return finish
+
+
+def execute(client, sql="SELECT 1"):
+    return client.execute_statement(ClusterIdentifier="covid-de-dc", Database="covid_dw", DbUser="dwuser",
+                                    Sql=sql)["Id"]
+
+
+def test_wait_for_statement_polls_with_backoff_until_finished(redshift_data, finish_after):
+    statement_id = execute(redshift_data)
+    delays = finish_after(statement_id, 3)
+    statement = covid_aws_de.wait_for_statement(statement_id, redshift_data, max_delay=3.0)
+    assert statement["Status"] == "FINISHED"
+    assert delays == [1.0, 2.0, 3.0]
+
+
+@pytest.mark.parametrize("status", ["FAILED", "ABORTED"])
+def test_wait_for_statement_raises_when_the_statement_does_not_finish(redshift_data, finish_after, status):
+    statement_id = execute(redshift_data)
+    finish_after(statement_id, 1, status)
+    with pytest.raises(RuntimeError, match=f"{statement_id} {status}"):
+        covid_aws_de.wait_for_statement(statement_id, redshift_data)
+
+
+def test_run_data_api_load_submits_the_batch_and_waits(redshift_data, finish_after, monkeypatch):
+    client = BatchClient(redshift_data)
+    statements = covid_aws_de.build_load_statements(load_state())
+    execute_statement = redshift_data.execute_statement
+
+    def submitted(**kwargs):
+        response = execute_statement(**kwargs)
+        finish_after(response["Id"], 2)
+        return response
+
+    monkeypatch.setattr(redshift_data, "execute_statement", submitted)
+    statement = covid_aws_de.run_data_api_load(statements, client)
+    assert statement["Status"] == "FINISHED"
+    assert client.sqls == statements
+
+
+def test_run_data_api_load_raises_when_the_batch_fails(redshift_data, finish_after, monkeypatch):
+    client = BatchClient(redshift_data)
+    execute_statement = redshift_data.execute_statement
+
+    def submitted(**kwargs):
+        response = execute_statement(**kwargs)
+        finish_after(response["Id"], 1, "FAILED")
+        return response
+
+    monkeypatch.setattr(redshift_data, "execute_statement", submitted)
+    with pytest.raises(RuntimeError, match="FAILED"):
+        covid_aws_de.run_data_api_load(["SELECT 1"], client)
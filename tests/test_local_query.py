@@ -0,0 +1,73 @@
+# The DuckDB backend's source cache and a transform stage run without AWS
+import os
+import sys
+from pathlib import Path
+
+import botocore.client
+import pandas as pd
+import pytest
+import requests
+import responses
+
+import covid_aws_de
+import local_query
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "benchmarks"))
+from synthetic_sources import make_sources  # noqa: E402
+
+URL = "https://covid19-lake.s3.us-east-2.amazonaws.com/static-datasets/csv/state-abv/states_abv.csv"
+
+
+def cached(cache_dir):
+    with open(os.path.join(cache_dir, "states_abv.csv")) as f:
+        return f.read()
+
+
+@responses.activate
+def test_cache_downloads_again_only_when_the_source_changed(tmp_path):
+    local = local_query.LocalQuery(str(tmp_path))
+    responses.get(URL, body="State,Abbreviation\n", headers={"ETag": '"v1"'})
+    assert local.cache([URL]) == ["states_abv.csv"]
+
+    responses.replace(responses.GET, URL, status=304,
+                      match=[responses.matchers.header_matcher({"If-None-Match": '"v1"'})])
+    assert local.cache([URL]) == []
+    assert cached(tmp_path) == "State,Abbreviation\n"
+
+    responses.replace(responses.GET, URL, body="State,Abbreviation\nAlabama,AL\n", headers={"ETag": '"v2"'})
+    assert local.cache([URL]) == ["states_abv.csv"]
+    assert cached(tmp_path) == "State,Abbreviation\nAlabama,AL\n"
+    assert local.load_validators()["states_abv.csv"]["etag"] == '"v2"'
+
+
+@responses.activate
+def test_cache_uses_the_cached_copy_when_the_source_is_unreachable(tmp_path):
+    local = local_query.LocalQuery(str(tmp_path))
+    responses.get(URL, body="State,Abbreviation\n", headers={"ETag": '"v1"'})
+    local.cache([URL])
+
+    responses.replace(responses.GET, URL, body=requests.ConnectionError("offline"))
+    assert local.cache([URL]) == []
+    assert cached(tmp_path) == "State,Abbreviation\n"
+
+    with pytest.raises(requests.ConnectionError):
+        local_query.LocalQuery(str(tmp_path / "empty")).cache([URL])
+
+
+def test_offline_transform_makes_no_aws_calls(tmp_path, monkeypatch):
+    def no_aws(self, operation_name, api_params):
+        raise AssertionError(f"{operation_name} called while offline")
+
+    monkeypatch.setattr(botocore.client.BaseClient, "_make_api_call", no_aws)
+    monkeypatch.setattr(covid_aws_de, "TRANSFORM_OFFLINE", True)
+    monkeypatch.setattr(covid_aws_de, "QUERY_BACKEND", "duckdb")
+    monkeypatch.setattr(covid_aws_de, "FACT_LOAD_MODE", "incremental")
+    monkeypatch.setattr(covid_aws_de, "LOCAL_CACHE_DIR", str(tmp_path))
+    monkeypatch.setattr(covid_aws_de, "extract_local_tables", lambda tables: make_sources(1))
+
+    state = covid_aws_de.transform_tables({})
+    assert state["fact_watermark"] is None and state["new_dates"]
+    for table in ["fact_covid", "dim_date", "dim_hospital", "dim_region"]:
+        assert os.path.exists(tmp_path / "output" / f"{table}.manifest")
+    parts = sorted((tmp_path / "output" / "dim_region").iterdir())
+    assert pd.read_parquet(parts[0])["region_sk"].iloc[0] == 1
@@ -0,0 +1,89 @@
+# Scheduling, checkpointing and resuming of the pipeline task graph
+import json
+import threading
+
+import pytest
+
+from pipeline import Pipeline, Task
+
+
+class Recorder:
+    """Stub task functions that log when they start and finish"""
+
+    def __init__(self):
+        self.events = []
+        self.lock = threading.Lock()
+
+    def log(self, event):
+        with self.lock:
+            self.events.append(event)
+
+    def task(self, name, deps=(), fail=False):
+        def fn(state):
+            self.log(("start", name))
+            if fail:
+                raise RuntimeError(f"{name} broke")
+            self.log(("end", name))
+            return {name: sorted(state)}
+        return Task(name, fn, deps)
+
+    def started(self):
+        return [name for event, name in self.events if event == "start"]
+
+    def before(self, first, then):
+        return self.events.index(("end", first)) < self.events.index(("start", then))
+
+
+def diamond(recorder, fail=()):
+    return [recorder.task("ingest", fail="ingest" in fail),
+            recorder.task("crawl", ["ingest"], fail="crawl" in fail),
+            recorder.task("wheels", fail="wheels" in fail),
+            recorder.task("transform", ["crawl"], fail="transform" in fail),
+            recorder.task("load", ["transform", "wheels"], fail="load" in fail)]
+
+
+def test_tasks_start_after_their_dependencies(tmp_path):
+    recorder = Recorder()
+    state = Pipeline(diamond(recorder), str(tmp_path / "checkpoint.json")).run()
+    assert sorted(recorder.started()) == ["crawl", "ingest", "load", "transform", "wheels"]
+    assert recorder.before("ingest", "crawl") and recorder.before("crawl", "transform")
+    assert recorder.before("transform", "load") and recorder.before("wheels", "load")
+    # Every task sees the state its dependencies returned
+    assert {"ingest", "crawl"} <= set(state["transform"])
+    assert not (tmp_path / "checkpoint.json").exists()
+
+
+def test_a_failed_task_stops_its_dependents_and_keeps_the_finished_ones(tmp_path):
+    recorder = Recorder()
+    path = tmp_path / "checkpoint.json"
+    with pytest.raises(RuntimeError, match="crawl broke"):
+        Pipeline(diamond(recorder, fail={"crawl"}), str(path), max_workers=1).run()
+    assert "transform" not in recorder.started() and "load" not in recorder.started()
+    checkpoint = json.loads(path.read_text())
+    # wheels was already running when crawl failed and is kept
+    assert set(checkpoint["done"]) == {"ingest", "wheels"}
+    assert set(checkpoint["state"]) == set(checkpoint["done"])
+
+
+def test_a_rerun_resumes_after_the_checkpointed_tasks(tmp_path):
+    path = str(tmp_path / "checkpoint.json")
+    with pytest.raises(RuntimeError):
+        Pipeline(diamond(Recorder(), fail={"transform"}), path).run()
+
+    recorder = Recorder()
+    state = Pipeline(diamond(recorder), path).run()
+    assert sorted(recorder.started()) == ["load", "transform"]
+    # State saved by the first run is handed to the resumed tasks
+    assert {"ingest", "crawl", "wheels"} <= set(state["load"])
+
+    recorder = Recorder()
+    Pipeline(diamond(recorder), path, resume=False).run()
+    assert len(recorder.started()) == 5
+
+
+def test_unknown_and_circular_dependencies_are_errors(tmp_path):
+    recorder = Recorder()
+    with pytest.raises(ValueError, match="unknown tasks"):
+        Pipeline([recorder.task("load", ["transform"])], str(tmp_path / "checkpoint.json"))
+    with pytest.raises(RuntimeError, match="never became ready"):
+        Pipeline([recorder.task("a", ["b"]), recorder.task("b", ["a"])], str(tmp_path / "checkpoint.json")).run()
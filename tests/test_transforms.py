@@ -0,0 +1,75 @@
+# The star schema builders on frames typed like the extraction returns them
+import numpy as np
+import pandas as pd
+import pytest
+
+import fips_codec
+import transforms
+
+
+@pytest.fixture
+def sources():
+    """Source extracts with the code, category and nullable columns of the typed extraction"""
+    enigma_jhu = pd.DataFrame({
+        "fips": pd.array(["1001", "1003", "72001", "6037"], dtype="string"),
+        "province_state": pd.Categorical(["Alabama", "Alabama", "Puerto Rico", "California"]),
+        "country_region": pd.Categorical(["US"] * 4),
+        "latitude": [32.5, 30.7, 18.2, 34.3],
+        "longitude": [-86.6, -87.7, -66.7, -118.2],
+    })
+    nytimes_data_us_county = pd.DataFrame({
+        "fips": pd.array(["1001", "1003", "72001", "6037"], dtype="string"),
+        "county": pd.Categorical(["Autauga", "Baldwin", "Adjuntas", "Los Angeles"]),
+    })
+    rearc_usa_hospital_beds = pd.DataFrame({
+        "fips": pd.array(["1001", "6037", "6037"], dtype="string"),
+        "state_name": pd.Categorical(["Alabama", "California", "California"]),
+        "county_name": pd.Categorical(["Autauga", "Los Angeles", "Los Angeles"]),
+        "latitude": [32.4, 34.0, 34.1],
+        "longtitude": [-86.5, -118.3, -118.4],
+        "hospital_name": pd.array(["Prattville Baptist", "Cedars", "Good Samaritan"], dtype="string"),
+        "hq_address": pd.array(["124 S Memorial Dr", "8700 Beverly Blvd", "1225 Wilshire Blvd"], dtype="string"),
+        "hq_city": pd.array(["Prattville", "Los Angeles", "Los Angeles"], dtype="string"),
+        "hq_state": pd.Categorical(["AL", "CA", "CA"]),
+        "hq_zip_code": pd.array(["36067", "90048", "90017"], dtype="string"),
+        "hospital_type": pd.Categorical(["Short Term Acute Care Hospital"] * 3),
+    })
+    measures = {col: pd.array([np.nan, 5.0, 7.0], dtype="float64")
+                for col in ["positive", "negative", "hospitalized", "hospitalizedcurrently",
+                            "hospitalizeddischarged", "hospitalizedcumulative", "death", "recovered"]}
+    increases = {col: pd.array([None, 1, 2], dtype="Int64")
+                 for col in ["deathincrease", "hospitalizedincrease", "positiveincrease"]}
+    rearc_testing_states_daily = pd.DataFrame({
+        "fips": pd.array(["1", "6", "1"], dtype="string"),
+        "date": pd.array([20200301, 20200301, 20200302], dtype="Int64"),
+        "state": pd.Categorical(["AL", "CA", "AL"]),
+        **measures, **increases,
+    })
+    return enigma_jhu, nytimes_data_us_county, rearc_usa_hospital_beds, rearc_testing_states_daily
+
+
+def test_build_fact_covid_fills_missing_measures_next_to_categorical_columns(sources):
+    enigma_jhu, nytimes_data_us_county, rearc_usa_hospital_beds, rearc_testing_states_daily = sources
+    dim_region = transforms.build_dim_region(enigma_jhu, nytimes_data_us_county)
+    dim_hospital = transforms.build_dim_hospital(rearc_usa_hospital_beds)
+    fact_covid = transforms.build_fact_covid(rearc_testing_states_daily, dim_region, dim_hospital)
+
+    assert list(fact_covid.columns) == transforms.FACT_COVID_COLUMNS
+    assert fact_covid["state_fips"].dtype == fips_codec.STATE_FIPS_DTYPE
+    assert isinstance(fact_covid["state"].dtype, pd.CategoricalDtype)
+    assert not fact_covid[transforms.FACT_MEASURE_COLUMNS].isna().any().any()
+    first = fact_covid[(fact_covid["state"] == "AL") & (fact_covid["date"] == 20200301)].iloc[0]
+    assert first["positive"] == 0 and first["deathincrease"] == 0
+
+
+def test_build_fact_covid_joins_the_first_keys_of_each_state(sources):
+    enigma_jhu, nytimes_data_us_county, rearc_usa_hospital_beds, rearc_testing_states_daily = sources
+    dim_region = transforms.build_dim_region(enigma_jhu, nytimes_data_us_county)
+    dim_hospital = transforms.build_dim_hospital(rearc_usa_hospital_beds)
+    fact_covid = transforms.build_fact_covid(rearc_testing_states_daily, dim_region, dim_hospital)
+
+    keys = fact_covid.drop_duplicates("state_fips").set_index("state_fips")[["region_sk", "hosp_sk"]]
+    assert keys.loc["01"].tolist() == [1, 1]
+    assert keys.loc["06"].tolist() == [3, 2]
+    # Puerto Rico has no daily figures, its region is not in the fact table
+    assert sorted(fact_covid["state_fips"].astype(str).unique()) == ["01", "06"]
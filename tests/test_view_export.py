@@ -0,0 +1,62 @@
+# UNLOAD of the dashboard views and the local rebuild from the manifest
+import gzip
+import json
+
+import boto3
+import pandas as pd
+import pytest
+
+import view_export
+from conftest import BUCKET, REGION
+
+IAM_ROLE = "arn:aws:iam::123456789012:role/redshift-s3-access"
+PREFIX = "export/state_daily/part_"
+
+
+def flat(sql):
+    return " ".join(sql.split())
+
+
+def test_unload_sql_writes_a_manifest_of_parallel_parts():
+    sql = flat(view_export.unload_sql("state_daily", "covid_dw", f"s3://{BUCKET}/{PREFIX}", IAM_ROLE, REGION))
+    assert sql == (f"UNLOAD ('SELECT * FROM covid_dw.public.state_daily') TO 's3://{BUCKET}/{PREFIX}' "
+                   f"credentials 'aws_iam_role={IAM_ROLE}' region '{REGION}' FORMAT AS PARQUET "
+                   "MANIFEST ALLOWOVERWRITE PARALLEL ON")
+    csv = flat(view_export.unload_sql("us_totals", "covid_dw", f"s3://{BUCKET}/{PREFIX}", IAM_ROLE, REGION,
+                                      export_format="csv", parallel=False))
+    assert "FORMAT AS CSV HEADER GZIP MANIFEST" in csv and csv.endswith("PARALLEL OFF")
+
+
+def part_body(df, export_format):
+    if export_format == "parquet":
+        return df.to_parquet(index=False)
+    return gzip.compress(df.to_csv(index=False).encode())
+
+
+@pytest.mark.parametrize("export_format", view_export.EXPORT_FORMATS)
+def test_only_the_parts_in_the_manifest_are_read(aws, tmp_path, export_format):
+    s3 = boto3.client("s3", region_name=REGION)
+    parts = [pd.DataFrame({"date": [20210302, 20210301], "state_abv": ["CA", "CA"], "positive": [9, 5]}),
+             pd.DataFrame({"date": [20210301], "state_abv": ["AL"], "positive": [7]})]
+    for i, df in enumerate(parts):
+        s3.put_object(Bucket=BUCKET, Key=f"{PREFIX}000{i}", Body=part_body(df, export_format))
+    # A part an earlier run with more slices left under the same prefix
+    stale = pd.DataFrame({"date": [20200101], "state_abv": ["XX"], "positive": [0]})
+    s3.put_object(Bucket=BUCKET, Key=f"{PREFIX}0002", Body=part_body(stale, export_format))
+    manifest = {"entries": [{"url": f"s3://{BUCKET}/{PREFIX}000{i}"} for i in range(len(parts))]}
+    s3.put_object(Bucket=BUCKET, Key=f"{PREFIX}manifest", Body=json.dumps(manifest).encode())
+
+    output = tmp_path / "state_daily.csv"
+    rows = view_export.export_view(s3, BUCKET, f"{PREFIX}manifest", str(output), export_format,
+                                   view_export.EXPORT_VIEWS["state_daily"])
+    assert rows == 3
+    assert output.read_text() == ("date,state_abv,positive\n"
+                                  "20210301,AL,7\n20210301,CA,5\n20210302,CA,9\n")
+
+
+def test_empty_parts_are_left_out():
+    # A slice without rows unloads a parquet part without columns
+    empty = pd.DataFrame()
+    df = view_export.reassemble([empty, pd.DataFrame({"total": [3]})], [])
+    assert df["total"].tolist() == [3]
+    assert view_export.reassemble([empty], []).empty
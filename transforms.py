@@ -0,0 +1,151 @@
+# Pandas transforms that build the warehouse star schema
+# from the extracted source tables
+import pandas as pd
+
+import fips_codec
+import spans
+
+DIM_REGION_COLUMNS = ['region_sk', 'fips', 'state_fips', 'county_fips',
+                      'province_state', 'county', 'country_region', 'latitude', 'longitude']
+DIM_HOSPITAL_COLUMNS = ['hosp_sk', 'fips', 'state_fips', 'county_fips', 'state_name',
+                        'county_name', 'hospital_name', 'hq_address', 'hq_city',
+                        'hq_state', 'hq_zip_code', 'hospital_type', 'latitude', 'longtitude']
+FACT_COVID_COLUMNS = ['date', 'state_fips', 'state', 'positive', 'positiveincrease', 'negative',
+                      'death', 'deathincrease', 'recovered', 'hospitalized', 'hospitalizedcurrently',
+                      'hospitalizeddischarged', 'hospitalizedcumulative', 'hospitalizedincrease',
+                      'region_sk', 'hosp_sk']
+# Total orders the dimension rows are numbered in without a registry,
+# athena_ctas numbers its rows in the same order
+DIM_REGION_ORDER = ['state_code', 'county_code', 'province_state', 'county', 'country_region',
+                    'latitude', 'longitude']
+DIM_HOSPITAL_ORDER = ['state_code', 'county_code', 'hospital_name', 'hq_address', 'state_name', 'county_name',
+                      'hq_city', 'hq_state', 'hq_zip_code', 'hospital_type', 'latitude', 'longtitude']
+# Missing figures are loaded as 0. The key and text columns can be
+# categoricals, which only take values from their categories
+FACT_MEASURE_COLUMNS = ['positive', 'positiveincrease', 'negative', 'death', 'deathincrease', 'recovered',
+                        'hospitalized', 'hospitalizedcurrently', 'hospitalizeddischarged',
+                        'hospitalizedcumulative', 'hospitalizedincrease']
+
+
+def sort_rows(df, by):
+    """Sort on the column values, categoricals by their text instead of their category order"""
+    return df.sort_values(
+        by=by, kind="stable",
+        key=lambda col: col.astype("string") if isinstance(col.dtype, pd.CategoricalDtype) else col,
+    ).reset_index(drop=True)
+
+
+def build_dim_region(enigma_jhu, nytimes_data_us_county, registry=None):
+    """dim_region keyed by row order, or by a key_registry.KeyRegistry when given"""
+    print("Creating DWH dim_region table...")
+    with spans.span("dim_region", "dim_region COMPLETE.") as s:
+        dim_region1 = enigma_jhu[['fips', 'province_state', 'country_region',
+                                  'latitude', 'longitude']][enigma_jhu['province_state'] != 'Grand Princess']
+        dim_region1 = dim_region1.dropna(subset=['fips'])
+        dim_region2 = nytimes_data_us_county[['fips', 'county']]
+        dim_region = pd.merge(dim_region1, dim_region2, on='fips', how='inner')
+        dim_region = dim_region.dropna(subset=['fips', 'latitude', 'longitude'])
+        dim_region.drop_duplicates(inplace=True)
+        dim_region.reset_index(drop=True, inplace=True)
+        dim_region = dim_region.drop(columns=['fips']).join(fips_codec.parse_county_fips(dim_region['fips']))
+        dim_region = sort_rows(dim_region, DIM_REGION_ORDER)
+        if registry is not None:
+            # One row per natural key so every key is used once
+            dim_region = dim_region.drop_duplicates(subset=registry.natural_keys).reset_index(drop=True)
+            dim_region['region_sk'] = registry.assign(dim_region)
+        else:
+            dim_region['region_sk'] = dim_region.reset_index()['index']
+            dim_region = dim_region.dropna(subset=['region_sk']).reset_index(drop=True)
+            dim_region['region_sk'] = dim_region['region_sk'].astype(int) + 1
+        dim_region = dim_region[DIM_REGION_COLUMNS]
+        s.add(rows_in=len(enigma_jhu) + len(nytimes_data_us_county), rows_out=len(dim_region))
+    return dim_region
+
+
+def build_dim_hospital(rearc_usa_hospital_beds, registry=None):
+    """dim_hospital keyed by row order, or by a key_registry.KeyRegistry when given"""
+    print("Creating DWH dim_hospital table...")
+    with spans.span("dim_hospital", "dim_hospital COMPLETE.") as s:
+        dim_hospital = rearc_usa_hospital_beds[['fips', 'state_name', 'county_name', 'latitude', 'longtitude',
+                                                'hospital_name', 'hq_address', 'hq_city', 'hq_state',
+                                                'hq_zip_code', 'hospital_type']].dropna(
+                                                    subset=['fips', 'state_name']).reset_index(drop=True)
+        dim_hospital = dim_hospital.drop(columns=['fips']).join(fips_codec.parse_county_fips(dim_hospital['fips']))
+        dim_hospital.hq_zip_code = dim_hospital.hq_zip_code.str.zfill(5)
+        dim_hospital = sort_rows(dim_hospital, DIM_HOSPITAL_ORDER)
+        if registry is not None:
+            dim_hospital = dim_hospital.drop_duplicates(subset=registry.natural_keys).reset_index(drop=True)
+            dim_hospital['hosp_sk'] = registry.assign(dim_hospital)
+        else:
+            dim_hospital['hosp_sk'] = dim_hospital.reset_index()['index']
+            dim_hospital['hosp_sk'] = dim_hospital['hosp_sk'].astype(int) + 1
+        dim_hospital = dim_hospital[DIM_HOSPITAL_COLUMNS]
+        s.add(rows_in=len(rearc_usa_hospital_beds), rows_out=len(dim_hospital))
+    return dim_hospital
+
+
+# Create date_dim calendar table
+# This table could be passed an indefinite end date
+def create_date_dim(start, end, loaded=None):
+    """Calendar rows from start to end, every attribute computed on whole columns
+
+    :param start: first date
+    :param end: last date, can lie past the source data
+    :param loaded: (first, last) date_id already in the warehouse, those dates are left out
+    :return: DataFrame with one row per missing date
+    """
+    print("Creating DWH dim_date table...")
+    with spans.span("dim_date") as s:
+        dates = pd.date_range(start, end)
+        date_ids = dates.year * 10000 + dates.month * 100 + dates.day
+        if loaded is not None:
+            keep = (date_ids < loaded[0]) | (date_ids > loaded[1])
+            dates, date_ids = dates[keep], date_ids[keep]
+        df = pd.DataFrame({"date_id": date_ids, "date": dates})
+        df["day_name"] = dates.day_name()
+        df["day_of_week"] = dates.day_of_week + 1  # Start Monday at 1
+        df["day"] = dates.day
+        df["day_of_year"] = dates.day_of_year
+        df["month"] = dates.month
+        df["month_name"] = dates.month_name()
+        df["week"] = dates.isocalendar().week.to_numpy()
+        df["quarter"] = dates.quarter
+        df["year"] = dates.year
+        df["year_half"] = (dates.month > 6) + 1
+        df["is_weekend"] = dates.weekday >= 5
+        s.add(rows_out=len(df))
+        s.done = f"dim_date COMPLETE. {len(df)} dates."
+    return df
+
+
+def build_fact_covid(rearc_testing_states_daily, dim_region, dim_hospital):
+    """Join the daily state figures to the first region and hospital key of each state"""
+    print("Creating DWH fact_covid table...")
+    with spans.span("fact_covid", "fact_covid COMPLETE.") as s:
+        fact_covid1 = rearc_testing_states_daily[['fips', 'date', 'positive', 'negative', 'hospitalized', 'state',
+                                                  'hospitalizedcurrently', 'hospitalizeddischarged',
+                                                  'hospitalizedcumulative', 'death', 'recovered', 'deathincrease',
+                                                  'hospitalizedincrease', 'positiveincrease']]
+        fact_covid1 = fact_covid1.dropna(subset=['fips', 'state']).reset_index(drop=True)
+        fact_covid1['state_fips'] = fips_codec.parse_state_fips(fact_covid1['fips'])
+        fact_covid1.drop(['fips'], axis=1, inplace=True)
+        fact_covid1 = fact_covid1.sort_values(by=['state_fips'])
+        fact_covid1.set_index(['state_fips'], inplace=True)
+
+        fact_covid2 = dim_region[['state_fips', 'region_sk']]
+        fact_covid2 = fact_covid2.sort_values(by=['state_fips', 'region_sk']).reset_index(drop=True)
+        fact_covid2.set_index(['state_fips'], inplace=True)
+        fact_covid2 = fact_covid2.groupby(fact_covid2.index, observed=True).first()
+
+        fact_covid3 = dim_hospital[['state_fips', 'hosp_sk']]
+        fact_covid3 = fact_covid3.sort_values(by=['state_fips', 'hosp_sk']).reset_index(drop=True)
+        fact_covid3.set_index(['state_fips'], inplace=True)
+        fact_covid3 = fact_covid3.groupby(fact_covid3.index, observed=True).first()
+
+        fact_covid4 = pd.merge(fact_covid1, fact_covid2, how='inner', left_index=True, right_index=True)
+        fact_covid = pd.merge(fact_covid3, fact_covid4, how='inner', left_index=True, right_index=True)
+        fact_covid.reset_index(inplace=True)
+        fact_covid[FACT_MEASURE_COLUMNS] = fact_covid[FACT_MEASURE_COLUMNS].fillna(0)
+        fact_covid = fact_covid[FACT_COVID_COLUMNS]
+        s.add(rows_in=len(rearc_testing_states_daily), rows_out=len(fact_covid))
+    return fact_covid
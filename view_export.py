@@ -0,0 +1,82 @@
+# UNLOAD of the dashboard views and the rebuild of the local output/
+# files. Views are unloaded by every slice at once and the parts are
+# downloaded concurrently, then put back together in view order
+import json
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+import pandas as pd
+
+EXPORT_FORMATS = ("parquet", "csv")
+
+# View -> columns the rebuilt file is sorted on. Parallel parts
+# come back in slice order, not in the order of the view
+EXPORT_VIEWS = {
+    "us_totals": [],
+    "state_totals": ["state_abv"],
+    "state_daily": ["date", "state_abv"],
+}
+
+
+def unload_sql(view, database, s3_prefix, iam_role, region, export_format="parquet", parallel=True):
+    """UNLOAD of one view with a manifest listing the parts it wrote
+
+    :param s3_prefix: s3 url the part names start with, the manifest is <prefix>manifest
+    """
+    file_format = "FORMAT AS PARQUET" if export_format == "parquet" else "FORMAT AS CSV HEADER GZIP"
+    return f"""
+        UNLOAD ('SELECT * FROM {database}.public.{view}')
+        TO '{s3_prefix}'
+        credentials 'aws_iam_role={iam_role}'
+        region '{region}'
+        {file_format}
+        MANIFEST
+        ALLOWOVERWRITE
+        PARALLEL {"ON" if parallel else "OFF"}
+    """
+
+
+def manifest_urls(body):
+    """Part urls of an UNLOAD manifest, earlier runs may have left other parts under the prefix"""
+    return [entry["url"] for entry in json.loads(body)["entries"]]
+
+
+def read_part(body, export_format):
+    if export_format == "parquet":
+        return pd.read_parquet(BytesIO(body))
+    return pd.read_csv(BytesIO(body), compression="gzip")
+
+
+def download_parts(client, urls, export_format, max_workers=8):
+    """Download and parse the parts concurrently
+
+    :return: list of DataFrames in manifest order
+    """
+    def fetch(url):
+        bucket, key = url.replace("s3://", "").split("/", 1)
+        return read_part(client.get_object(Bucket=bucket, Key=key)["Body"].read(), export_format)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        return list(pool.map(fetch, urls))
+
+
+def reassemble(parts, order_by):
+    """One frame from the parts, sorted like the view"""
+    parts = [part for part in parts if len(part.columns)]
+    if not parts:
+        return pd.DataFrame()
+    df = pd.concat(parts, ignore_index=True)
+    if order_by:
+        df = df.sort_values(order_by, kind="stable").reset_index(drop=True)
+    return df
+
+
+def export_view(client, bucket, manifest_key, output_path, export_format, order_by, max_workers=8):
+    """Rebuild the local csv of a view from its unloaded parts
+
+    :return: rows written
+    """
+    body = client.get_object(Bucket=bucket, Key=manifest_key)["Body"].read()
+    df = reassemble(download_parts(client, manifest_urls(body), export_format, max_workers), order_by)
+    df.to_csv(output_path, index=False)
+    return len(df)